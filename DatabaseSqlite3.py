@@ -1,11 +1,134 @@
+import csv
+import json
 import logging
+import itertools
 import sqlite3
-import pandas as pd
+import threading
+import functools
+import contextlib
 
 logger = logging.getLogger("__name__")
 
+# Pragmas applied once to every pooled connection
+POOL_PRAGMAS = {
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL",
+    "temp_store": "MEMORY",
+    "cache_size": -8000,
+    "mmap_size": 67108864,
+}
+
+# Size of the per connection prepared statement cache of sqlite3
+STATEMENT_CACHE_SIZE = 256
+
+# Rows fetched and inserted per batch by the export and import functions
+BATCH_SIZE = 500
+
+def pandas():
+    """
+    The pandas module, imported on first use. Only the dataframe functions need it,
+    the bot itself never loads it. None when pandas is not installed.
+    """
+    try:
+        import pandas
+    except ImportError as e:
+        logger.error("Dataframe functions need pandas, it is not installed")
+        logger.error(e)
+        return None
+    return pandas
+
+@functools.lru_cache(maxsize=STATEMENT_CACHE_SIZE)
+def build_select(table_name, columns, where=None, order_by=None, limit=False):
+    """Build the statement text of a parameterized SELECT, equal arguments give the same text"""
+    query = "SELECT " + ", ".join(columns) + " FROM " + table_name
+    if where:
+        query += " WHERE " + where
+    if order_by:
+        query += " ORDER BY " + order_by
+    if limit:
+        query += " LIMIT ?"
+    return query
+
+@functools.lru_cache(maxsize=STATEMENT_CACHE_SIZE)
+def build_update(table_name, columns, where):
+    """Build the statement text of a parameterized UPDATE"""
+    return "UPDATE " + table_name + " SET " + ", ".join(column + " = ?" for column in columns) + " WHERE " + where
+
+@functools.lru_cache(maxsize=STATEMENT_CACHE_SIZE)
+def build_insert(table_name, columns):
+    """Build the statement text of a parameterized INSERT"""
+    return "INSERT INTO " + table_name + " (" + ", ".join(columns) + ") VALUES (" + ", ".join("?" for column in columns) + ")"
+
+class ConnectionPool():
+    """
+    Hands out long-lived sqlite3 connections for one database file.
+    Every thread gets its own connection which is reused for all its handlers,
+    connections of finished threads are closed the next time a connection is made.
+    """
+    def __init__(self, connection_string, timeout=30.0, pragmas=None):
+        self.connection_string = connection_string
+        self.timeout = timeout
+        self.pragmas = POOL_PRAGMAS if pragmas is None else pragmas
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.connections = {}
+
+    def acquire(self):
+        """Get the connection of the current thread, create it if there is none yet"""
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = self.connect()
+            self.local.conn = conn
+            self.local.users = 0
+            with self.lock:
+                self.prune()
+                self.connections[threading.get_ident()] = (threading.current_thread(), conn)
+        self.local.users += 1
+        return conn
+
+    def release(self, conn):
+        """Give a connection back, work that was not committed is rolled back"""
+        if conn is not getattr(self.local, "conn", None):
+            logger.error("Connection released by a thread that does not own it")
+            return
+        self.local.users -= 1
+        if self.local.users <= 0:
+            self.local.users = 0
+            if conn.in_transaction:
+                logger.warning("Rolling back uncommitted work on released connection")
+                conn.rollback()
+
+    def connect(self):
+        """Open a new connection and apply the pool pragmas"""
+        conn = sqlite3.connect(self.connection_string, timeout=self.timeout, check_same_thread=False, cached_statements=STATEMENT_CACHE_SIZE)
+        for pragma, value in self.pragmas.items():
+            try:
+                conn.execute("PRAGMA " + pragma + " = " + str(value))
+            except Exception as e:
+                logger.error("Unable to set pragma: " + pragma)
+                logger.error(e)
+        return conn
+
+    def prune(self):
+        """Close the connections of threads that are no longer alive"""
+        for ident, (thread, conn) in list(self.connections.items()):
+            if not thread.is_alive():
+                conn.close()
+                del self.connections[ident]
+
+    def close_all(self):
+        """Close every connection of the pool"""
+        with self.lock:
+            for thread, conn in self.connections.values():
+                conn.close()
+            self.connections = {}
+        self.local = threading.local()
+
 class DatabaseSqlite3():
-    def __init__(self, connection_string, check=False):
+    def __init__(self, connection_string, check=False, pool=None):
+        self.pool = pool
+        self.transaction_depth = 0
+        self.commit_callbacks = []
         self.set_conn(connection_string)
         self.set_cursor(self.get_conn())
         self.set_type("sqlite3")
@@ -29,15 +152,17 @@ class DatabaseSqlite3():
         self.route_columns = [column_names, column_types, column_extras]
 
         # Ticket table
-        column_names = ["id","city1","city2","value","special","owner"]
-        column_types = ["INTEGER", "INTEGER", "INTEGER", "INTEGER", "INTEGER", "INTEGER"]
-        column_extras = ["PRIMARY KEY AUTOINCREMENT", "NOT NULL", "NOT NULL", "NOT NULL", "NOT NULL",""]
+        # position orders the tickets of an owner, the stack is drawn from the lowest
+        column_names = ["id","city1","city2","value","special","owner","position"]
+        column_types = ["INTEGER", "INTEGER", "INTEGER", "INTEGER", "INTEGER", "INTEGER", "INTEGER"]
+        column_extras = ["PRIMARY KEY AUTOINCREMENT", "NOT NULL", "NOT NULL", "NOT NULL", "NOT NULL","",""]
         self.ticket_columns = [column_names, column_types, column_extras]
 
         # Card table
-        column_names = ["id","color","owner"]
-        column_types = ["INTEGER", "TEXT", "INTEGER"]
-        column_extras = ["PRIMARY KEY AUTOINCREMENT", "NOT NULL", ""]
+        # position orders the cards of an owner, the deck is drawn from the lowest
+        column_names = ["id","color","owner","position"]
+        column_types = ["INTEGER", "TEXT", "INTEGER", "INTEGER"]
+        column_extras = ["PRIMARY KEY AUTOINCREMENT", "NOT NULL", "", ""]
         self.card_columns = [column_names, column_types, column_extras]
 
         # Turn table
@@ -46,6 +171,17 @@ class DatabaseSqlite3():
         column_extras = ["PRIMARY KEY NOT NULL", "NOT NULL", "NOT NULL", ""]
         self.turn_columns = [column_names, column_types, column_extras]
 
+        # Meta table, settings of the database like the checksum of the config it was seeded with
+        column_names = ["key","value"]
+        column_types = ["TEXT", "TEXT"]
+        column_extras = ["PRIMARY KEY NOT NULL", ""]
+        self.meta_columns = [column_names, column_types, column_extras]
+
+        # Indexes created together with their table. The game state answers the reads
+        # from memory and writes rows by primary key, an index on the game tables only
+        # costs writes (benchmarks/indexes.py)
+        self.table_indexes = {"Player": [], "City": [], "Route": [], "Ticket": [], "Card": [], "Turn": []}
+
         if check:
             tables = self.table_info()
             if "Player" not in tables:
@@ -60,8 +196,23 @@ class DatabaseSqlite3():
                 self.create_table("Card", self.card_columns)
             if "Turn" not in tables:
                 self.create_table("Turn", self.turn_columns)   
+            if "Meta" not in tables:
+                self.create_table("Meta", self.meta_columns)
             logger.info("All tables present in database!")
 
+            # Databases made before the piles had an order get the position columns
+            for table_name in ["Ticket", "Card"]:
+                if "position" not in self.columns_info(table_name):
+                    self.cursor.execute("ALTER TABLE " + table_name + " ADD COLUMN position INTEGER")
+                    logger.info("Column position added to " + table_name)
+
+            # Databases made before the indexes existed get them here, the ones no longer declared are dropped
+            for table_name, indexes in self.table_indexes.items():
+                self.create_indexes(table_name, indexes)
+                self.drop_stale_indexes(table_name, indexes)
+            self.optimize()
+            logger.info("All indexes present in database!")
+
     def create_table(self, table_name, columns_info):
         """Create a table with table_name as name and columns_info as columns"""
         query = "CREATE TABLE IF NOT EXISTS " + table_name + " ("
@@ -77,6 +228,42 @@ class DatabaseSqlite3():
             logger.debug(query)
             logger.error("Unable to create: " + table_name)
             logger.error(e)
+            if self.in_transaction():
+                raise
+
+        if table_name in self.table_indexes:
+            self.create_indexes(table_name, self.table_indexes[table_name])
+
+    def create_indexes(self, table_name, indexes_info):
+        """
+        Create the indexes of a table if they don't exist yet.
+        indexes_info is a list of [index name, list of column expressions]
+        """
+        for index_name, columns in indexes_info:
+            query = "CREATE INDEX IF NOT EXISTS " + index_name + " ON " + table_name + " (" + ", ".join(columns) + ");"
+            try:
+                self.cursor.execute(query)
+            except Exception as e:
+                logger.debug(query)
+                logger.error("Unable to create index: " + index_name)
+                logger.error(e)
+
+    def drop_stale_indexes(self, table_name, indexes_info):
+        """Drop the idx_ indexes of a table that are not in indexes_info"""
+        declared = [index_name for index_name, columns in indexes_info]
+        rows = self.cursor.execute("SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = ? AND name LIKE 'idx\\_%' ESCAPE '\\'", (table_name,)).fetchall()
+        for (index_name,) in rows:
+            if index_name not in declared:
+                self.cursor.execute("DROP INDEX " + index_name)
+                logger.info("Index " + index_name + " dropped")
+
+    def optimize(self):
+        """Let sqlite refresh the statistics the query planner uses to pick indexes"""
+        try:
+            self.cursor.execute("PRAGMA optimize;")
+        except Exception as e:
+            logger.error("Unable to optimize database")
+            logger.error(e)
 
     def insert_data_table(self, table_name, columns, data):
         """
@@ -96,15 +283,19 @@ class DatabaseSqlite3():
 
         try:
             self.cursor.executemany(query, data)
-            self.conn.commit()
+            self.commit()
         except Exception as e:
             logger.debug(query)
             logger.error("Unable to add data rows")
             logger.error(e)
+            if self.in_transaction():
+                raise
 
     def insert_df_table(self, table_name, data):
         """Inserts a pandas Dataframe in a table specified by table_name."""
         # https://www.dataquest.io/blog/sql-insert-tutorial/
+        if pandas() is None:
+            return
         try:
             data.to_sql(name=table_name, con=self.conn, if_exists="append", index=False)
         except Exception as e:
@@ -129,11 +320,13 @@ class DatabaseSqlite3():
         
         try:
             self.cursor.execute(query)
-            self.conn.commit()
+            self.commit()
         except Exception as e:
             logger.debug(query)
             logger.error("Unable to update row")
             logger.error(e)
+            if self.in_transaction():
+                raise
 
     def get_data_table(self, table_name, columns, where):
         """"
@@ -159,14 +352,105 @@ class DatabaseSqlite3():
 
         return result
 
+    def select(self, table_name, columns, where=None, params=(), order_by=None, limit=None):
+        """
+        Get rows from a table with a parameterized query.
+        columns is a list of column names
+        where is a condition with ? placeholders which are bound to params
+        order_by is an ORDER BY expression and limit the maximum amount of rows
+        A list of tuples is returned.
+        """
+        result = []
+        query = build_select(table_name, tuple(columns), where, order_by, limit is not None)
+        if limit is not None:
+            params = tuple(params) + (limit,)
+
+        try:
+            result = self.cursor.execute(query, params).fetchall()
+        except Exception as e:
+            logger.debug(query)
+            logger.error("Unable to get data")
+            logger.error(e)
+
+        return result
+
+    def select_one(self, table_name, columns, where=None, params=(), order_by=None):
+        """Get the first row of a parameterized query or None"""
+        result = self.select(table_name, columns, where, params, order_by, 1)
+        if len(result) < 1:
+            return None
+        return result[0]
+
+    def update(self, table_name, data, where, params=()):
+        """
+        Update rows in a table with a parameterized query.
+        data is a dict of the columns and values you want to update
+        where is a condition with ? placeholders which are bound to params
+        Returns the amount of updated rows.
+        """
+        query = build_update(table_name, tuple(data.keys()), where)
+
+        try:
+            self.cursor.execute(query, tuple(data.values()) + tuple(params))
+            self.commit()
+        except Exception as e:
+            logger.debug(query)
+            logger.error("Unable to update row")
+            logger.error(e)
+            if self.in_transaction():
+                raise
+            return 0
+
+        return self.cursor.rowcount
+
+    def insert(self, table_name, columns, data):
+        """
+        Insert rows in a table with a parameterized query.
+        columns is a list of column names and data a list of tuples
+        """
+        query = build_insert(table_name, tuple(columns))
+
+        try:
+            self.cursor.executemany(query, data)
+            self.commit()
+        except Exception as e:
+            logger.debug(query)
+            logger.error("Unable to add data rows")
+            logger.error(e)
+            if self.in_transaction():
+                raise
+
+    def get_meta(self, key):
+        """Value of a key in the Meta table or None"""
+        row = self.select_one("Meta", ["value"], "key = ?", (key,))
+        if row is None:
+            return None
+        return row[0]
+
+    def set_meta(self, key, value):
+        """Store the value of a key in the Meta table"""
+        query = "INSERT OR REPLACE INTO Meta (key, value) VALUES (?, ?);"
+        try:
+            self.cursor.execute(query, (key, value))
+            self.commit()
+        except Exception as e:
+            logger.debug(query)
+            logger.error("Unable to set meta: " + key)
+            logger.error(e)
+            if self.in_transaction():
+                raise
+
     def get_data_df_table(self, table_name, columns, where, between_1, between_2, index = None):
         """
         Get the data from a table specified by table_name.
         columns is a list of the columns you want to have
         where is the column string
         between are the strings for the values
-        A Pandas dataframe is returned.
+        A Pandas dataframe is returned, None when pandas is not installed.
         """
+        pd = pandas()
+        if pd is None:
+            return None
         df = pd.DataFrame()
         query = "SELECT "
         for column in columns[0]:
@@ -189,6 +473,133 @@ class DatabaseSqlite3():
         
         return df
 
+    def iter_rows(self, table_name, columns=None, where=None, params=()):
+        """
+        Iterate over the rows of a table as tuples, fetched in batches on a cursor of its own.
+        columns is a list of column names, all columns when None.
+        """
+        if columns is None:
+            columns = self.columns_info(table_name)
+        query = build_select(table_name, tuple(columns), where)
+        cursor = self.conn.cursor()
+        try:
+            cursor.execute(query, params)
+            while True:
+                rows = cursor.fetchmany(BATCH_SIZE)
+                if not rows:
+                    break
+                for row in rows:
+                    yield row
+        finally:
+            cursor.close()
+
+    def export_csv(self, table_name, file_name, columns=None, where=None, params=()):
+        """Write the rows of a table to a CSV file with a header line, returns the amount of rows"""
+        if columns is None:
+            columns = self.columns_info(table_name)
+        amount = 0
+        with open(file_name, "w", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(columns)
+            for row in self.iter_rows(table_name, columns, where, params):
+                writer.writerow(row)
+                amount += 1
+        return amount
+
+    def export_jsonl(self, table_name, file_name, columns=None, where=None, params=()):
+        """Write the rows of a table to a file with a JSON object per line, returns the amount of rows"""
+        if columns is None:
+            columns = self.columns_info(table_name)
+        amount = 0
+        with open(file_name, "w") as f:
+            for row in self.iter_rows(table_name, columns, where, params):
+                f.write(json.dumps(dict(zip(columns, row))) + "\n")
+                amount += 1
+        return amount
+
+    def import_rows(self, table_name, columns, rows):
+        """Insert an iterable of row tuples in batches in one transaction, returns the amount of rows"""
+        query = build_insert(table_name, tuple(columns))
+        amount = 0
+        batch = []
+        with self.transaction():
+            for row in rows:
+                batch.append(row)
+                if len(batch) == BATCH_SIZE:
+                    self.cursor.executemany(query, batch)
+                    amount += len(batch)
+                    batch = []
+            if batch:
+                self.cursor.executemany(query, batch)
+                amount += len(batch)
+        return amount
+
+    def import_csv(self, table_name, file_name):
+        """Insert the rows of a CSV file with a header line of column names, returns the amount of rows"""
+        with open(file_name, newline="") as f:
+            reader = csv.reader(f)
+            columns = next(reader)
+            # CSV has no types, empty fields are NULL and sqlite converts the rest to the column type
+            return self.import_rows(table_name, columns, (tuple(value if value != "" else None for value in row) for row in reader))
+
+    def import_jsonl(self, table_name, file_name):
+        """Insert the rows of a file with a JSON object per line, returns the amount of rows"""
+        with open(file_name) as f:
+            objects = (json.loads(line) for line in f if line.strip())
+            first = next(objects, None)
+            if first is None:
+                return 0
+            columns = list(first.keys())
+            return self.import_rows(table_name, columns, (tuple(row.get(column) for column in columns) for row in itertools.chain([first], objects)))
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """
+        Unit of work: everything executed inside is committed once at the end
+        of the outermost transaction, or rolled back when an exception is raised.
+        The write functions raise their errors inside it, so a failed write rolls
+        the whole unit back. Outside a transaction they log them and carry on.
+        """
+        if self.transaction_depth == 0 and not self.conn.in_transaction:
+            self.conn.execute("BEGIN IMMEDIATE")
+        self.transaction_depth += 1
+        try:
+            yield self
+        except BaseException:
+            self.transaction_depth -= 1
+            if self.transaction_depth == 0:
+                self.conn.rollback()
+                self.commit_callbacks = []
+                logger.warning("Transaction rolled back")
+            raise
+        self.transaction_depth -= 1
+        self.commit()
+
+    def in_transaction(self):
+        """Check if a transaction scope is open"""
+        return self.transaction_depth > 0
+
+    def commit(self):
+        """Commit, deferred until the end of the outermost transaction when one is open"""
+        if self.transaction_depth > 0:
+            return
+        self.conn.commit()
+        callbacks = self.commit_callbacks
+        self.commit_callbacks = []
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception as e:
+                logger.error("Commit callback failed")
+                logger.error(e)
+
+    def after_commit(self, callback):
+        """Run callback once the current transaction is committed, or right away without transaction"""
+        if self.transaction_depth > 0:
+            self.commit_callbacks.append(callback)
+        else:
+            callback()
+
     def get_max_from_column(self, table_name, column):
         """Get the row in which the maximum of a specified column is present""" 
         self.cursor.execute("SELECT max(" + column + ") FROM " + table_name)
@@ -219,6 +630,8 @@ class DatabaseSqlite3():
             logger.debug(query)
             logger.error("Unable to delete: " + table_name)
             logger.error(e)
+            if self.in_transaction():
+                raise
 
     def table_info(self):
         """Get the name of the tables present in the database"""
@@ -237,7 +650,7 @@ class DatabaseSqlite3():
         return list(table_names)
 
     def columns_info(self, table_name):
-        """Get column names and types from a table. Returns 2 dimensional array"""
+        """Get the column names of a table as a list"""
         column_names = []
         query = "PRAGMA table_info(" + table_name + ")"
         try:
@@ -252,8 +665,18 @@ class DatabaseSqlite3():
         return column_names
 
     def close(self):
-        """Close database connection"""
-        self.conn.close()
+        """Close database connection, pooled connections are given back to the pool"""
+        if self.pool is not None:
+            self.pool.release(self.conn)
+        else:
+            self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
 
     ### GET ###
 
@@ -270,7 +693,10 @@ class DatabaseSqlite3():
 
     def set_conn(self, connection_string):
         try:
-            self.conn = sqlite3.connect(connection_string)
+            if self.pool is not None:
+                self.conn = self.pool.acquire()
+            else:
+                self.conn = sqlite3.connect(connection_string, cached_statements=STATEMENT_CACHE_SIZE)
         except Exception as e:
             logger.critical("Unable to connect to database with connection string: " + connection_string)
             logger.critical(e)
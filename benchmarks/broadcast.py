@@ -0,0 +1,73 @@
+"""
+Benchmark of the broadcast fan-out against the local stub Telegram api.
+A market pick sends 3 broadcasts to every player. The old way did one blocking
+requests.get per player on the handler thread, the Broadcaster only queues.
+Measured are the time the handler is blocked and the time until every message
+is delivered, afterwards every chat is checked to have received the messages intact
+and in order, also with failing requests.
+
+usage: python benchmarks/broadcast.py [players] [picks]
+"""
+import os
+import sys
+import time
+import logging
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import requests
+
+from broadcaster import Broadcaster
+from stub_telegram import StubTelegram
+
+TOKEN = "123:stub"
+LATENCY = 0.02
+
+def messages(picks):
+    for pick in range(picks):
+        yield "blue (Bob) choose red from the market. #" + str(pick)
+        yield "New Market: \n1 red & 2 blue #" + str(pick)
+        yield "Turn for player red -> Alice #" + str(pick)
+
+def sequential(server, players, picks):
+    """Blocking requests.get per player, without session"""
+    start = time.perf_counter()
+    for message in messages(picks):
+        for player in players:
+            send_text = server.url + '/bot' + TOKEN + '/sendMessage?chat_id=' + str(player) + '&parse_mode=Markdown&text=' + message
+            requests.get(send_text)
+    blocked = time.perf_counter() - start
+    return blocked, blocked
+
+def dispatched(server, players, picks, **kwargs):
+    broadcaster = Broadcaster(TOKEN, api_url=server.url, **kwargs)
+    start = time.perf_counter()
+    for message in messages(picks):
+        broadcaster.broadcast(players, message)
+    blocked = time.perf_counter() - start
+    broadcaster.close()
+    return blocked, time.perf_counter() - start
+
+def check_order(server, players, picks):
+    expected = list(messages(picks))
+    for player in players:
+        if server.messages.get(str(player)) != expected:
+            return False
+    return True
+
+def run(name, function, players, picks, **kwargs):
+    server = StubTelegram(latency=LATENCY, **kwargs).start()
+    blocked, delivered = function(server, players, picks)
+    print(name.ljust(34) + ("%8.1f ms blocked" % (blocked * 1000)) + ("%8.1f ms delivered" % (delivered * 1000)) + ("%6d requests" % server.requests) + ("%4d connections" % server.connections) + "  messages " + ("OK" if check_order(server, players, picks) else "GARBLED"))
+    server.stop()
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.ERROR)
+    amount = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    picks = int(sys.argv[2]) if len(sys.argv) > 2 else 1
+    players = [1001 + i for i in range(amount)]
+    print(str(amount) + " players, " + str(picks) + " market picks, " + str(int(LATENCY * 1000)) + " ms api latency")
+    run("sequential requests.get", sequential, players, picks)
+    run("broadcaster", lambda s, p, n: dispatched(s, p, n), players, picks)
+    run("broadcaster, 10% 500 errors", lambda s, p, n: dispatched(s, p, n, backoff=0.05), players, picks, errors=0.1)
+    run("broadcaster, 5% 429 flood", lambda s, p, n: dispatched(s, p, n, backoff=0.05), players, picks, flood=0.05, retry_after=0.2)
@@ -0,0 +1,63 @@
+"""
+Benchmark of the card piles: drawing the deck empty card by card, discarding every
+card and shuffling the discard pile back, for decks of growing size. Compares the
+lists the piles were, where a draw shifts the whole deck and every reshuffled card
+is looked up in the discard pile, with the deques of the game state that take
+the top card and move the discard pile as a whole.
+
+usage: python benchmarks/decks.py [repeat]
+"""
+import os
+import sys
+import time
+import random
+from collections import deque
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from gamestate import take
+
+SIZES = [110, 1000, 10000]
+
+def with_lists(size, rng):
+    deck = list(range(1, size + 1))
+    discard = []
+    start = time.perf_counter()
+    while deck:
+        card_id = deck[0]
+        deck.remove(card_id)
+        discard.append(card_id)
+    drawn = time.perf_counter()
+    order = list(discard)
+    rng.shuffle(order)
+    for card_id in order:
+        discard.remove(card_id)
+        deck.append(card_id)
+    return drawn - start, time.perf_counter() - drawn
+
+def with_deques(size, rng):
+    deck = deque(range(1, size + 1))
+    discard = deque()
+    start = time.perf_counter()
+    while deck:
+        card_id = deck[0]
+        take(deck, card_id)
+        discard.append(card_id)
+    drawn = time.perf_counter()
+    order = list(discard)
+    rng.shuffle(order)
+    discard.clear()
+    deck.extend(order)
+    return drawn - start, time.perf_counter() - drawn
+
+if __name__ == "__main__":
+    repeat = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    for size in SIZES:
+        for name, function in [("lists", with_lists), ("deques", with_deques)]:
+            rng = random.Random(size)
+            draw = reshuffle = 0
+            for i in range(repeat):
+                elapsed = function(size, rng)
+                draw += elapsed[0]
+                reshuffle += elapsed[1]
+            print("%6d cards  %-6s  draw %7.2f us  reshuffle %9.1f us" % (size, name, draw / (repeat * size) * 1e6, reshuffle / repeat * 1e6))
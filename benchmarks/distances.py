@@ -0,0 +1,79 @@
+"""
+Benchmark of the remaining distances of the tickets during a game.
+Games are played in memory like benchmarks/engine.py does, after every move the
+remaining distance of every ticket of every player is asked, once from the
+incrementally updated matrices and once with a new Dijkstra search per ticket.
+
+usage: python benchmarks/distances.py [games] [players]
+"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from engine import Engine
+from mappack import load_config
+from distances import all_pairs
+from benchmarks.engine import play_turn, MAX_MOVES
+
+PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def fresh(engine, owner, ticket):
+    """Remaining distance of a ticket with a new search"""
+    distances = engine.distances
+    distances.costs[None] = {pair: distances.pair_cost(owner, pair) for pair in distances.pairs}
+    return distances.search(None, ticket["city1"])[ticket["city2"]]
+
+def play_game(config, players, seed):
+    """Play a game, returns (queries, seconds incremental, seconds from scratch)"""
+    engine = Engine.simulation(config, seed)
+    for i, piece in enumerate(config["pieces"][:players]):
+        chat_id = 1001 + i
+        engine.join(chat_id, str(chat_id), piece["color"])
+        engine.keep_tickets(engine.pending[chat_id][0], chat_id)
+    engine.start()
+    queries = 0
+    incremental = [0]
+    claim = engine.distances.claim
+    def timed_claim(route):
+        start = time.perf_counter()
+        claim(route)
+        incremental[0] += time.perf_counter() - start
+    engine.distances.claim = timed_claim
+    scratch = 0
+    moves = 0
+    while not engine.finished and moves < MAX_MOVES:
+        if not play_turn(engine):
+            engine.end_turn()
+        moves += 1
+        for player in engine.state.active_players():
+            for ticket_id in engine.state.ticket_pile(player["chat_id"]):
+                ticket = engine.state.tickets[ticket_id]
+                start = time.perf_counter()
+                remaining = engine.distances.remaining(player["chat_id"], ticket["city1"], ticket["city2"])
+                incremental[0] += time.perf_counter() - start
+                start = time.perf_counter()
+                expected = fresh(engine, player["chat_id"], ticket)
+                scratch += time.perf_counter() - start
+                assert remaining == expected
+                queries += 1
+    return queries, incremental[0], scratch
+
+if __name__ == "__main__":
+    games = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+    players = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+    config = load_config(PATH, "europe")
+    cities = {name: i for i, name in enumerate(config["maps"]["cities"], 1)}
+    start = time.perf_counter()
+    all_pairs(len(cities), [(cities[route["city1"]], cities[route["city2"]], route["distance"]) for route in config["maps"]["connections"]])
+    print("all pairs of the map with Floyd-Warshall: %.1f ms" % ((time.perf_counter() - start) * 1e3))
+    queries = incremental = scratch = 0
+    for seed in range(games):
+        result = play_game(config, players, seed)
+        queries += result[0]
+        incremental += result[1]
+        scratch += result[2]
+    print("%d games of %d players, %d ticket queries" % (games, players, queries))
+    print("incremental matrices  %9.1f us/query (matrix updates included)" % (incremental / queries * 1e6))
+    print("search per query      %9.1f us/query" % (scratch / queries * 1e6))
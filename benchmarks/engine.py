@@ -0,0 +1,80 @@
+"""
+Benchmark of the game rules without Telegram and without database.
+Whole games are played in memory by a simple policy: build the longest route
+that can be paid, otherwise take tickets now and then or draw train cards.
+
+usage: python benchmarks/engine.py [games] [players]
+"""
+import os
+import sys
+import time
+import cProfile
+import pstats
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from engine import Engine
+from mappack import load_config
+from gamestate import OWNER_MARKET
+
+PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MAX_MOVES = 5000
+
+def play_turn(engine):
+    """One action of the player whose turn it is, returns False when nothing could be done"""
+    state = engine.state
+    chat_id = state.playing
+    if chat_id in engine.pending:
+        return engine.keep_tickets(engine.pending[chat_id][0])
+    if engine.drawn == 0:
+        trains = state.player(chat_id)["trains"]
+        routes = [route for route in state.routes.values() if route["distance"] <= trains and engine.claimable(route["id"], chat_id)]
+        routes.sort(key=lambda route: route["distance"], reverse=True)
+        for route in routes:
+            if engine.payment(chat_id, route["distance"], route["color"], route["locomotives"]) is not None:
+                return engine.claim_route(route["id"])
+        if engine.rng.random() < 0.05 and state.ticket_pile(None):
+            return bool(engine.draw_tickets())
+    market = [color for color in state.pile_colors(OWNER_MARKET) if color != "locomotive" or engine.drawn == 0]
+    if market and engine.rng.random() < 0.5:
+        return engine.draw_market(engine.rng.choice(market)) is not None
+    return engine.draw_blind() is not None
+
+def play_game(config, players, seed):
+    """Play a game, returns the amount of moves"""
+    engine = Engine.simulation(config, seed)
+    for i, piece in enumerate(config["pieces"][:players]):
+        chat_id = 1001 + i
+        engine.join(chat_id, str(chat_id), piece["color"])
+        engine.keep_tickets(engine.pending[chat_id][0], chat_id)
+    engine.start()
+    moves = 0
+    while not engine.finished and moves < MAX_MOVES:
+        if not play_turn(engine):
+            engine.end_turn()
+        moves += 1
+    return moves, engine
+
+if __name__ == "__main__":
+    games = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    players = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+    config = load_config(PATH, "europe")
+
+    start = time.perf_counter()
+    moves = 0
+    unfinished = 0
+    for seed in range(games):
+        amount, engine = play_game(config, players, seed)
+        moves += amount
+        unfinished += int(not engine.finished)
+    elapsed = time.perf_counter() - start
+    print(str(games) + " games of " + str(players) + " players: " + str(moves) + " moves in %.2f s, %.0f moves/s, %.0f games/s" % (elapsed, moves / elapsed, games / elapsed))
+    if unfinished:
+        print(str(unfinished) + " games hit the limit of " + str(MAX_MOVES) + " moves")
+
+    profile = cProfile.Profile()
+    profile.enable()
+    for seed in range(min(games, 20)):
+        play_game(config, players, seed)
+    profile.disable()
+    pstats.Stats(profile).sort_stats("cumulative").print_stats(12)
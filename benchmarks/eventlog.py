@@ -0,0 +1,85 @@
+"""
+Benchmark of saving a game after every move: appending the move to the event log
+against writing the whole game again, like json_save did with data.json.
+Games are played in memory like benchmarks/engine.py does, then replayed from the log.
+
+usage: python benchmarks/eventlog.py [games] [players]
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from engine import Engine
+from mappack import load_config
+from eventlog import EventLog
+from gamestate import GameState
+from benchmarks.engine import play_turn, MAX_MOVES
+
+PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def play_game(config, players, seed, directory, sync):
+    """Play a game with a log, returns (moves, seconds logging, seconds rewriting the game)"""
+    engine = Engine.simulation(config, seed)
+    log = EventLog(directory, sync=sync)
+    engine.attach(log)
+    append = log.append
+    logging = [0]
+    def timed_append(move, args, kwargs):
+        start = time.perf_counter()
+        seq = append(move, args, kwargs)
+        logging[0] += time.perf_counter() - start
+        return seq
+    log.append = timed_append
+    for i, piece in enumerate(config["pieces"][:players]):
+        chat_id = 1001 + i
+        engine.join(chat_id, str(chat_id), piece["color"])
+        engine.keep_tickets(engine.pending[chat_id][0], chat_id)
+    engine.start()
+    rewrite = 0
+    moves = 0
+    while not engine.finished and moves < MAX_MOVES:
+        if not play_turn(engine):
+            engine.end_turn()
+        moves += 1
+        start = time.perf_counter()
+        with open(os.path.join(directory, "data.json"), "w") as f:
+            json.dump(engine.snapshot(), f)
+            f.flush()
+            if sync:
+                os.fsync(f.fileno())
+        rewrite += time.perf_counter() - start
+    log.close()
+    return log.seq, logging[0], rewrite
+
+def replay(config, directory):
+    """Seconds to rebuild the game from the log"""
+    engine = Engine(GameState(colors=[card["color"] for card in config["train_cards"]]), config["game"], config["pieces"])
+    start = time.perf_counter()
+    engine.replay(EventLog(directory))
+    return time.perf_counter() - start
+
+if __name__ == "__main__":
+    games = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    players = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+    config = load_config(PATH, "europe")
+    for sync in [False, True]:
+        moves = logging = rewrite = replayed = 0
+        for seed in range(games):
+            directory = tempfile.mkdtemp()
+            try:
+                result = play_game(config, players, seed, directory, sync)
+                replayed += replay(config, directory)
+            finally:
+                shutil.rmtree(directory)
+            moves += result[0]
+            logging += result[1]
+            rewrite += result[2]
+        print("%d games of %d players, %d moves, fsync: %s" % (games, players, moves, sync))
+        print("append move to the log %9.1f us/move" % (logging / moves * 1e6))
+        print("rewrite the whole game %9.1f us/move" % (rewrite / moves * 1e6))
+        print("replay a game          %9.1f ms" % (replayed / games * 1e3))
@@ -0,0 +1,53 @@
+"""
+Benchmark of hosting many games in one process: games are opened round robin with
+a bounded amount of open games, every visit plays a move. Reports the time to open
+a game, to route to an open one and the peak RSS.
+
+usage: python benchmarks/games.py [games] [capacity] [rounds]
+"""
+import os
+import sys
+import time
+import shutil
+import resource
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import mappack
+from games import Games
+
+PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+if __name__ == "__main__":
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    capacity = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+    rounds = int(sys.argv[3]) if len(sys.argv) > 3 else 3
+    pack = mappack.load(PATH, "europe")
+    directory = tempfile.mkdtemp()
+    try:
+        games = Games(directory, pack, capacity=capacity)
+        opening = routing = 0
+        opened = routed = 0
+        for i in range(rounds):
+            for number in range(count):
+                game_id = "game" + str(number)
+                was_open = game_id in games.open_games
+                start = time.perf_counter()
+                game = games.get(game_id)
+                elapsed = time.perf_counter() - start
+                if was_open:
+                    routing += elapsed
+                    routed += 1
+                else:
+                    opening += elapsed
+                    opened += 1
+                game.engine.watch(1000 + i, "p" + str(i))
+        games.close()
+        print("%d games, %d open at most, %d visits" % (count, capacity, count * rounds))
+        print("open a game     %9.1f ms (%d times)" % (opening / opened * 1e3, opened))
+        if routed:
+            print("route to a game %9.1f us (%d times)" % (routing / routed * 1e6, routed))
+        print("peak RSS        %9.1f MB" % (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024))
+    finally:
+        shutil.rmtree(directory)
@@ -0,0 +1,120 @@
+"""
+Benchmark of the statements of a move with and without secondary indexes on
+the game tables. A 5 player game is seeded from the europe config files,
+afterwards the writes the write-behind sends for a move are run. The reads of
+a move are answered by the game state in memory and never reach the database.
+Indexes are created for the benchmark as the tables declared them before.
+
+usage: python benchmarks/indexes.py [rounds] [repeat]
+"""
+import os
+import sys
+import json
+import time
+import random
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from DatabaseSqlite3 import DatabaseSqlite3
+
+PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# The secondary indexes the game tables declared before the game state kept the reads in memory
+INDEXES = {
+    "Player": [["idx_player_color", ["color"]]],
+    "City": [["idx_city_name", ["name COLLATE NOCASE"]], ["idx_city_station", ["station"]]],
+    "Route": [["idx_route_city1", ["city1", "owner"]], ["idx_route_city2", ["city2", "owner"]], ["idx_route_owner", ["owner"]]],
+    "Ticket": [["idx_ticket_owner", ["owner", "special", "city1", "city2", "value"]]],
+    "Card": [["idx_card_owner", ["owner", "color"]]],
+    "Turn": [["idx_turn_playing", ["playing", "chat_id", "sequence", "turns"]]],
+}
+PLAYERS = [(1001, "blue"), (1002, "red"), (1003, "green"), (1004, "yellow"), (1005, "black")]
+
+def load(directory, name):
+    with open(os.path.join(PATH, directory, name)) as f:
+        return json.load(f)
+
+def seed(db):
+    """Seed a 5 player game like VTR_BOT does"""
+    random.seed(5)
+    map_data = load("maps", "europe-map.json")
+    db.insert("City", ["name", "station"], [(city, None) for city in map_data["cities"]])
+    city_ids = {name: i + 1 for i, name in enumerate(map_data["cities"])}
+    routes = []
+    for route in map_data["connections"]:
+        routes.append((city_ids[route["city1"]], city_ids[route["city2"]], route["color"], route["distance"], route["locomotives"], int(route["tunnel"]), 0))
+    db.insert("Route", ["city1", "city2", "color", "distance", "locomotives", "tunnel", "owner"], routes)
+    tickets = []
+    ticket_data = load("ticket_cards", "europe-tickets.json")
+    for special, kind in enumerate(["normal", "special"]):
+        for ticket in ticket_data[kind]:
+            tickets.append((city_ids[ticket["city1"]], city_ids[ticket["city2"]], ticket["value"], special, None, len(tickets)))
+    db.insert("Ticket", ["city1", "city2", "value", "special", "owner", "position"], tickets)
+    deck = []
+    for card in load("train_cards", "europe-trains.json"):
+        deck += [card["color"]] * card["cards"]
+    random.shuffle(deck)
+    db.insert("Card", ["color", "owner", "position"], [(color, 0, position) for position, color in enumerate(deck)])
+    db.update("Card", {"owner": 1}, "id <= ?", (5,))
+    for seq, (chat_id, color) in enumerate(PLAYERS):
+        db.insert("Player", db.player_columns[0], [(chat_id, str(chat_id), 45, 3, 0, color)])
+        db.insert("Turn", db.turn_columns[0], [(chat_id, int(seq == 0), seq + 1, None)])
+        cards = db.select("Card", ["id"], "owner = ?", (0,), "id", 4)
+        for card in cards:
+            db.update("Card", {"owner": chat_id}, "id = ?", (card[0],))
+        for ticket in db.select("Ticket", ["id"], "owner IS NULL", (), "id", 3):
+            db.update("Ticket", {"owner": chat_id}, "id = ?", (ticket[0],))
+
+def move(db, chat_id, moves):
+    """
+    The statements one move sends to the database. The game state answers the reads
+    from memory, the write-behind writes the changed rows by their primary key
+    """
+    for card_id in [moves % 110 + 1, (moves + 55) % 110 + 1]:
+        db.update("Card", {"owner": chat_id, "position": moves}, "id = ?", (card_id,))
+    db.update("Route", {"owner": chat_id}, "id = ?", (moves % 100 + 1,))
+    db.update("Ticket", {"owner": chat_id, "position": moves}, "id = ?", (moves % 40 + 1,))
+    db.update("City", {"station": chat_id}, "id = ?", (moves % 47 + 1,))
+    db.update("Player", {"trains": 45 - moves % 45, "points": moves}, "chat_id = ?", (chat_id,))
+    db.update("Turn", {"playing": 0}, "chat_id = ?", (chat_id,))
+    db.update("Turn", {"playing": 1}, "chat_id = ?", (PLAYERS[(moves + 1) % len(PLAYERS)][0],))
+
+def run(indexed, rounds):
+    directory = tempfile.mkdtemp()
+    db = DatabaseSqlite3(os.path.join(directory, "bench.db"), True)
+    seed(db)
+    if indexed:
+        for table_name, indexes in INDEXES.items():
+            db.create_indexes(table_name, indexes)
+    db.conn.execute("ANALYZE")
+
+    queries = [0]
+    steps = [0]
+    db.conn.set_trace_callback(lambda statement: queries.__setitem__(0, queries[0] + 1))
+    db.conn.set_progress_handler(lambda: steps.__setitem__(0, steps[0] + 1), 100)
+
+    moves = 0
+    start = time.perf_counter()
+    with db.transaction():
+        for i in range(rounds):
+            for chat_id, color in PLAYERS:
+                move(db, chat_id, moves)
+                moves += 1
+    elapsed = time.perf_counter() - start
+    db.conn.set_trace_callback(None)
+    db.conn.set_progress_handler(None, 0)
+    db.close()
+    return moves, queries[0], steps[0] * 100, elapsed
+
+if __name__ == "__main__":
+    rounds = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    repeat = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+    # Runs alternate so neither side gets the warm cache, the median is reported
+    results = {False: [], True: []}
+    for i in range(repeat):
+        for indexed in [False, True] if i % 2 == 0 else [True, False]:
+            results[indexed].append(run(indexed, rounds))
+    print("%-10s %8s %10s %14s %12s" % ("indexes", "moves", "queries", "vm steps/move", "us/move"))
+    for indexed in [False, True]:
+        moves, queries, steps, elapsed = sorted(results[indexed], key=lambda result: result[3])[repeat // 2]
+        print("%-10s %8d %10d %14d %12.1f" % ("yes" if indexed else "no", moves, queries, steps / moves, elapsed / moves * 1e6))
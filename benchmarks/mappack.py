@@ -0,0 +1,35 @@
+"""
+Benchmark of loading the config of a map: parsing the JSON config files against
+reading the compiled map pack, from disk and from the packs of the process.
+
+usage: python benchmarks/mappack.py [map_name] [repeat]
+"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import mappack
+
+PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def timed(name, function, repeat):
+    start = time.perf_counter()
+    for i in range(repeat):
+        function()
+    elapsed = (time.perf_counter() - start) / repeat
+    print(name.ljust(30) + "%9.1f us" % (elapsed * 1e6))
+
+def from_disk(map_name):
+    mappack.packs.clear()
+    return mappack.load(PATH, map_name)
+
+if __name__ == "__main__":
+    map_name = sys.argv[1] if len(sys.argv) > 1 else "europe"
+    repeat = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+    timed("json config files", lambda: mappack.load_config(PATH, map_name), repeat)
+    timed("compile pack", lambda: mappack.build(PATH, map_name), repeat)
+    mappack.write(mappack.pack_file(PATH, map_name), mappack.build(PATH, map_name))
+    timed("pack from disk", lambda: from_disk(map_name), repeat)
+    timed("pack of the process", lambda: mappack.load(PATH, map_name), repeat)
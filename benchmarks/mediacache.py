@@ -0,0 +1,65 @@
+"""
+Benchmark of sending the board to the players: every press of Map uploads the PNG
+without the media cache, with it the board is uploaded once per change and the
+other presses send its file id. Telegram is replaced by a message that counts
+the bytes uploaded.
+
+usage: python benchmarks/mediacache.py [presses] [changes]
+"""
+import io
+import os
+import sys
+import time
+import shutil
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from mediacache import MediaCache, content_key
+
+PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+class PhotoSize():
+    def __init__(self, file_id):
+        self.file_id = file_id
+
+class Sent():
+    def __init__(self, file_id):
+        self.photo = [PhotoSize(file_id)]
+
+class Message():
+    """Counts the bytes of the photos that are uploaded"""
+    def __init__(self):
+        self.uploaded = 0
+
+    def reply_photo(self, photo, **kwargs):
+        if isinstance(photo, str):
+            return Sent(photo)
+        self.uploaded += len(photo.read())
+        return Sent("file" + str(self.uploaded))
+
+if __name__ == "__main__":
+    presses = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    changes = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+    with open(os.path.join(PATH, "board", "europe.png"), "rb") as f:
+        png = f.read()
+    directory = tempfile.mkdtemp()
+    try:
+        cache = MediaCache(os.path.join(directory, "lobby.db"))
+        plain = Message()
+        cached = Message()
+        elapsed = 0
+        for press in range(presses):
+            # The board changes every presses / changes presses
+            board = png + str(press * changes // presses).encode()
+            key = content_key(board)
+            plain.reply_photo(io.BytesIO(board))
+            start = time.perf_counter()
+            cache.reply_photo(cached, key, lambda: io.BytesIO(board))
+            elapsed += time.perf_counter() - start
+        print("%d presses, %d board changes" % (presses, changes))
+        print("uploaded without cache %9.1f MB" % (plain.uploaded / 1e6))
+        print("uploaded with cache    %9.1f MB" % (cached.uploaded / 1e6))
+        print("cache per press        %9.1f us" % (elapsed / presses * 1e6))
+    finally:
+        shutil.rmtree(directory)
@@ -0,0 +1,56 @@
+"""
+Benchmark of persisting one conversation transition with stores of growing size:
+pickling every conversation and user_data into one file like PicklePersistence does,
+against marking the row of the chat dirty and flushing it with SqlitePersistence.
+
+usage: python benchmarks/persistence.py [repeat]
+"""
+import os
+import sys
+import time
+import pickle
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from persistence import SqlitePersistence
+from DatabaseSqlite3 import ConnectionPool
+
+SIZES = [10, 100, 1000, 10000]
+
+def user_data(chat_id):
+    return {"initialized": True, "tickets_selection": [chat_id % 46, chat_id % 41], "route": False, "route_city": "Paris"}
+
+def pickle_file(directory, chats, repeat):
+    """Seconds per transition rewriting the whole store"""
+    data = {"conversations": {"ticket_to_ride": {(chat_id, chat_id): 1 for chat_id in range(chats)}},
+        "user_data": {chat_id: user_data(chat_id) for chat_id in range(chats)}, "chat_data": {}, "bot_data": {}}
+    file_name = os.path.join(directory, "pickle")
+    start = time.perf_counter()
+    for i in range(repeat):
+        data["conversations"]["ticket_to_ride"][(i % chats, i % chats)] = i % 8
+        with open(file_name, "wb") as f:
+            pickle.dump(data, f)
+    return (time.perf_counter() - start) / repeat
+
+def sqlite_rows(directory, chats, repeat):
+    """Seconds per transition marking and flushing the rows of one chat"""
+    url = os.path.join(directory, "store.db")
+    store = SqlitePersistence(url, ConnectionPool(url), interval=0)
+    for chat_id in range(chats):
+        store.update_conversation("ticket_to_ride", (chat_id, chat_id), 1)
+        store.update_user_data(chat_id, user_data(chat_id))
+    start = time.perf_counter()
+    for i in range(repeat):
+        store.update_conversation("ticket_to_ride", (i % chats, i % chats), i % 8)
+        # The dispatcher hands back user_data after every update, unchanged here
+        store.update_user_data(i % chats, user_data(i % chats))
+    elapsed = (time.perf_counter() - start) / repeat
+    store.close()
+    return elapsed
+
+if __name__ == "__main__":
+    repeat = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    for chats in SIZES:
+        with tempfile.TemporaryDirectory() as directory:
+            print("%6d chats  pickle file %9.1f us/transition  sqlite rows %9.1f us/transition" % (chats, pickle_file(directory, chats, repeat) * 1e6, sqlite_rows(directory, chats, repeat) * 1e6))
@@ -0,0 +1,59 @@
+"""
+Benchmark of drawing the board: drawing every claimed route on a copy of the board
+image like a full render, against the renderer that draws only the new claim and
+sends the kept JPEG while the board didn't change. Encoding the whole picture is
+part of every render, its time is reported on its own.
+
+usage: python benchmarks/renderer.py [claims]
+"""
+import io
+import os
+import sys
+import time
+import shutil
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import mappack
+from games import Games
+from renderer import BoardRenderer, JPEG_QUALITY
+
+PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+if __name__ == "__main__":
+    claims = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    pack = mappack.load(PATH, "europe")
+    directory = tempfile.mkdtemp()
+    try:
+        games = Games(directory, pack, board_directory=os.path.join(PATH, "board"))
+        game = games.get("benchmark")
+        state = game.state
+        state.players[1] = {"chat_id": 1, "color": "red"}
+        game.board.render()
+        full = incremental = cached = encoding = 0
+        for route_id in list(state.routes)[:claims]:
+            with state.unit():
+                state.set_route_owner(route_id, 1)
+            start = time.perf_counter()
+            game.board.render()
+            incremental += time.perf_counter() - start
+            start = time.perf_counter()
+            game.board.render()
+            cached += time.perf_counter() - start
+            # A new renderer draws the whole board
+            start = time.perf_counter()
+            BoardRenderer(state, pack["board"], os.path.join(PATH, "board")).render()
+            full += time.perf_counter() - start
+            start = time.perf_counter()
+            game.board.composed.save(io.BytesIO(), "JPEG", quality=JPEG_QUALITY)
+            encoding += time.perf_counter() - start
+        games.close()
+        print("%d claims" % claims)
+        print("full render        %9.1f ms" % (full / claims * 1e3))
+        print("incremental render %9.1f ms" % (incremental / claims * 1e3))
+        print("of which encoding  %9.1f ms" % (encoding / claims * 1e3))
+        print("unchanged board    %9.1f us" % (cached / claims * 1e6))
+        print("JPEG size          %9.1f kB" % (len(game.board.photo) / 1e3))
+    finally:
+        shutil.rmtree(directory)
@@ -0,0 +1,56 @@
+"""
+Benchmark of writing a reshuffle to the database: the discard pile goes back
+under the deck with one UPDATE per card, against the one statement executed for
+all cards that the game state queues, both in one transaction.
+
+usage: python benchmarks/reshuffle.py [repeat]
+"""
+import os
+import sys
+import time
+import random
+import shutil
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from DatabaseSqlite3 import DatabaseSqlite3, ConnectionPool, build_update
+from gamestate import OWNER_DECK, OWNER_DISCARD
+
+SIZES = [110, 1000, 10000]
+
+def one_by_one(db, rows):
+    query = build_update("Card", ("owner", "position"), "id = ?")
+    for params in rows:
+        db.cursor.execute(query, params)
+
+def bulk(db, rows):
+    db.cursor.executemany(build_update("Card", ("owner", "position"), "id = ?"), rows)
+
+if __name__ == "__main__":
+    repeat = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    directory = tempfile.mkdtemp()
+    try:
+        for size in SIZES:
+            url = os.path.join(directory, str(size) + ".db")
+            pool = ConnectionPool(url)
+            with DatabaseSqlite3(url, True, pool) as db:
+                with db.transaction():
+                    db.insert("Card", db.card_columns[0], [(card_id, "red", OWNER_DISCARD, card_id) for card_id in range(1, size + 1)])
+                rng = random.Random(size)
+                results = []
+                for function in [one_by_one, bulk]:
+                    elapsed = 0
+                    for i in range(repeat):
+                        order = list(range(1, size + 1))
+                        rng.shuffle(order)
+                        rows = [(OWNER_DECK, position, card_id) for position, card_id in enumerate(order)]
+                        start = time.perf_counter()
+                        with db.transaction():
+                            function(db, rows)
+                        elapsed += time.perf_counter() - start
+                    results.append(elapsed / repeat * 1e3)
+            pool.close_all()
+            print("%6d cards  one by one %8.2f ms  one statement %8.2f ms" % (size, results[0], results[1]))
+    finally:
+        shutil.rmtree(directory)
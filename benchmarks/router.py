@@ -0,0 +1,41 @@
+"""
+Benchmark of routing a menu message: testing the message against one regex per
+action in order, like the MessageHandlers of the OPTIONS state did, against the
+one dict lookup of the Router, for menus of growing size.
+
+usage: python benchmarks/router.py [repeat]
+"""
+import os
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from router import Router
+
+SIZES = [15, 50, 200]
+
+def timed(function, texts, repeat):
+    start = time.perf_counter()
+    for i in range(repeat):
+        for text in texts:
+            function(text)
+    return (time.perf_counter() - start) / (repeat * len(texts))
+
+if __name__ == "__main__":
+    repeat = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    for size in SIZES:
+        actions = ["Action " + str(i) for i in range(size)]
+        patterns = [(re.compile("^(" + action + ")$"), action) for action in actions]
+        def sequential(text):
+            for pattern, action in patterns:
+                if pattern.match(text):
+                    return action
+            return None
+        router = Router()
+        for action in actions:
+            router.add(action, action)
+        # The first, middle and last action and a message that is none
+        texts = [actions[0], actions[size // 2], actions[-1], "Hello"]
+        print("%4d actions  regex per action %7.2f us  router %7.2f us" % (size, timed(sequential, texts, repeat) * 1e6, timed(router.route, texts, repeat) * 1e6))
@@ -0,0 +1,40 @@
+"""
+Benchmark of the startup time and resident memory of the modules of the bot.
+Every case is imported in a fresh interpreter, which reports its own time and
+peak RSS, so the numbers include the interpreter itself.
+
+usage: python benchmarks/startup.py [repeat]
+"""
+import os
+import sys
+import json
+import subprocess
+
+PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+CASES = [
+    ("python", ""),
+    ("DatabaseSqlite3", "import DatabaseSqlite3"),
+    ("DatabaseSqlite3 + pandas", "import DatabaseSqlite3; DatabaseSqlite3.pandas()"),
+    ("game modules", "import DatabaseSqlite3, gamestate, engine, mappack, broadcaster"),
+]
+
+PROBE = """
+import time, resource, json, sys
+start = time.perf_counter()
+%s
+elapsed = time.perf_counter() - start
+print(json.dumps({"seconds": elapsed, "rss": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, "pandas": "pandas" in sys.modules}))
+"""
+
+def probe(code):
+    output = subprocess.run([sys.executable, "-c", PROBE % code], cwd=PATH, capture_output=True, text=True, check=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+if __name__ == "__main__":
+    repeat = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    for name, code in CASES:
+        results = [probe(code) for i in range(repeat)]
+        seconds = min(result["seconds"] for result in results)
+        rss = min(result["rss"] for result in results)
+        print(name.ljust(30) + "%9.1f ms import %9.1f MB peak RSS   pandas loaded: %s" % (seconds * 1e3, rss / 1024, results[0]["pandas"]))
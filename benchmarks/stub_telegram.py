@@ -0,0 +1,86 @@
+"""
+Local stand in for the sendMessage method of the Telegram bot api.
+Every request is answered after a fixed latency, a fraction of the requests
+can be answered with a 429 or a 500 to exercise the retries of the broadcaster.
+Received messages are recorded per chat in the order they arrived.
+
+usage: python benchmarks/stub_telegram.py [port]
+"""
+import sys
+import json
+import time
+import random
+import threading
+import urllib.parse
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+class StubTelegram(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, port=0, latency=0.05, flood=0.0, errors=0.0, retry_after=1):
+        super().__init__(("127.0.0.1", port), StubHandler)
+        self.latency = latency
+        self.flood = flood
+        self.errors = errors
+        self.retry_after = retry_after
+        self.lock = threading.Lock()
+        self.messages = {}
+        self.requests = 0
+        self.connections = 0
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:" + str(self.server_address[1])
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever, daemon=True)
+        thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def setup(self):
+        super().setup()
+        with self.server.lock:
+            self.server.connections += 1
+
+    def do_GET(self):
+        self.answer(urllib.parse.urlsplit(self.path).query)
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        self.answer(self.rfile.read(length).decode())
+
+    def answer(self, query):
+        params = dict(urllib.parse.parse_qsl(query))
+        time.sleep(self.server.latency)
+        draw = random.random()
+        with self.server.lock:
+            self.server.requests += 1
+            if draw < self.server.flood:
+                status, body = 429, {"ok": False, "error_code": 429, "parameters": {"retry_after": self.server.retry_after}}
+            elif draw < self.server.flood + self.server.errors:
+                status, body = 500, {"ok": False, "error_code": 500}
+            else:
+                self.server.messages.setdefault(params.get("chat_id"), []).append(params.get("text"))
+                status, body = 200, {"ok": True, "result": {"chat": {"id": params.get("chat_id")}, "text": params.get("text")}}
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+if __name__ == "__main__":
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 8081
+    server = StubTelegram(port)
+    print("Stub Telegram api on " + server.url)
+    server.serve_forever()
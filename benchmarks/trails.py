@@ -0,0 +1,82 @@
+"""
+Benchmark of the longest route on a randomly fully claimed board.
+Every route of the map is claimed in a random order by a random player, after
+every claim the longest routes are updated incrementally and, for comparison,
+computed again from scratch. Bigger maps are made of copies of the europe map
+that are linked to each other.
+
+usage: python benchmarks/trails.py [seed]
+"""
+import os
+import sys
+import json
+import time
+import random
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from trails import LongestRoutes
+
+PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def europe():
+    with open(os.path.join(PATH, "maps", "europe-map.json")) as f:
+        map_data = json.load(f)
+    city_ids = {name: i for i, name in enumerate(map_data["cities"])}
+    edges = [(city_ids[route["city1"]], city_ids[route["city2"]], route["distance"]) for route in map_data["connections"]]
+    return len(city_ids), edges
+
+def scaled(copies, rng):
+    """copies of the europe map, every copy linked to the next one at a tenth of the cities"""
+    cities, edges = europe()
+    scaled_edges = []
+    for copy in range(copies):
+        scaled_edges += [(city1 + copy * cities, city2 + copy * cities, distance) for city1, city2, distance in edges]
+        if copy > 0:
+            for city in rng.sample(range(cities), cities // 10):
+                scaled_edges.append((city + (copy - 1) * cities, city + copy * cities, rng.randint(1, 4)))
+    return scaled_edges
+
+def claim_all(edges, players, rng, full=True):
+    """Claim every edge, returns (seconds incremental, slowest claim, seconds from scratch)"""
+    routes = {}
+    order = list(range(len(edges)))
+    rng.shuffle(order)
+    longest = LongestRoutes()
+    incremental = 0
+    slowest = 0
+    scratch = 0
+    for index in order:
+        city1, city2, distance = edges[index]
+        route = {"id": index + 1, "city1": city1, "city2": city2, "distance": distance, "owner": rng.randint(1, players)}
+        routes[route["id"]] = route
+        start = time.perf_counter()
+        longest.claim(route)
+        elapsed = time.perf_counter() - start
+        incremental += elapsed
+        slowest = max(slowest, elapsed)
+        if full:
+            start = time.perf_counter()
+            fresh = LongestRoutes()
+            fresh.rebuild(routes)
+            scratch += time.perf_counter() - start
+            assert fresh.length(route["owner"]) == longest.length(route["owner"])
+    return incremental, slowest, scratch
+
+def report(name, edges, players, rng, full=True):
+    incremental, slowest, scratch = claim_all(edges, players, rng, full)
+    line = name.ljust(30) + ("%5d routes %2d players" % (len(edges), players))
+    line += "%9.1f us/claim %9.1f us slowest" % (incremental / len(edges) * 1e6, slowest * 1e6)
+    if full:
+        line += "%11.1f us/claim from scratch" % (scratch / len(edges) * 1e6)
+    print(line)
+
+if __name__ == "__main__":
+    seed = int(sys.argv[1]) if len(sys.argv) > 1 else 0
+    rng = random.Random(seed)
+    cities, edges = europe()
+    report("europe", edges, 5, rng)
+    report("europe", edges, 3, rng)
+    report("europe", edges, 2, rng, False)
+    for copies in (2, 4, 8):
+        report("europe x" + str(copies), scaled(copies, rng), 5, rng, copies < 8)
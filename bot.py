@@ -1,15 +1,22 @@
 import os
 import json
 import logging
-import requests
 from telegram import (ReplyKeyboardMarkup, ReplyKeyboardRemove)
-from telegram.ext import (Updater, CommandHandler, MessageHandler, Filters, ConversationHandler, PicklePersistence)
+from telegram.ext import (Updater, CommandHandler, MessageHandler, Filters, ConversationHandler)
+
+from broadcaster import Broadcaster
+from trails import LongestRoutes
+from persistence import SqlitePersistence, FLUSH_INTERVAL
+from router import Router
+from eventlog import DocumentLog
 
 # Enable logging
 logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
 
 logger = logging.getLogger(__name__)
 
+broadcaster = None
+
 SELECTION, OPTIONS, CITY, FULLCITY, ROUTE, RETURN, MARKET, TICKET, STATION = range(9)
 
 option_keyboard = [["Get Market Card", "Build Route"],
@@ -166,7 +173,24 @@ def aroutes(update, context):
 
 def lroute(update, context):
     """Get the longest Route"""
-    update.message.reply_text("To Be Implemented!!!")
+    data = json_load()
+    longest = LongestRoutes()
+    for i, route in enumerate(data["routes"]):
+        if route["player"]:
+            longest.claim({"id": i, "city1": route["city1"], "city2": route["city2"], "distance": route["distance"], "owner": route["player"]})
+
+    response = ""
+    for player in data["players"]:
+        response += player["color"] + " - " + player["name"] + ": " + str(longest.length(player["color"]))
+        cities = longest.cities(player["color"])
+        if len(cities) > 0:
+            response += " (" + " - ".join(cities) + ")"
+        response += "\n"
+    leaders = longest.leaders()
+    if len(leaders) > 0:
+        response += "\nLongest route: " + ", ".join(leaders)
+
+    update.message.reply_text(response)
 
 def overview(update, context):
     """Get the game overview"""
@@ -506,19 +530,18 @@ def make_nested_lists(data_list, items_each_line = 3):
     return outer_list
 
 def broadcast(data, message):
-    config = {}
-    try:
-        config = json.load(open("config.json"))
-    except:
-        logger.critical("File Not found: config.json")
-        exit()
-    
-    for player in data["players"]:
-        send_text = 'https://api.telegram.org/bot' + config["telegram"]["token"] + '/sendMessage?chat_id=' + str(player["chat_id"]) + '&parse_mode=Markdown&text=' + message
-
-        response = requests.get(send_text)
-
-    return response.json()
+    """Queue a message for all the players, it is delivered in the background"""
+    global broadcaster
+    if broadcaster is None:
+        config = {}
+        try:
+            config = json.load(open("config.json"))
+        except:
+            logger.critical("File Not found: config.json")
+            exit()
+        broadcaster = Broadcaster(config["telegram"]["token"])
+
+    broadcaster.broadcast([player["chat_id"] for player in data["players"]], message)
 
 def your_turn(data, update):
     """Check if it's your turn"""
@@ -547,12 +570,21 @@ def next_turn(data):
     json_save(data)
     logger.info("Next turn for: " + player["name"] + " - " + player["color"])
 
+# data.json is kept in an event log, a save appends what changed instead of writing the whole file
+documents = None
+
+def document_log():
+    """The log data.json is kept in, opened on first use"""
+    global documents
+    if documents is None:
+        path = os.path.dirname(os.path.abspath(__file__))
+        documents = DocumentLog(os.path.join(path, 'data.eventlog'), os.path.join(path, 'data.json'))
+    return documents
+
 def json_load():
     data = {}
     try:
-        path = os.path.join(os.path.dirname(os.path.abspath(__file__)),'data.json')
-        with open(path, 'r') as f:
-            data = json.load(f)
+        data = document_log().load()
     except Exception as e:
         logger.error(e)
     
@@ -560,9 +592,7 @@ def json_load():
 
 def json_save(data):
     try:
-        path = os.path.join(os.path.dirname(os.path.abspath(__file__)),'data.json')
-        with open(path, 'w') as json_file:
-            json_file.write(json.dumps(data, ensure_ascii=False))
+        document_log().save(data)
     except Exception as e:
         logger.error(e)
 
@@ -581,30 +611,41 @@ def main():
         exit()
 
     # Initialize Telegram bot
-    pp = PicklePersistence(filename="bobbieventianbot")
+    # Conversations and user_data are rows of a sqlite file, the old pickle file is taken over once
+    pp = SqlitePersistence("bobbieventianbot.sqlite", interval=config.get("persistence", {}).get("interval", FLUSH_INTERVAL), migrate="bobbieventianbot")
     updater = Updater(config["telegram"]["token"], persistence= pp, use_context=True)
     dp = updater.dispatcher
 
+    # Menus are routed with one lookup, the colors are the ones of the pieces of the game
     data = json_load()
-    availabe_colors = list_available_colors(data)
-    aplayers = ""
-    for color in availabe_colors:
-        aplayers += color + "|"
-
-    aplayers = aplayers[:-1]
+    colors_router = Router()
+    for player in data["players"]:
+        colors_router.add(player["color"], add)
+    options_router = Router()
+    for text, handler, aliases, command in [
+        ("Get Market Card", choose_market, ["Market Card", "Draw"], "draw"),
+        ("Build Route", choose_city, ["Route"], "route"),
+        ("Build Station", build_station, ["Station"], "station"),
+        ("Get New Tickets", get_new_tickets, ["Tickets"], "tickets"),
+        ("Deck", deck, ["Cards", "Hand"], "deck"),
+        ("Market", market, [], "market"),
+        ("Overview", overview, [], "overview"),
+        ("Map", send_map, ["Board"], "map"),
+        ("Routes", routes, ["All Routes"], "routes"),
+        ("City", choose_city, ["Cities"], "city"),
+        ("Your Routes", yroutes, ["My Routes"], "yroutes"),
+        ("Player", choose_player, [], "player"),
+        ("Longest Route", lroute, ["Longest"], "lroute"),
+        ("Points", points, ["Score", "Scores"], "points"),
+        ("Help", help, [], "help")]:
+        options_router.add(text, handler, aliases, command)
 
     option_handler = ConversationHandler(
         entry_points=[CommandHandler("start", start)],
 
         states = {
-            SELECTION: [MessageHandler(Filters.regex("^(" + aplayers + ")$"), add),],
-            OPTIONS: [MessageHandler(Filters.regex("^(Get Market Card)$"), choose_market), MessageHandler(Filters.regex("^(Build Route)$"), choose_city),
-            MessageHandler(Filters.regex("^(Build Station)$"), build_station), MessageHandler(Filters.regex("^(Get New Tickets)$"), get_new_tickets),
-            MessageHandler(Filters.regex("^(Deck)$"), deck), MessageHandler(Filters.regex("^(Market)$"), market),
-            MessageHandler(Filters.regex("^(Overview)$"), overview), MessageHandler(Filters.regex("^(Map)$"), send_map),
-            MessageHandler(Filters.regex("^(Routes)$"), routes), MessageHandler(Filters.regex("^(City)$"), choose_city),
-            MessageHandler(Filters.regex("^(Your Routes)$"), yroutes), MessageHandler(Filters.regex("^(Player)$"), choose_player),
-            MessageHandler(Filters.regex("^(Longest Route)$"), lroute), MessageHandler(Filters.regex("^(Points)$"), points), MessageHandler(Filters.regex("^(Help)$"), help)],
+            SELECTION: [colors_router.handler(),],
+            OPTIONS: [options_router.handler(),],
             FULLCITY: [MessageHandler(Filters.text, full_city),],
             CITY: [MessageHandler(Filters.text, city),],
             MARKET: [MessageHandler(Filters.text, pick_market),],
@@ -636,5 +677,10 @@ def main():
 
     updater.idle()
 
+    if broadcaster is not None:
+        broadcaster.close()
+    if documents is not None:
+        documents.close()
+
 if __name__ == '__main__':
     main()
\ No newline at end of file
@@ -0,0 +1,176 @@
+import time
+import logging
+import threading
+import collections
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger(__name__)
+
+API_URL = "https://api.telegram.org"
+
+class RateLimiter():
+    """
+    Token bucket, rate tokens per second with room for a burst of tokens.
+    acquire blocks until a token is available.
+    """
+    def __init__(self, rate, burst=1):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.tokens = float(burst)
+        self.stamp = time.monotonic()
+        self.lock = threading.Lock()
+
+    def delay(self):
+        """Take a token, returns the seconds to wait before it may be used"""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+            self.stamp = now
+            self.tokens -= 1
+            if self.tokens >= 0:
+                return 0
+            return -self.tokens / self.rate
+
+    def acquire(self):
+        wait = self.delay()
+        if wait > 0:
+            time.sleep(wait)
+
+    def pause(self, seconds):
+        """Block the bucket for some seconds, used when the server asks to retry later"""
+        with self.lock:
+            self.tokens = min(self.tokens, 0) - seconds * self.rate
+
+class Broadcaster():
+    """
+    Sends Telegram messages from a thread pool over one keep-alive HTTP session.
+    send and broadcast only queue the message and return right away.
+    Messages to the same chat are delivered in the order they were queued,
+    different chats are delivered concurrently. Telegram allows about 30 messages
+    per second in total and about 1 per second in a chat, both are enforced with
+    token buckets. Failed requests are retried with exponential backoff, on a 429
+    the retry_after of the response is respected.
+    """
+    def __init__(self, token, workers=8, rate=30, chat_rate=1, chat_burst=3, retries=3, backoff=0.5, timeout=10, api_url=API_URL):
+        self.url = api_url + "/bot" + token + "/sendMessage"
+        self.workers = workers
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.limiter = RateLimiter(rate, rate)
+        self.chat_limiters = {}
+        self.queues = {}
+        self.pending = 0
+        self.running = True
+        self.condition = threading.Condition()
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=workers)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="broadcast")
+
+    def send(self, chat_id, text, parse_mode="Markdown"):
+        """Queue a message for a chat"""
+        with self.condition:
+            if not self.running:
+                logger.error("Unable to send message to " + str(chat_id) + ", broadcaster is closed")
+                return
+            self.pending += 1
+            queue = self.queues.get(chat_id)
+            if queue is not None:
+                # A worker is draining this chat already, it picks the message up in order
+                queue.append((text, parse_mode))
+                return
+            self.queues[chat_id] = collections.deque([(text, parse_mode)])
+        self.executor.submit(self.drain, chat_id)
+
+    def broadcast(self, chat_ids, text, parse_mode="Markdown"):
+        """Queue a message for every chat_id"""
+        for chat_id in chat_ids:
+            self.send(chat_id, text, parse_mode)
+
+    def flush(self, timeout=None):
+        """Block until every queued message is delivered or given up, returns False on timeout"""
+        end = None if timeout is None else time.monotonic() + timeout
+        with self.condition:
+            while self.pending > 0:
+                remaining = None if end is None else end - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self.condition.wait(remaining)
+        return True
+
+    def close(self, timeout=30):
+        """Deliver what is queued and stop"""
+        if not self.running:
+            return
+        self.flush(timeout)
+        with self.condition:
+            self.running = False
+        self.executor.shutdown(wait=True)
+        self.session.close()
+        logger.info("Broadcaster closed")
+
+    def drain(self, chat_id):
+        """Deliver the queue of a chat one message at a time"""
+        while True:
+            with self.condition:
+                queue = self.queues[chat_id]
+                if not queue:
+                    del self.queues[chat_id]
+                    return
+                text, parse_mode = queue.popleft()
+            try:
+                self.deliver(chat_id, text, parse_mode)
+            except Exception as e:
+                logger.error("Unable to send message to " + str(chat_id))
+                logger.error(e)
+            with self.condition:
+                self.pending -= 1
+                self.condition.notify_all()
+
+    def chat_limiter(self, chat_id):
+        limiter = self.chat_limiters.get(chat_id)
+        if limiter is None:
+            limiter = self.chat_limiters.setdefault(chat_id, RateLimiter(self.chat_rate, self.chat_burst))
+        return limiter
+
+    def deliver(self, chat_id, text, parse_mode):
+        """Post one message, retrying on rate limits, server errors and connection errors"""
+        data = {"chat_id": chat_id, "text": text}
+        if parse_mode:
+            data["parse_mode"] = parse_mode
+
+        for attempt in range(self.retries + 1):
+            self.chat_limiter(chat_id).acquire()
+            self.limiter.acquire()
+            wait = self.backoff * 2 ** attempt
+            try:
+                response = self.session.post(self.url, data=data, timeout=self.timeout)
+            except requests.RequestException as e:
+                logger.warning("Sending message to " + str(chat_id) + " failed: " + str(e))
+            else:
+                if response.status_code == 200:
+                    return True
+                if response.status_code == 429:
+                    try:
+                        wait = max(wait, response.json()["parameters"]["retry_after"])
+                    except Exception:
+                        pass
+                    # Every worker waits for the bucket, no need to sleep on top of it
+                    self.limiter.pause(wait)
+                    wait = 0
+                elif response.status_code < 500:
+                    logger.error("Unable to send message to " + str(chat_id) + ": " + str(response.status_code) + " " + response.text)
+                    return False
+                logger.warning("Sending message to " + str(chat_id) + " got status " + str(response.status_code))
+            if attempt < self.retries and wait > 0:
+                time.sleep(wait)
+
+        logger.error("Unable to send message to " + str(chat_id) + " after " + str(self.retries + 1) + " attempts")
+        return False
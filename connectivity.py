@@ -0,0 +1,140 @@
+import logging
+import itertools
+
+logger = logging.getLogger(__name__)
+
+class DisjointSet():
+    """
+    Union-find with union by size. Outside an overlay find compresses paths.
+    Inside an overlay, started with checkpoint, unions are recorded and undone
+    by rollback; paths are not compressed then so the undo stays exact.
+    """
+    def __init__(self):
+        self.parent = {}
+        self.size = {}
+        self.history = None
+
+    def find(self, node):
+        parent = self.parent
+        if node not in parent:
+            return node
+        root = node
+        while parent[root] != root:
+            root = parent[root]
+        if self.history is None:
+            while parent[node] != root:
+                parent[node], node = root, parent[node]
+        return root
+
+    def union(self, node1, node2):
+        """Join the sets of two nodes, returns False when they were joined already"""
+        for node in (node1, node2):
+            if node not in self.parent:
+                self.parent[node] = node
+                self.size[node] = 1
+                if self.history is not None:
+                    self.history.append((node, None))
+        root1 = self.find(node1)
+        root2 = self.find(node2)
+        if root1 == root2:
+            return False
+        if self.size[root1] < self.size[root2]:
+            root1, root2 = root2, root1
+        self.parent[root2] = root1
+        self.size[root1] += self.size[root2]
+        if self.history is not None:
+            self.history.append((root2, root1))
+        return True
+
+    def connected(self, node1, node2):
+        return node1 == node2 or self.find(node1) == self.find(node2)
+
+    def checkpoint(self):
+        """Start or continue an overlay, returns the marker to roll back to"""
+        if self.history is None:
+            self.history = []
+        return len(self.history)
+
+    def rollback(self, marker=0):
+        """Undo the unions since marker, the overlay ends when it is rolled back completely"""
+        while len(self.history) > marker:
+            child, root = self.history.pop()
+            if root is None:
+                del self.parent[child]
+                del self.size[child]
+            else:
+                self.parent[child] = child
+                self.size[root] -= self.size[child]
+        if marker == 0:
+            self.history = None
+
+class TicketTracker():
+    """
+    Connected cities of every player over its claimed routes, so a ticket is checked
+    in near constant time. Stations borrow one route of another player in their city,
+    which routes are borrowed is decided at the end of the game: every choice is tried
+    as an overlay on the sets of the player and rolled back afterwards.
+    """
+    def __init__(self):
+        self.sets = {}
+        self.city_routes = {}
+
+    def rebuild(self, routes):
+        """Compute everything from scratch, routes are the route dicts of the game state"""
+        self.sets = {}
+        self.city_routes = {}
+        for route in routes.values():
+            self.city_routes.setdefault(route["city1"], []).append(route)
+            self.city_routes.setdefault(route["city2"], []).append(route)
+            if route["owner"]:
+                self.claim(route)
+
+    def claim(self, route):
+        """Add a claimed route to its owner"""
+        self.sets.setdefault(route["owner"], DisjointSet()).union(route["city1"], route["city2"])
+
+    def connected(self, owner, city1, city2):
+        sets = self.sets.get(owner)
+        return sets is not None and sets.connected(city1, city2)
+
+    def completed(self, owner, ticket):
+        """Is a ticket dict connected by the routes of owner"""
+        return self.connected(owner, ticket["city1"], ticket["city2"])
+
+    def borrowable(self, owner, stations):
+        """Per station city of owner the routes of other players it can borrow"""
+        options = []
+        for city_id in stations:
+            routes = [route for route in self.city_routes.get(city_id, []) if route["owner"] and route["owner"] != owner]
+            if routes:
+                options.append(routes)
+        return options
+
+    def ticket_score(self, owner, tickets):
+        """Value of the completed tickets minus the value of the others"""
+        score = 0
+        for ticket in tickets:
+            score += ticket["value"] if self.completed(owner, ticket) else -ticket["value"]
+        return score
+
+    def best_stations(self, owner, tickets, stations):
+        """
+        Routes to borrow with the stations of owner for the best ticket score.
+        Returns (ticket score, borrowed route ids, ticket ids that are completed).
+        """
+        sets = self.sets.setdefault(owner, DisjointSet())
+        best = (self.ticket_score(owner, tickets), [], [ticket["id"] for ticket in tickets if self.completed(owner, ticket)])
+        options = self.borrowable(owner, stations)
+        if not options or not tickets:
+            return best
+        for choice in itertools.product(*options):
+            marker = sets.checkpoint()
+            try:
+                for route in choice:
+                    sets.union(route["city1"], route["city2"])
+                score = self.ticket_score(owner, tickets)
+                if score > best[0]:
+                    best = (score, [route["id"] for route in choice], [ticket["id"] for ticket in tickets if self.completed(owner, ticket)])
+            finally:
+                sets.rollback(marker)
+        return best
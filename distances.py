@@ -0,0 +1,185 @@
+import heapq
+import logging
+from array import array
+
+logger = logging.getLogger(__name__)
+
+# Distance between cities that are not connected, the largest value of the array type
+INFINITY = 0xFFFF
+
+def all_pairs(size, edges):
+    """
+    Shortest distance in trains between every two cities with Floyd-Warshall.
+    size is the highest city id and edges a list of (city1, city2, distance).
+    Returns a flat array, the distance from city1 to city2 is at city1 * (size + 1) + city2.
+    """
+    width = size + 1
+    matrix = [[INFINITY] * width for i in range(width)]
+    for city in range(width):
+        matrix[city][city] = 0
+    for city1, city2, distance in edges:
+        if distance < matrix[city1][city2]:
+            matrix[city1][city2] = matrix[city2][city1] = distance
+    for k in range(1, width):
+        row_k = matrix[k]
+        for i in range(1, width):
+            row_i = matrix[i]
+            through = row_i[k]
+            if through == INFINITY:
+                continue
+            for j in range(1, width):
+                distance = through + row_k[j]
+                if distance < row_i[j]:
+                    row_i[j] = distance
+    flat = array("H")
+    for row in matrix:
+        flat.extend(min(distance, INFINITY) for distance in row)
+    return flat
+
+class RemainingDistances():
+    """
+    Trains a player still needs between two cities: its own routes cost nothing and the
+    routes it can't claim anymore are left out. Every player that is asked for gets a
+    distance matrix, a copy of the distances of the empty map while nothing is claimed.
+    A claim only changes the cost of one city pair, the matrices are updated for it:
+    a cheaper pair relaxes every pair of cities through it, a more expensive one drops
+    the rows of the cities whose shortest distances used it, these are searched again
+    when they are asked for.
+    claimable(route_id, owner) tells if owner can still claim a route, base are the
+    distances of the empty map like all_pairs makes them, computed when not given.
+    """
+    def __init__(self, claimable, base=None):
+        self.claimable = claimable
+        self.base = base
+        self.clear()
+
+    def clear(self):
+        """Forget the matrices of the players, they are made again when asked for"""
+        self.matrices = {}
+        self.costs = {}
+
+    def rebuild(self, routes, adjacency=None):
+        """
+        Compute everything from scratch, routes are the route dicts of the game state and
+        adjacency the (route id, other city id) per city id of the map pack when it matches them.
+        """
+        self.clear()
+        self.pairs = {}
+        self.neighbors = {}
+        self.size = 0
+        self.claimed = False
+        if adjacency is not None:
+            self.neighbors = {city: {other for route_id, other in links} for city, links in enumerate(adjacency) if links}
+        for route in routes.values():
+            pair = (min(route["city1"], route["city2"]), max(route["city1"], route["city2"]))
+            self.pairs.setdefault(pair, []).append(route)
+            if adjacency is None:
+                self.neighbors.setdefault(route["city1"], set()).add(route["city2"])
+                self.neighbors.setdefault(route["city2"], set()).add(route["city1"])
+            self.size = max(self.size, pair[1])
+            if route["owner"]:
+                self.claimed = True
+        if self.base is not None and self.pairs and len(self.base) != (self.size + 1) ** 2:
+            logger.error("Distances of the map pack don't match the routes, they are not used")
+            self.base = None
+
+    def empty_map(self):
+        """Distances of the map without claimed routes"""
+        if self.base is None:
+            self.base = all_pairs(self.size, [pair + (min(route["distance"] for route in routes),) for pair, routes in self.pairs.items()])
+        return self.base
+
+    def pair_cost(self, owner, pair):
+        cost = INFINITY
+        for route in self.pairs[pair]:
+            if route["owner"] == owner:
+                return 0
+            if not route["owner"] and self.claimable(route["id"], owner) and route["distance"] < cost:
+                cost = route["distance"]
+        return cost
+
+    def matrix(self, owner):
+        matrix = self.matrices.get(owner)
+        if matrix is not None:
+            return matrix
+        self.costs[owner] = {pair: self.pair_cost(owner, pair) for pair in self.pairs}
+        width = self.size + 1
+        if not self.claimed:
+            base = self.empty_map()
+            matrix = [list(base[city * width:(city + 1) * width]) for city in range(width)]
+        else:
+            matrix = [None] * width
+        self.matrices[owner] = matrix
+        return matrix
+
+    def search(self, owner, source):
+        """Distances from source with Dijkstra over the costs of owner"""
+        distances = [INFINITY] * (self.size + 1)
+        distances[source] = 0
+        costs = self.costs[owner]
+        queue = [(0, source)]
+        while queue:
+            distance, city = heapq.heappop(queue)
+            if distance > distances[city]:
+                continue
+            for other in self.neighbors.get(city, ()):
+                cost = costs[(city, other) if city < other else (other, city)]
+                if cost == INFINITY:
+                    continue
+                if distance + cost < distances[other]:
+                    distances[other] = distance + cost
+                    heapq.heappush(queue, (distance + cost, other))
+        return distances
+
+    def claim(self, route):
+        """Update the matrices after a route is claimed"""
+        self.claimed = True
+        city1, city2 = min(route["city1"], route["city2"]), max(route["city1"], route["city2"])
+        pair = (city1, city2)
+        for owner, matrix in self.matrices.items():
+            old = self.costs[owner][pair]
+            new = self.pair_cost(owner, pair)
+            self.costs[owner][pair] = new
+            if new < old:
+                row1 = self.row(owner, city1)
+                row2 = self.row(owner, city2)
+                for source, row in enumerate(matrix):
+                    # A dropped row is searched with the new cost anyway
+                    if row is None:
+                        continue
+                    via1 = row[city1] + new
+                    via2 = row[city2] + new
+                    # The pair makes nothing shorter from a source it doesn't bring closer to one of its cities
+                    if via1 >= row[city2] and via2 >= row[city1]:
+                        continue
+                    matrix[source] = [min(distance, via1 + distance2, via2 + distance1) for distance, distance1, distance2 in zip(row, row1, row2)]
+                    if source == city1:
+                        row1 = matrix[source]
+                    elif source == city2:
+                        row2 = matrix[source]
+            elif new > old and old != INFINITY:
+                # When the distance between two cities changes both their rows used the pair
+                for source, row in enumerate(matrix):
+                    if row is not None and row[city1] != INFINITY and (row[city1] + old == row[city2] or row[city2] + old == row[city1]):
+                        matrix[source] = None
+
+    def row(self, owner, city):
+        """Distances from a city for owner, searched again when the row was dropped"""
+        matrix = self.matrix(owner)
+        if matrix[city] is None:
+            matrix[city] = self.search(owner, city)
+        return matrix[city]
+
+    def remaining(self, owner, city1, city2):
+        """Trains owner still needs to connect two cities, INFINITY when it can't anymore"""
+        if city1 > self.size or city2 > self.size:
+            # A city without routes
+            return 0 if city1 == city2 else INFINITY
+        matrix = self.matrix(owner)
+        if matrix[city1] is None and matrix[city2] is not None:
+            return matrix[city2][city1]
+        return self.row(owner, city1)[city2]
+
+    def shortest(self, city1, city2):
+        """Trains between two cities on the empty map"""
+        return self.empty_map()[city1 * (self.size + 1) + city2]
@@ -0,0 +1,585 @@
+import random
+import logging
+import functools
+import itertools
+
+from gamestate import OWNER_DECK, OWNER_MARKET, OWNER_DISCARD
+from trails import LongestRoutes
+from connectivity import TicketTracker
+from distances import RemainingDistances, INFINITY
+
+logger = logging.getLogger(__name__)
+
+def route_scores(scores):
+    """Points per route distance as a list indexed by distance"""
+    distances = [int(key) for key in scores if key.isdigit()]
+    table = [0] * (max(distances, default=0) + 1)
+    for distance in distances:
+        table[distance] = scores[str(distance)]
+    return table
+
+def new_deck(train_cards, rng):
+    """Shuffled list of card colors"""
+    deck = []
+    for card in train_cards:
+        deck += [card["color"]] * card["cards"]
+    rng.shuffle(deck)
+    return deck
+
+def new_tickets(ticket_cards, rng):
+    """Shuffled normal tickets followed by the shuffled special tickets"""
+    tickets = []
+    for special, kind in enumerate(["normal", "special"]):
+        stack = [(ticket["city1"], ticket["city2"], ticket["value"], special) for ticket in ticket_cards[kind]]
+        rng.shuffle(stack)
+        tickets += stack
+    return tickets
+
+@functools.lru_cache(maxsize=4096)
+def payment_options(hand, colors, amount, color="blank", locomotives=0):
+    """
+    Every way to pay amount cards of color with at least locomotives locomotives,
+    a blank color can be paid with any one color. hand is a tuple of card amounts
+    indexed like the tuple colors. Returns a tuple of options, an option is a tuple
+    of (color, amount) pairs. Options with fewer locomotives and of colors with more
+    cards come first, paying everything with locomotives is one option for all colors.
+    A tunnel is paid the same way, tunnel_extra_options pays the extra cards it costs.
+    """
+    cards = dict(zip(colors, hand))
+    wild = cards.get("locomotive", 0)
+    if wild < locomotives or amount < max(locomotives, 1):
+        return ()
+    if color == "blank":
+        candidates = [c for c in colors if c != "locomotive" and cards[c] > 0]
+        candidates.sort(key=lambda c: cards[c], reverse=True)
+    elif color == "locomotive":
+        candidates = []
+    else:
+        candidates = [color]
+    options = []
+    for c in candidates:
+        have = cards.get(c, 0)
+        for used_wild in range(max(locomotives, amount - have), min(wild, amount - 1) + 1):
+            options.append(((c, amount - used_wild), ("locomotive", used_wild)) if used_wild > 0 else ((c, amount),))
+    if wild >= amount:
+        options.append((("locomotive", amount),))
+    # Fewest locomotives first, the sort is stable so colors with more cards stay in front
+    options.sort(key=lambda option: dict(option).get("locomotive", 0))
+    return tuple(options)
+
+@functools.lru_cache(maxsize=4096)
+def tunnel_extra_options(hand, colors, paid_color, extra):
+    """
+    Every way to pay the extra cards of a tunnel that was paid with paid_color: cards
+    of that color, locomotives or some of both. hand are the card amounts left after
+    the tunnel was paid, indexed like colors. Returns a tuple of options like
+    payment_options, fewest locomotives first. No extra cards is one empty option.
+    """
+    cards = dict(zip(colors, hand))
+    wild = cards.get("locomotive", 0)
+    have = 0 if paid_color == "locomotive" else cards.get(paid_color, 0)
+    options = []
+    for used_wild in range(max(0, extra - have), min(wild, extra) + 1):
+        option = ((paid_color, extra - used_wild),) if used_wild < extra else ()
+        if used_wild > 0:
+            option += (("locomotive", used_wild),)
+        options.append(option)
+    return tuple(options)
+
+# Names of the actions that are logged as moves
+MOVES = set()
+
+def move(action):
+    """
+    Log an action of the Engine in its event log once it succeeded, the actions it
+    does itself are part of it. The move is appended when the state unit is done,
+    the snapshot that is due after it is taken right away. The unit may not be
+    committed yet then, a log ahead of the database is fine: a game is rebuilt from
+    its log when it is opened and the database is written again from it.
+    """
+    @functools.wraps(action)
+    def logged(self, *args, **kwargs):
+        self.depth += 1
+        try:
+            result = action(self, *args, **kwargs)
+        finally:
+            self.depth -= 1
+        if self.depth == 0 and self.log is not None and result is not None and result is not False:
+            log = self.log
+            snapshot = self.snapshot() if log.due(log.seq + 1) else None
+            def append():
+                seq = log.append(action.__name__, args, kwargs)
+                if snapshot is not None:
+                    log.write_snapshot(seq, snapshot)
+            self.state.after_unit(append)
+        return result
+    MOVES.add(action.__name__)
+    return logged
+
+class Engine():
+    """
+    Rules of the game on a GameState, without anything of Telegram.
+    Actions are done for the player whose turn it is and return None or False
+    when they are not allowed or change nothing, the state is left untouched
+    then and the move is not logged.
+    on_turn is called with the chat_id of the next player after every turn and
+    on_reshuffle with the amount of cards when the discard pile was shuffled into
+    the deck, once the game action is done. distances are the distances of the empty map
+    and scores the points per route distance from the map pack, they are computed
+    when needed otherwise. Once an EventLog is
+    attached every move is logged in it and the game can be rebuilt from it.
+    """
+    def __init__(self, state, game, pieces, rng=None, distances=None, scores=None):
+        self.state = state
+        self.rng = rng if rng is not None else random.Random()
+        self.trains = {piece["color"]: piece["trains"] for piece in pieces}
+        self.stations = game["stations"]["amount"] if game["stations"]["enabled"] else 0
+        self.scores = game["scores"]
+        self.route_scores = scores if scores is not None else route_scores(game["scores"])
+        self.single_where_double = game["single_where_double"]
+        self.longest_route_bonus = game["scores"]["longest_route"] if game["longest_route"] else 0
+        self.trains_last_turns = game["last_turns_trains"]
+        self.turns_left = game["turns_left"]
+        self.drawn = 0
+        self.pending = {}
+        self.finished = False
+        self.on_turn = None
+        self.on_reshuffle = None
+        self.log = None
+        self.depth = 0
+        self.longest = LongestRoutes()
+        self.tickets = TicketTracker()
+        self.distances = RemainingDistances(self.claimable, distances)
+        self.rebuild()
+        state.loaded.append(self.rebuild)
+
+    def rebuild(self):
+        """Compute what is derived from the state again, after it was (re)loaded"""
+        self.longest.rebuild(self.state.routes)
+        self.tickets.rebuild(self.state.routes)
+        self.distances.rebuild(self.state.routes, self.state.adjacency)
+
+    @classmethod
+    def simulation(cls, config, seed=None):
+        """Engine on a new in memory game that is not persisted"""
+        from gamestate import GameState
+        rng = random.Random(seed)
+        state = GameState(colors=[card["color"] for card in config["train_cards"]])
+        state.seed(config["maps"]["cities"], config["maps"]["connections"], new_deck(config["train_cards"], rng), new_tickets(config["ticket_cards"], rng))
+        engine = cls(state, config["game"], config["pieces"], rng)
+        engine.deal_market()
+        return engine
+
+    ### SETUP ###
+
+    @move
+    def deal_market(self):
+        """Fill the market up to 5 cards, returns the amount of cards dealt or None when none were"""
+        dealt = 0
+        with self.state.unit():
+            while len(self.state.pile(OWNER_MARKET)) < 5:
+                if self.deal(OWNER_MARKET) is None:
+                    break
+                dealt += 1
+        return dealt or None
+
+    @move
+    def watch(self, chat_id, name):
+        """Add a spectator, returns the player dict or None when chat_id is known"""
+        if self.state.player(chat_id) is not None:
+            return None
+        with self.state.unit():
+            return self.state.add_player(chat_id, name)
+
+    @move
+    def join(self, chat_id, name, color):
+        """
+        Add a player with a color: 4 cards, a special ticket, trains and stations.
+        3 tickets are dealt of which at least 2 have to be kept with keep_tickets.
+        Returns the dealt ticket ids or None when the color is taken.
+        """
+        if color not in self.trains:
+            return None
+        with self.state.unit():
+            if any(player["color"] == color for player in self.state.active_players()):
+                return None
+            if self.state.player(chat_id) is None:
+                self.state.add_player(chat_id, name)
+            for i in range(4):
+                self.deal(chat_id)
+            special = next((ticket_id for ticket_id in self.state.ticket_pile(None) if self.state.tickets[ticket_id]["special"] == 1), None)
+            if special is not None:
+                self.state.move_ticket(special, chat_id)
+            self.state.update_player(chat_id, {"trains": self.trains[color], "stations": self.stations, "color": color})
+            # The amount of players decides which double routes can be claimed
+            self.distances.clear()
+            return self.deal_tickets(chat_id, 2)
+
+    @move
+    def start(self):
+        """Set the turn order of the players, returns the chat_id of the first player"""
+        with self.state.unit():
+            for sequence, player in enumerate(self.state.active_players(), 1):
+                self.state.add_turn(player["chat_id"], int(sequence == 1), sequence, None)
+            self.drawn = 0
+            return self.state.playing
+
+    ### TRAIN CARDS ###
+
+    def deal(self, owner):
+        """Move the top card of the deck to an owner, reshuffles the discard pile when the deck is empty"""
+        if not self.state.pile(OWNER_DECK):
+            self.reshuffle()
+        deck = self.state.pile(OWNER_DECK)
+        if not deck:
+            return None
+        card_id = deck[0]
+        self.state.move_card(card_id, owner)
+        return card_id
+
+    @move
+    def reshuffle(self, seed=None):
+        """
+        Shuffle the discard pile under the deck in one go, with the rng of the engine
+        or a Random of seed. Returns the amount of cards, None when the pile is empty.
+        """
+        rng = self.rng if seed is None else random.Random(seed)
+        with self.state.unit():
+            discard = list(self.state.pile(OWNER_DISCARD))
+            if not discard:
+                return None
+            rng.shuffle(discard)
+            self.state.move_pile(OWNER_DISCARD, OWNER_DECK, discard)
+            if self.on_reshuffle is not None:
+                self.state.after_unit(lambda: self.on_reshuffle(len(discard)))
+        logger.info("Card deck gets reshuffled!")
+        return len(discard)
+
+    @move
+    def draw_market(self, color):
+        """Take a card of a color from the market, returns the card id"""
+        chat_id = self.acting()
+        if chat_id is None or (self.drawn > 0 and color == "locomotive"):
+            return None
+        with self.state.unit():
+            card_id = self.state.find_card(OWNER_MARKET, color)
+            if card_id is None:
+                return None
+            self.state.move_card(card_id, chat_id)
+            self.deal(OWNER_MARKET)
+            if color == "locomotive":
+                self.drawn = 2
+            else:
+                self.drawn += 1
+            if self.drawn >= 2:
+                self.end_turn()
+            return card_id
+
+    @move
+    def draw_blind(self):
+        """Take the top card of the deck, returns the card id"""
+        chat_id = self.acting()
+        if chat_id is None:
+            return None
+        with self.state.unit():
+            card_id = self.deal(chat_id)
+            if card_id is None:
+                return None
+            self.drawn += 1
+            if self.drawn >= 2:
+                self.end_turn()
+            return card_id
+
+    def payment_options(self, chat_id, amount, color="blank", locomotives=0):
+        """Every way a player can pay amount cards of color with locomotives, as dicts color: amount"""
+        options = payment_options(tuple(self.state.hand(chat_id)), tuple(self.state.colors), amount, color, locomotives)
+        return [dict(option) for option in options]
+
+    def tunnel_extra_options(self, chat_id, paid_color, extra):
+        """Every way a player can pay extra cards for a tunnel paid with paid_color, as dicts color: amount"""
+        options = tunnel_extra_options(tuple(self.state.hand(chat_id)), tuple(self.state.colors), paid_color, extra)
+        return [dict(option) for option in options]
+
+    def payment(self, chat_id, amount, color="blank", locomotives=0):
+        """
+        Cheapest cards of a player for amount cards of color with at least locomotives
+        locomotives, a blank color can be paid with any color. Returns a dict color: amount or None.
+        """
+        options = payment_options(tuple(self.state.hand(chat_id)), tuple(self.state.colors), amount, color, locomotives)
+        if not options:
+            return None
+        return dict(options[0])
+
+    def valid_payment(self, chat_id, cards, amount, color="blank", locomotives=0):
+        """Check cards, a dict color: amount, pay for amount cards of color with locomotives"""
+        colors = [c for c, n in cards.items() if n > 0 and c != "locomotive"]
+        if len(colors) > 1 or sum(cards.values()) != amount or cards.get("locomotive", 0) < locomotives:
+            return False
+        if colors and color != "blank" and colors[0] != color:
+            return False
+        return all(self.state.count(chat_id, c) >= n for c, n in cards.items())
+
+    def pay(self, chat_id, cards):
+        """Move cards, a dict color: amount, of a player to the discard pile"""
+        for color, amount in cards.items():
+            for i in range(amount):
+                self.state.move_card(self.state.find_card(chat_id, color), OWNER_DISCARD)
+
+    ### ROUTES AND STATIONS ###
+
+    def claimable(self, route_id, chat_id=None):
+        """
+        Can a route still be claimed, by chat_id when given. A player never gets both routes
+        of a double route and with single_where_double players or less only one of them is used.
+        """
+        route = self.state.routes.get(route_id)
+        if route is None or route["owner"] != 0:
+            return False
+        for sibling in self.state.siblings.get(route_id, []):
+            owner = self.state.routes[sibling]["owner"]
+            if owner and (owner == chat_id or len(self.state.active_players()) <= self.single_where_double):
+                return False
+        return True
+
+    def open_routes(self, city_id, chat_id=None):
+        """Route dicts that start or end in a city and can still be claimed, by chat_id when given"""
+        return [self.state.routes[route_id] for route_id in self.state.open_routes_of_city(city_id) if self.claimable(route_id, chat_id)]
+
+    @move
+    def claim_route(self, route_id, cards=None):
+        """Build a route with cards, a dict color: amount, the cheapest cards are used without cards"""
+        chat_id = self.acting()
+        route = self.state.routes.get(route_id)
+        if chat_id is None or self.drawn > 0 or not self.claimable(route_id, chat_id):
+            return False
+        player = self.state.player(chat_id)
+        if player["trains"] < route["distance"]:
+            return False
+        with self.state.unit():
+            if cards is None:
+                cards = self.payment(chat_id, route["distance"], route["color"], route["locomotives"])
+            if cards is None or not self.valid_payment(chat_id, cards, route["distance"], route["color"], route["locomotives"]):
+                return False
+            self.pay(chat_id, cards)
+            self.state.set_route_owner(route_id, chat_id)
+            self.longest.claim(route)
+            self.tickets.claim(route)
+            self.distances.claim(route)
+            self.state.update_player(chat_id, {"trains": player["trains"] - route["distance"], "points": player["points"] + self.route_points(route["distance"])})
+            self.end_turn()
+            return True
+
+    def route_points(self, distance):
+        """Points of a route of distance"""
+        return self.route_scores[distance] if distance < len(self.route_scores) else 0
+
+    def station_cost(self, chat_id):
+        """Amount of cards the next station of a player costs"""
+        return len(self.state.stations_of(chat_id)) + 1
+
+    @move
+    def build_station(self, city_id, cards=None):
+        """Build a station in a city with cards, a dict color: amount, the cheapest cards are used without cards"""
+        chat_id = self.acting()
+        if chat_id is None or self.drawn > 0 or city_id not in self.state.city_names or city_id in self.state.stations:
+            return False
+        player = self.state.player(chat_id)
+        if player["stations"] < 1:
+            return False
+        with self.state.unit():
+            amount = self.station_cost(chat_id)
+            if cards is None:
+                cards = self.payment(chat_id, amount)
+            if cards is None or not self.valid_payment(chat_id, cards, amount):
+                return False
+            self.pay(chat_id, cards)
+            self.state.build_station(city_id, chat_id)
+            self.state.update_player(chat_id, {"stations": player["stations"] - 1})
+            self.end_turn()
+            return True
+
+    ### TICKETS ###
+
+    def deal_tickets(self, chat_id, minimum, turn=False, amount=3):
+        """Give tickets of the stack to a player who has to keep at least minimum of them, turn ends the turn once chosen"""
+        ticket_ids = list(itertools.islice(self.state.ticket_pile(None), amount))
+        for ticket_id in ticket_ids:
+            self.state.move_ticket(ticket_id, chat_id)
+        if ticket_ids:
+            self.pending[chat_id] = (list(ticket_ids), min(minimum, len(ticket_ids)), turn)
+        return ticket_ids
+
+    @move
+    def draw_tickets(self):
+        """Take 3 tickets of the stack, returns the ticket ids to choose from with keep_tickets or None"""
+        chat_id = self.acting()
+        if chat_id is None or self.drawn > 0:
+            return None
+        with self.state.unit():
+            return self.deal_tickets(chat_id, 1, True) or None
+
+    @move
+    def keep_tickets(self, ticket_ids, chat_id=None):
+        """Keep some of the dealt tickets, the others go to the bottom of the stack. Ends the turn when drawn in a turn"""
+        if chat_id is None:
+            chat_id = self.state.playing
+        if chat_id not in self.pending:
+            return False
+        dealt, minimum, turn = self.pending[chat_id]
+        ticket_ids = set(ticket_ids)
+        if len(ticket_ids) < minimum or not ticket_ids.issubset(dealt):
+            return False
+        with self.state.unit():
+            del self.pending[chat_id]
+            for ticket_id in dealt:
+                if ticket_id not in ticket_ids:
+                    self.state.move_ticket(ticket_id, None)
+            if turn:
+                self.end_turn()
+            return True
+
+    def completed(self, ticket_id):
+        """Is a ticket connected by the routes of its owner"""
+        ticket = self.state.tickets[ticket_id]
+        return self.tickets.completed(ticket["owner"], ticket)
+
+    def ticket_distance(self, ticket_id, chat_id=None):
+        """Trains the owner of a ticket, or chat_id, still needs for it, None when it can't be completed anymore"""
+        ticket = self.state.tickets[ticket_id]
+        distance = self.distances.remaining(chat_id if chat_id is not None else ticket["owner"], ticket["city1"], ticket["city2"])
+        if distance == INFINITY:
+            return None
+        return distance
+
+    ### SCORES ###
+
+    def score(self, chat_id, final=None):
+        """
+        Score of a player as dict: routes, tickets, stations, longest and total points,
+        completed and open ticket ids and the borrowed route ids. During the game open
+        tickets don't count yet, at the end they count negative and the stations borrow
+        the routes that complete the most tickets.
+        """
+        if final is None:
+            final = self.finished
+        player = self.state.player(chat_id)
+        tickets = [self.state.tickets[ticket_id] for ticket_id in self.state.ticket_pile(chat_id)]
+        if final:
+            ticket_points, borrowed, completed = self.tickets.best_stations(chat_id, tickets, self.state.stations_of(chat_id))
+        else:
+            borrowed = []
+            completed = [ticket["id"] for ticket in tickets if self.tickets.completed(chat_id, ticket)]
+            ticket_points = sum(self.state.tickets[ticket_id]["value"] for ticket_id in completed)
+        score = {
+            "routes": player["points"],
+            "tickets": ticket_points,
+            "stations": player["stations"] * self.scores["station"],
+            "longest": self.longest_route_bonus if chat_id in self.longest.leaders() else 0,
+            "completed": completed,
+            "open": [ticket["id"] for ticket in tickets if ticket["id"] not in completed],
+            "borrowed": borrowed,
+        }
+        score["total"] = score["routes"] + score["tickets"] + score["stations"] + score["longest"]
+        return score
+
+    def results(self, final=None):
+        """Scores of all players with a color, highest total first, as list of (chat_id, score)"""
+        results = [(player["chat_id"], self.score(player["chat_id"], final)) for player in self.state.active_players()]
+        results.sort(key=lambda result: result[1]["total"], reverse=True)
+        return results
+
+    ### TURNS ###
+
+    def acting(self):
+        """chat_id of the player who may act or None"""
+        chat_id = self.state.playing
+        if self.finished or chat_id is None or chat_id in self.pending:
+            return None
+        return chat_id
+
+    @move
+    def end_turn(self):
+        """Pass the turn to the next player, returns the chat_id of the next player"""
+        state = self.state
+        with state.unit():
+            self.drawn = 0
+            turn = state.turns.get(state.playing)
+            if turn is None:
+                return None
+            state.update_turn(turn["chat_id"], {"playing": 0})
+            if turn["turns"] is None:
+                if any(p["trains"] <= self.trains_last_turns for p in state.active_players()):
+                    for chat_id in state.turns:
+                        state.update_turn(chat_id, {"turns": self.turns_left})
+            else:
+                state.update_turn(turn["chat_id"], {"turns": turn["turns"] - 1})
+
+            turn = state.turn_by_sequence(turn["sequence"] % len(state.turns) + 1)
+            state.update_turn(turn["chat_id"], {"playing": 1})
+            if turn["turns"] is not None and turn["turns"] <= 0:
+                self.finished = True
+                logger.info("Game has ended")
+            if self.on_turn is not None:
+                next_chat_id = turn["chat_id"]
+                state.after_unit(lambda: self.on_turn(next_chat_id), True)
+            return turn["chat_id"]
+
+    ### EVENT LOG ###
+
+    def snapshot(self):
+        """The game with what the engine keeps itself, as a dict that can be stored as JSON"""
+        version, internal, gauss = self.rng.getstate()
+        return {
+            "state": self.state.snapshot(),
+            "drawn": self.drawn,
+            "pending": [[chat_id, dealt, minimum, turn] for chat_id, (dealt, minimum, turn) in self.pending.items()],
+            "finished": self.finished,
+            "rng": [version, list(internal), gauss],
+        }
+
+    def restore(self, snapshot):
+        """Continue the game from a snapshot"""
+        self.state.restore(snapshot["state"])
+        self.drawn = snapshot["drawn"]
+        self.pending = {chat_id: (dealt, minimum, turn) for chat_id, dealt, minimum, turn in snapshot["pending"]}
+        self.finished = snapshot["finished"]
+        version, internal, gauss = snapshot["rng"]
+        self.rng.setstate((version, tuple(internal), gauss))
+
+    def replay(self, log, seq=None):
+        """
+        Rebuild the game up to move seq, or the last move, from the latest snapshot before it
+        and the moves after that. Nothing is logged or announced meanwhile.
+        Returns the seq of the last move replayed, None without snapshot.
+        """
+        latest = log.latest_snapshot(seq)
+        if latest is None:
+            logger.error("Unable to replay the event log, it has no snapshot")
+            return None
+        last, data = latest
+        self.restore(data)
+        current, on_turn, on_reshuffle = self.log, self.on_turn, self.on_reshuffle
+        self.log, self.on_turn, self.on_reshuffle = None, None, None
+        try:
+            for event in log.events(last, seq):
+                if event["move"] not in MOVES:
+                    logger.error("Unknown move in the event log: " + str(event["move"]))
+                    break
+                getattr(self, event["move"])(*event["args"], **event["kwargs"])
+                last = event["seq"]
+        finally:
+            self.log, self.on_turn, self.on_reshuffle = current, on_turn, on_reshuffle
+        return last
+
+    def attach(self, log):
+        """
+        Log the moves from now on in log. A log of an earlier run is replayed first,
+        so the game continues where its last logged move left it.
+        """
+        self.log = None
+        if log.empty() or self.replay(log) is None:
+            log.reset()
+            log.write_snapshot(0, self.snapshot())
+        else:
+            logger.info("Game replayed up to move " + str(log.seq))
+        self.log = log
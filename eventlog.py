@@ -0,0 +1,232 @@
+"""
+Event log of a game: every move of the Engine is appended as one JSON line to
+events.jsonl and every so many moves a snapshot of the whole game is written to
+the snapshots directory. A game is rebuilt from the latest snapshot and the moves
+after it, so a crash loses nothing that was logged and any earlier moment of the
+game can be looked at again. A DocumentLog keeps a JSON document, like data.json,
+the same way: a save appends what changed instead of writing the whole file again.
+
+usage: python eventlog.py directory [map_name] [seq]
+"""
+import os
+import sys
+import json
+import copy
+import time
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+EVENTS_FILE = "events.jsonl"
+SNAPSHOT_DIRECTORY = "snapshots"
+
+class EventLog():
+    """
+    Append only log of moves in a directory. A move is a dict with seq, move (the name
+    of the Engine method), args, kwargs and time. sync makes every append reach the disk
+    before it returns, snapshot_every is the amount of moves between snapshots.
+    """
+    def __init__(self, directory, snapshot_every=50, sync=True):
+        self.directory = directory
+        self.snapshot_every = snapshot_every
+        self.sync = sync
+        os.makedirs(os.path.join(directory, SNAPSHOT_DIRECTORY), exist_ok=True)
+        self.seq = self.recover()
+        self.file = open(os.path.join(directory, EVENTS_FILE), "a")
+
+    def recover(self):
+        """Cut off what a crash left half written at the end of the log, returns the last seq"""
+        file_name = os.path.join(self.directory, EVENTS_FILE)
+        seq = 0
+        end = 0
+        try:
+            with open(file_name, "rb") as f:
+                for line in f:
+                    if not line.endswith(b"\n"):
+                        break
+                    try:
+                        seq = json.loads(line)["seq"]
+                    except (ValueError, KeyError):
+                        break
+                    end += len(line)
+                size = f.seek(0, os.SEEK_END)
+        except FileNotFoundError:
+            return 0
+        if end < size:
+            logger.error("Event log " + file_name + " ends with a move that wasn't fully written, it is dropped")
+            with open(file_name, "r+b") as f:
+                f.truncate(end)
+        return seq
+
+    def close(self):
+        self.file.close()
+
+    def empty(self):
+        return self.seq == 0 and self.latest_snapshot() is None
+
+    def append(self, move, args, kwargs):
+        """Log a move, returns its seq"""
+        self.seq += 1
+        line = json.dumps({"seq": self.seq, "move": move, "args": args, "kwargs": kwargs, "time": time.time()}, default=list)
+        self.file.write(line + "\n")
+        self.file.flush()
+        if self.sync:
+            os.fsync(self.file.fileno())
+        return self.seq
+
+    def due(self, seq):
+        """Is a snapshot due after move seq"""
+        return self.snapshot_every > 0 and seq % self.snapshot_every == 0
+
+    def events(self, since=0, upto=None):
+        """Moves after seq since up to seq upto, a line that can't be read ends the log"""
+        try:
+            f = open(os.path.join(self.directory, EVENTS_FILE))
+        except FileNotFoundError:
+            return
+        with f:
+            for number, line in enumerate(f, 1):
+                try:
+                    event = json.loads(line)
+                except ValueError as e:
+                    # Only the last line can be half written by a crash
+                    logger.error("Unable to read line " + str(number) + " of the event log, the moves after it are ignored")
+                    logger.error(e)
+                    return
+                if upto is not None and event["seq"] > upto:
+                    return
+                if event["seq"] > since:
+                    yield event
+
+    def snapshot_file(self, seq):
+        return os.path.join(self.directory, SNAPSHOT_DIRECTORY, str(seq) + ".json")
+
+    def snapshots(self):
+        """seqs of the snapshots, lowest first"""
+        names = os.listdir(os.path.join(self.directory, SNAPSHOT_DIRECTORY))
+        return sorted(int(name[:-5]) for name in names if name.endswith(".json") and name[:-5].isdigit())
+
+    def write_snapshot(self, seq, data):
+        """Write the snapshot after move seq next to its final name first, so a reader never sees half a snapshot"""
+        file_name = self.snapshot_file(seq)
+        try:
+            with open(file_name + ".tmp", "w") as f:
+                json.dump(data, f)
+                f.flush()
+                if self.sync:
+                    os.fsync(f.fileno())
+            os.replace(file_name + ".tmp", file_name)
+        except Exception as e:
+            logger.error("Unable to write snapshot " + file_name)
+            logger.error(e)
+
+    def latest_snapshot(self, upto=None):
+        """(seq, data) of the latest snapshot up to seq upto, None when there is none"""
+        for seq in reversed(self.snapshots()):
+            if upto is not None and seq > upto:
+                continue
+            try:
+                with open(self.snapshot_file(seq)) as f:
+                    return seq, json.load(f)
+            except Exception as e:
+                logger.error("Unable to read snapshot " + self.snapshot_file(seq))
+                logger.error(e)
+        return None
+
+    def reset(self):
+        """Forget every move and snapshot, for a new game"""
+        self.file.close()
+        for seq in self.snapshots():
+            os.remove(self.snapshot_file(seq))
+        self.file = open(os.path.join(self.directory, EVENTS_FILE), "w")
+        self.seq = 0
+
+class DocumentLog():
+    """
+    A JSON document kept in an event log in directory. A save appends the top level keys
+    that changed and the ones that were removed as one "save" move, every snapshot_every
+    saves the whole document is written as a snapshot. An empty log starts from the JSON
+    file file_name, which is only read then and never written.
+    """
+    def __init__(self, directory, file_name=None, snapshot_every=50, sync=True):
+        self.log = EventLog(directory, snapshot_every, sync)
+        self.lock = threading.Lock()
+        latest = self.log.latest_snapshot()
+        if latest is None:
+            # A new log, or one without a snapshot to replay from
+            self.reset(self.read(file_name))
+        else:
+            seq, self.document = latest
+            for event in self.log.events(seq):
+                self.apply(*event["args"])
+
+    def read(self, file_name):
+        if file_name is None or not os.path.exists(file_name):
+            return {}
+        try:
+            with open(file_name) as f:
+                return json.load(f)
+        except Exception as e:
+            logger.error("Unable to read " + file_name)
+            logger.error(e)
+            return {}
+
+    def apply(self, changed, removed):
+        self.document.update(changed)
+        for key in removed:
+            self.document.pop(key, None)
+
+    def reset(self, document):
+        """Forget every save and start again from document, for a new game"""
+        self.document = copy.deepcopy(document)
+        self.log.reset()
+        self.log.write_snapshot(0, self.document)
+
+    def load(self):
+        """A copy of the document, to change and save"""
+        with self.lock:
+            return copy.deepcopy(self.document)
+
+    def save(self, document):
+        """Log the keys of document that changed, returns the seq of the save or None when nothing changed"""
+        with self.lock:
+            changed = {key: copy.deepcopy(value) for key, value in document.items() if key not in self.document or self.document[key] != value}
+            removed = [key for key in self.document if key not in document]
+            if not changed and not removed:
+                return None
+            seq = self.log.append("save", [changed, removed], {})
+            self.apply(changed, removed)
+            if self.log.due(seq):
+                self.log.write_snapshot(seq, self.document)
+            return seq
+
+    def close(self):
+        with self.lock:
+            self.log.close()
+
+if __name__ == "__main__":
+    # Print the game at a move, to settle what happened
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
+    import mappack
+    from engine import Engine
+    from gamestate import GameState
+    directory = sys.argv[1]
+    map_name = sys.argv[2] if len(sys.argv) > 2 else "europe"
+    seq = int(sys.argv[3]) if len(sys.argv) > 3 else None
+    pack = mappack.load(os.path.dirname(os.path.realpath(__file__)), map_name)
+    if pack is None:
+        sys.exit(1)
+    log = EventLog(directory)
+    state = GameState(colors=[card["color"] for card in pack["train_cards"]], city_ids=pack["city_ids"], adjacency=pack["adjacency"])
+    engine = Engine(state, pack["game"], pack["pieces"], distances=pack["distances"], scores=pack["route_scores"])
+    seq = engine.replay(log, seq)
+    if seq is None:
+        logger.critical("Event log " + directory + " has no snapshot to replay from")
+        sys.exit(1)
+    for event in log.events(max(seq - 5, 0), seq):
+        print(str(event["seq"]) + ": " + event["move"] + " " + json.dumps(event["args"]) + " " + json.dumps(event["kwargs"]))
+    print("Game after move " + str(seq) + ", playing: " + str(state.playing))
+    for chat_id, score in engine.results():
+        player = state.player(chat_id)
+        print(player["name"] + " (" + str(player["color"]) + "): " + str(score["total"]) + " points, " + str(player["trains"]) + " trains, " + str(len(state.pile(chat_id))) + " cards, tickets " + str(list(state.ticket_pile(chat_id))))
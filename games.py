@@ -0,0 +1,258 @@
+"""
+Many games in one bot process. Every game has its own sqlite file, event log,
+write-behind writer and in memory state, chats are routed to the game they joined.
+Only the games that were used recently are kept open, the least recently used
+ones are closed when there are too many or when they were idle for too long.
+A game is leased while a handler runs on it and is never closed during a lease.
+"""
+import os
+import re
+import time
+import random
+import logging
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from DatabaseSqlite3 import DatabaseSqlite3, ConnectionPool
+from engine import Engine, new_deck
+from eventlog import EventLog
+from gamestate import GameState, WriteBehind
+from renderer import BoardRenderer
+
+logger = logging.getLogger(__name__)
+
+# Game of the chats that didn't choose one
+DEFAULT_GAME = "default"
+
+# Games kept open and seconds an open game may be idle
+CAPACITY = 100
+IDLE_SECONDS = 3600
+
+MEMBERSHIP_COLUMNS = [["chat_id", "game"], ["INTEGER", "TEXT"], ["PRIMARY KEY NOT NULL", "NOT NULL"]]
+
+GAME_ID = re.compile("^[A-Za-z0-9_-]{1,32}$")
+
+def valid_game_id(game_id):
+    """Game ids are used as file names"""
+    return GAME_ID.match(game_id) is not None
+
+def seed_tables(db, pack, rng=None):
+    """
+    Fill the City, Route, Ticket and Card tables from the map pack in one transaction.
+    The seed hash of the pack is stored in the Meta table, the tables are only seeded
+    again when the seeded data changed. Cities get the ids of the pack so no names
+    are looked up. The deck and tickets are shuffled with rng, a random.Random.
+    Returns True when the tables were seeded again.
+    """
+    checksum = pack["seed_hash"]
+    stored = db.get_meta("seed_hash")
+    if stored == checksum:
+        logger.info("Tables match the config")
+        return False
+    tickets = pack["tickets"]["normal"] + pack["tickets"]["special"]
+    if stored is None and db.select("City", ["count(*)"])[0][0] == len(pack["cities"]) and db.select("Route", ["count(*)"])[0][0] == len(pack["routes"]) \
+        and db.select("Ticket", ["count(*)"])[0][0] == len(tickets) and db.select("Card", ["count(*)"])[0][0] == pack["cards"]:
+        # Seeded before the seed hash was stored, keep the game that is in it
+        db.set_meta("seed_hash", checksum)
+        logger.info("Tables match the config")
+        return False
+    players = db.select("Player", ["count(*)"])[0][0]
+    if players:
+        logger.critical("Cities, routes, tickets or cards of the map changed, the game of " + str(players) + " players is seeded again: their cards, tickets, routes and event log are lost")
+
+    rng = rng if rng is not None else random.Random()
+    deck = new_deck(pack["train_cards"], rng)
+    # The first 5 cards of the deck are the market, the deck is drawn in position order
+    cards = [(card_id, color, int(card_id <= 5), card_id) for card_id, color in enumerate(deck, 1)]
+    cities = [(city_id, name, None) for city_id, name in enumerate(pack["cities"], 1)]
+    routes = [(route_id,) + route + (0,) for route_id, route in enumerate(pack["routes"], 1)]
+    ticket_data = []
+    for special, kind in enumerate(["normal", "special"]):
+        stack = list(pack["tickets"][kind])
+        rng.shuffle(stack)
+        ticket_data += [(city1, city2, value, special, None, len(ticket_data) + position) for position, (city1, city2, value) in enumerate(stack)]
+
+    with db.transaction():
+        for table_name, columns in [("City", db.city_columns), ("Route", db.route_columns), ("Ticket", db.ticket_columns), ("Card", db.card_columns)]:
+            db.delete_table(table_name)
+            db.create_table(table_name, columns)
+        db.insert("City", db.city_columns[0], cities)
+        db.insert("Route", db.route_columns[0], routes)
+        db.insert("Ticket", ["city1","city2","value","special","owner","position"], ticket_data)
+        db.insert("Card", db.card_columns[0], cards)
+        db.set_meta("seed_hash", checksum)
+    logger.info("Tables seeded: " + str(len(cities)) + " cities, " + str(len(routes)) + " routes, " + str(len(ticket_data)) + " tickets, " + str(len(cards)) + " cards")
+    return True
+
+class Game():
+    """
+    One open game: its database, writer, event log, state and engine.
+    url is the sqlite file of the game and log_directory the directory of its event log.
+    The board is drawn when the pack has one and board_directory holds its image.
+    rng, a random.Random, seeds the tables and shuffles the deck, a new one when not given.
+    """
+    def __init__(self, game_id, url, log_directory, pack, board_directory=None, rng=None):
+        self.game_id = game_id
+        self.url = url
+        self.pool = ConnectionPool(url)
+        self.last_used = time.monotonic()
+        # Leases on the game, it isn't closed while it has any
+        self.users = 0
+        rng = rng if rng is not None else random.Random()
+
+        ### Moves of the game are logged, a new game starts a new log
+        self.log = EventLog(log_directory)
+        with DatabaseSqlite3(url, True, self.pool) as db:
+            if seed_tables(db, pack, rng):
+                self.log.reset()
+
+            # Check if market cards are set
+            market = db.select("Card", ["id"], "owner = ?", (1,))
+            if len(market) != 5:
+                # The market cards go back to the deck and the top 5 of the deck, in position order, are dealt again
+                with db.transaction():
+                    db.update("Card", {"owner":0}, "owner = ?", (1,))
+                    available_cards = db.select("Card", ["id"], "owner = ?", (0,), "position, id", 5)
+                    for card in available_cards:
+                        db.update("Card", {"owner":1}, "id = ?", (card[0],))
+
+            ### Load the game in memory, changes are written to the database in the background
+            self.writer = WriteBehind(url, self.pool)
+            self.state = GameState(self.writer, [card["color"] for card in pack["train_cards"]], pack["city_ids"], pack["adjacency"])
+            self.state.load(db)
+        self.engine = Engine(self.state, pack["game"], pack["pieces"], rng=rng, distances=pack["distances"], scores=pack["route_scores"])
+        self.engine.attach(self.log)
+        self.board = None
+        if pack.get("board") is not None and board_directory is not None:
+            self.board = BoardRenderer(self.state, pack["board"], board_directory)
+        logger.info("Game " + game_id + " opened")
+
+    def close(self):
+        self.writer.close()
+        self.log.close()
+        self.pool.close_all()
+        logger.info("Game " + self.game_id + " closed")
+
+class Games():
+    """
+    The games of a bot, opened on first use. Games are sqlite files in directory, the
+    chat to game routing is kept in the Membership table of lobby.db in it. The default
+    game keeps the database url and event log the bot had before it hosted more games.
+    At most capacity games are open, games idle for idle_seconds are closed too.
+    on_open is called with every game that is opened, board_directory holds the board images.
+    """
+    def __init__(self, directory, pack, default_url=None, default_log=None, capacity=CAPACITY, idle_seconds=IDLE_SECONDS, on_open=None, board_directory=None):
+        self.directory = directory
+        self.pack = pack
+        self.default_url = default_url
+        self.default_log = default_log
+        self.capacity = capacity
+        self.idle_seconds = idle_seconds
+        self.on_open = on_open
+        self.board_directory = board_directory
+        self.lock = threading.RLock()
+        self.open_games = OrderedDict()
+        os.makedirs(directory, exist_ok=True)
+        self.lobby_url = os.path.join(directory, "lobby.db")
+        self.lobby_pool = ConnectionPool(self.lobby_url)
+        self.members = {}
+        with self.lobby() as db:
+            db.create_table("Membership", MEMBERSHIP_COLUMNS)
+            for chat_id, game_id in db.select("Membership", ["chat_id", "game"]):
+                self.members[chat_id] = game_id
+
+    def lobby(self):
+        """Database handle on lobby.db, use it as context manager"""
+        return DatabaseSqlite3(self.lobby_url, pool=self.lobby_pool)
+
+    def files(self, game_id):
+        """(database url, event log directory) of a game"""
+        if game_id == DEFAULT_GAME and self.default_url is not None:
+            return self.default_url, self.default_log or os.path.join(self.directory, game_id + ".eventlog")
+        return os.path.join(self.directory, game_id + ".db"), os.path.join(self.directory, game_id + ".eventlog")
+
+    def game_of(self, chat_id):
+        """Id of the game a chat plays in"""
+        return self.members.get(chat_id, DEFAULT_GAME)
+
+    def enter(self, chat_id, game_id):
+        """Route a chat to a game from now on, returns False when the membership couldn't be stored"""
+        if self.members.get(chat_id) == game_id:
+            return True
+        try:
+            with self.lobby() as db:
+                with db.transaction():
+                    if db.update("Membership", {"game": game_id}, "chat_id = ?", (chat_id,)) == 0:
+                        db.insert("Membership", ["chat_id", "game"], [(chat_id, game_id)])
+        except Exception as e:
+            logger.error("Unable to move chat " + str(chat_id) + " to game " + game_id)
+            logger.error(e)
+            return False
+        # Only routed once it is stored, so a restart routes the chat the same way
+        self.members[chat_id] = game_id
+        return True
+
+    def open(self, game_id):
+        """The open game with game_id, opened when it isn't, call it with the lock held"""
+        game = self.open_games.get(game_id)
+        if game is None:
+            url, log_directory = self.files(game_id)
+            game = Game(game_id, url, log_directory, self.pack, self.board_directory)
+            if self.on_open is not None:
+                self.on_open(game)
+            self.open_games[game_id] = game
+        else:
+            self.open_games.move_to_end(game_id)
+        game.last_used = time.monotonic()
+        return game
+
+    def get(self, game_id):
+        """
+        The open game with game_id, opened when it isn't. Nothing keeps it open,
+        handlers use lease so another chat can't close the game under them.
+        """
+        with self.lock:
+            game = self.open(game_id)
+            self.evict()
+            return game
+
+    @contextmanager
+    def lease(self, game_id):
+        """The open game with game_id, kept open until the with block ends"""
+        with self.lock:
+            game = self.open(game_id)
+            game.users += 1
+            self.evict()
+        try:
+            yield game
+        finally:
+            with self.lock:
+                game.users -= 1
+                game.last_used = time.monotonic()
+                self.evict()
+
+    def for_chat(self, chat_id):
+        """Lease on the game of a chat"""
+        return self.lease(self.game_of(chat_id))
+
+    def evict(self):
+        """
+        Close the least recently used games beyond capacity and the idle ones, oldest first.
+        Leased games are skipped, the evict at the end of their lease closes them.
+        """
+        now = time.monotonic()
+        for game_id, game in list(self.open_games.items()):
+            if len(self.open_games) <= self.capacity and now - game.last_used < self.idle_seconds:
+                break
+            if game.users > 0:
+                continue
+            del self.open_games[game_id]
+            game.close()
+
+    def close(self):
+        with self.lock:
+            while self.open_games:
+                game_id, game = self.open_games.popitem(last=False)
+                game.close()
+            self.lobby_pool.close_all()
@@ -0,0 +1,671 @@
+import atexit
+import logging
+import threading
+import contextlib
+from collections import deque
+
+from DatabaseSqlite3 import DatabaseSqlite3, build_update, build_insert
+
+logger = logging.getLogger(__name__)
+
+# Card owners that are not a player chat_id
+OWNER_DECK, OWNER_MARKET, OWNER_DISCARD = 0, 1, 2
+
+# Seconds before a unit that couldn't be written is tried again, doubled on every failure up to MAX_BACKOFF
+BACKOFF = 0.5
+MAX_BACKOFF = 30.0
+
+def take(pile, item_id):
+    """Remove an id from a pile, without looking through it when it is the top or the bottom"""
+    if pile[0] == item_id:
+        pile.popleft()
+    elif pile[-1] == item_id:
+        pile.pop()
+    else:
+        pile.remove(item_id)
+
+def execute(cursor, query, params):
+    """Execute a queued statement, a list of parameter tuples runs it for every tuple"""
+    if isinstance(params, list):
+        cursor.executemany(query, params)
+    else:
+        cursor.execute(query, params)
+
+class WriteBehind():
+    """
+    Writes statements to the database from a background thread.
+    Statements are queued in units, every unit is committed as a whole and
+    all units that are waiting get committed together in one transaction.
+    A unit that can't be written stays at the front of the queue and is tried
+    again after a back off, the units after it wait so the order is kept.
+    """
+    def __init__(self, url, pool=None, interval=0.2):
+        self.url = url
+        self.pool = pool
+        self.interval = interval
+        self.queue = []
+        self.busy = False
+        self.flushing = 0
+        # Writes that failed in a row
+        self.failures = 0
+        self.running = True
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=self.run, name="write-behind", daemon=True)
+        self.thread.start()
+        atexit.register(self.close)
+
+    def put(self, unit):
+        """Queue a unit, a list of (query, params) tuples"""
+        if len(unit) < 1:
+            return
+        with self.condition:
+            if not self.running:
+                logger.error("Write-behind is closed, unit of " + str(len(unit)) + " statements is written directly")
+                if self.write([unit]) < 1:
+                    logger.critical("Unit of " + str(len(unit)) + " statements is not written: " + str(unit))
+                return
+            self.queue.append(unit)
+            self.condition.notify_all()
+
+    def flush(self, timeout=None):
+        """
+        Block until every queued unit is committed, or until timeout seconds passed.
+        Returns True when everything is committed.
+        """
+        with self.condition:
+            self.flushing += 1
+            self.condition.notify_all()
+            flushed = self.condition.wait_for(lambda: not self.queue and not self.busy, timeout)
+            self.flushing -= 1
+        return flushed
+
+    def close(self, timeout=None):
+        """
+        Flush the queue and stop the writer thread. Without timeout it keeps trying for
+        as long as the database refuses a unit, after timeout what is left is not written.
+        """
+        if not self.running:
+            return
+        flushed = self.flush(timeout)
+        with self.condition:
+            self.running = False
+            self.condition.notify_all()
+        self.thread.join()
+        # Closed writers of games that were unloaded are not kept alive until exit
+        atexit.unregister(self.close)
+        if flushed:
+            logger.info("Write-behind flushed and closed")
+        else:
+            logger.critical("Write-behind closed, " + str(len(self.queue)) + " units could not be written")
+
+    def run(self):
+        while True:
+            with self.condition:
+                while self.running and not self.queue:
+                    self.condition.wait()
+                if not self.running and (not self.queue or self.failures):
+                    return
+                if self.failures:
+                    # The back off doubles with every failure in a row
+                    self.condition.wait_for(lambda: not self.running, min(BACKOFF * 2 ** min(self.failures - 1, 10), MAX_BACKOFF))
+                    if not self.running:
+                        return
+                # Give the next units a moment so they end up in the same commit
+                elif self.running and not self.flushing:
+                    self.condition.wait(self.interval)
+                units = self.queue
+                self.queue = []
+                self.busy = True
+            committed = self.write(units)
+            with self.condition:
+                self.busy = False
+                if committed < len(units):
+                    # Tried again before the units that were queued meanwhile
+                    self.queue = units[committed:] + self.queue
+                    self.failures += 1
+                else:
+                    self.failures = 0
+                self.condition.notify_all()
+
+    def write(self, units):
+        """
+        Commit all units in one transaction, when that fails every unit on its own.
+        Returns the amount of units committed, the ones after a unit that failed are not tried.
+        """
+        with DatabaseSqlite3(self.url, pool=self.pool) as db:
+            try:
+                with db.transaction():
+                    for unit in units:
+                        for query, params in unit:
+                            execute(db.cursor, query, params)
+                return len(units)
+            except Exception as e:
+                logger.error("Unable to write batch of " + str(len(units)) + " units, retrying one by one")
+                logger.error(e)
+
+            for committed, unit in enumerate(units):
+                try:
+                    with db.transaction():
+                        for query, params in unit:
+                            execute(db.cursor, query, params)
+                except Exception as e:
+                    logger.error("Unable to write unit, it is tried again later: " + str(unit))
+                    logger.error(e)
+                    return committed
+            return len(units)
+
+class GameState():
+    """
+    Authoritative in memory copy of a game.
+    Reads never go to the database, every mutation is applied in memory and
+    queued on the write-behind writer. Without writer nothing gets persisted.
+    colors are the card colors in the order of the hand arrays, colors of the
+    cards that are not in it are added when the game is loaded. city_ids and
+    adjacency are the interned city names and the routes per city of the map
+    pack, they are used instead of building them when the game is loaded.
+    """
+    def __init__(self, writer=None, colors=None, city_ids=None, adjacency=None):
+        self.writer = writer
+        self.colors = list(colors or [])
+        self.pack_city_ids = city_ids
+        self.adjacency = adjacency
+        self.lock = threading.RLock()
+        self.local = threading.local()
+        # Called without arguments after every load or seed, to rebuild what is derived from the state
+        self.loaded = []
+        # Counts the changes of route owners and stations, what is drawn of the board is redrawn when it changed
+        self.board_version = 0
+        self.clear()
+
+    def clear(self):
+        """Forget everything"""
+        self.players = {}
+        self.cards = {}
+        # Piles are deques in position order, the top is the left end.
+        # bottoms is the position after the bottom of a pile, per owner
+        self.piles = {}
+        self.bottoms = {}
+        self.hands = {}
+        self.color_index = {color: index for index, color in enumerate(self.colors)}
+        self.tickets = {}
+        self.ticket_piles = {}
+        self.ticket_bottoms = {}
+        self.routes = {}
+        self.city_routes = {}
+        self.open_city_routes = {}
+        self.siblings = {}
+        self.stations = {}
+        self.turns = {}
+        self.playing = None
+        self.city_names = {}
+        self.city_ids = {}
+
+    def load(self, db):
+        """Load the whole game from the database"""
+        with self.lock:
+            self.clear()
+            for row in db.select("Player", db.player_columns[0], None, (), "rowid"):
+                self.players[row[0]] = dict(zip(db.player_columns[0], row))
+            for row in db.select("Card", db.card_columns[0], None, (), "id"):
+                self.cards[row[0]] = {"id": row[0], "color": row[1], "owner": row[2], "position": row[3]}
+                self.piles.setdefault(row[2], []).append(row[0])
+            self.order_piles("Card", self.cards, self.piles, self.bottoms)
+            self.count_hands()
+            for row in db.select("Ticket", db.ticket_columns[0], None, (), "id"):
+                self.tickets[row[0]] = dict(zip(db.ticket_columns[0], row))
+                self.ticket_piles.setdefault(row[5], []).append(row[0])
+            self.order_piles("Ticket", self.tickets, self.ticket_piles, self.ticket_bottoms)
+            for row in db.select("Route", db.route_columns[0], None, (), "id"):
+                route = dict(zip(db.route_columns[0], row))
+                route["city1"] = int(route["city1"])
+                route["city2"] = int(route["city2"])
+                self.routes[row[0]] = route
+            self.index_routes()
+            self.load_cities(db)
+            for row in db.select("Turn", db.turn_columns[0], None, (), "sequence"):
+                self.turns[row[0]] = dict(zip(db.turn_columns[0], row))
+                if row[1] == 1:
+                    self.playing = row[0]
+            self.notify_loaded()
+        logger.info("Game state loaded: " + str(len(self.players)) + " players, " + str(len(self.cards)) + " cards, " + str(len(self.tickets)) + " tickets, " + str(len(self.routes)) + " routes")
+
+    def seed(self, cities, connections, deck, tickets):
+        """
+        Set up a new game in memory only, ids are numbered like the database does.
+        cities is a list of names, connections the map connections, deck a list of card
+        colors and tickets a list of (city1, city2, value, special) with city names.
+        """
+        with self.lock:
+            self.clear()
+            for city_id, name in enumerate(cities, 1):
+                self.city_names[city_id] = name
+                self.city_ids[name.lower()] = city_id
+            for route_id, route in enumerate(connections, 1):
+                self.routes[route_id] = {"id": route_id, "city1": self.city_id(route["city1"]), "city2": self.city_id(route["city2"]), "color": route["color"],
+                    "distance": route["distance"], "locomotives": route["locomotives"], "tunnel": int(route["tunnel"]), "owner": 0}
+            self.index_routes()
+            for card_id, color in enumerate(deck, 1):
+                self.cards[card_id] = {"id": card_id, "color": color, "owner": OWNER_DECK, "position": card_id}
+                self.piles.setdefault(OWNER_DECK, []).append(card_id)
+            self.order_piles("Card", self.cards, self.piles, self.bottoms)
+            self.count_hands()
+            for ticket_id, (city1, city2, value, special) in enumerate(tickets, 1):
+                self.tickets[ticket_id] = {"id": ticket_id, "city1": self.city_id(city1), "city2": self.city_id(city2), "value": value, "special": special, "owner": None, "position": ticket_id}
+                self.ticket_piles.setdefault(None, []).append(ticket_id)
+            self.order_piles("Ticket", self.tickets, self.ticket_piles, self.ticket_bottoms)
+            self.notify_loaded()
+
+    def snapshot(self):
+        """Everything of the game as a dict that can be stored as JSON, piles keep their order instead of positions"""
+        with self.lock:
+            return {
+                "players": [dict(player) for player in self.players.values()],
+                "cities": [[city_id, name, self.stations.get(city_id)] for city_id, name in self.city_names.items()],
+                "routes": [dict(route) for route in self.routes.values()],
+                "cards": [[card_id, card["color"]] for card_id, card in self.cards.items()],
+                "piles": [[owner, list(card_ids)] for owner, card_ids in self.piles.items()],
+                "tickets": [{key: value for key, value in ticket.items() if key != "position"} for ticket in self.tickets.values()],
+                "ticket_piles": [[owner, list(ticket_ids)] for owner, ticket_ids in self.ticket_piles.items()],
+                "turns": [dict(turn) for turn in self.turns.values()],
+            }
+
+    def restore(self, snapshot):
+        """
+        Replace everything by a snapshot. The database is brought in line with it in one
+        unit: players and turns are written again, cards, tickets, routes and stations updated.
+        """
+        with self.lock:
+            self.clear()
+            for player in snapshot["players"]:
+                self.players[player["chat_id"]] = dict(player)
+            for city_id, name, station in snapshot["cities"]:
+                self.city_names[city_id] = name
+                self.city_ids[name.lower()] = city_id
+                if station is not None:
+                    self.stations[city_id] = station
+            for route in snapshot["routes"]:
+                self.routes[route["id"]] = dict(route)
+            self.index_routes()
+            # The order of the piles gives the positions
+            for card_id, color in snapshot["cards"]:
+                self.cards[card_id] = {"id": card_id, "color": color, "owner": None, "position": None}
+            for owner, card_ids in snapshot["piles"]:
+                self.piles[owner] = list(card_ids)
+                for card_id in card_ids:
+                    self.cards[card_id]["owner"] = owner
+            self.count_hands()
+            for ticket in snapshot["tickets"]:
+                self.tickets[ticket["id"]] = dict(ticket, position=None)
+            for owner, ticket_ids in snapshot["ticket_piles"]:
+                self.ticket_piles[owner] = list(ticket_ids)
+            for turn in sorted(snapshot["turns"], key=lambda turn: turn["sequence"]):
+                self.turns[turn["chat_id"]] = dict(turn)
+                if turn["playing"] == 1:
+                    self.playing = turn["chat_id"]
+
+            with self.unit():
+                self.order_piles("Card", self.cards, self.piles, self.bottoms, False)
+                self.order_piles("Ticket", self.tickets, self.ticket_piles, self.ticket_bottoms, False)
+                self.write("DELETE FROM Player", ())
+                for player in self.players.values():
+                    self.write(build_insert("Player", ("chat_id", "name", "trains", "stations", "points", "color")), (player["chat_id"], player["name"], player["trains"], player["stations"], player["points"], player["color"]))
+                self.write("DELETE FROM Turn", ())
+                for turn in self.turns.values():
+                    self.write(build_insert("Turn", ("chat_id", "playing", "sequence", "turns")), (turn["chat_id"], turn["playing"], turn["sequence"], turn["turns"]))
+                for card in self.cards.values():
+                    self.write(build_update("Card", ("owner", "position"), "id = ?"), (card["owner"], card["position"], card["id"]))
+                for ticket in self.tickets.values():
+                    self.write(build_update("Ticket", ("owner", "position"), "id = ?"), (ticket["owner"], ticket["position"], ticket["id"]))
+                for route in self.routes.values():
+                    self.write(build_update("Route", ("owner",), "id = ?"), (route["owner"], route["id"]))
+                for city_id in self.city_names:
+                    self.write(build_update("City", ("station",), "id = ?"), (self.stations.get(city_id), city_id))
+            self.notify_loaded()
+
+    def order_piles(self, table_name, items, piles, bottoms, positioned=True):
+        """
+        Turn the lists of ids per owner into deques in position order. Without positions,
+        from a database made before they existed or from a snapshot, the order of the lists
+        is kept and numbered, the new positions are written when positioned is True.
+        """
+        for owner, item_ids in piles.items():
+            if any(items[item_id]["position"] is None for item_id in item_ids):
+                with self.unit():
+                    for position, item_id in enumerate(item_ids):
+                        items[item_id]["position"] = position
+                        if positioned:
+                            self.write(build_update(table_name, ("position",), "id = ?"), (position, item_id))
+            else:
+                item_ids.sort(key=lambda item_id: items[item_id]["position"])
+            piles[owner] = deque(item_ids)
+            bottoms[owner] = items[item_ids[-1]]["position"] + 1 if item_ids else 0
+
+    def notify_loaded(self):
+        self.board_version += 1
+        for callback in self.loaded:
+            callback()
+
+    def load_cities(self, db):
+        """Intern the city names, call again whenever the City table is rebuilt"""
+        self.city_names = {}
+        self.city_ids = {}
+        self.stations = {}
+        rows = db.select("City", db.city_columns[0], None, (), "id")
+        interned = self.pack_city_ids is not None and len(self.pack_city_ids) == len(rows)
+        for row in rows:
+            self.city_names[row[0]] = row[1]
+            if not interned:
+                self.city_ids[row[1].lower()] = row[0]
+            if row[2] is not None:
+                self.stations[row[0]] = row[2]
+        if interned:
+            # The City table is seeded from the pack, its ids are the ones of the pack
+            self.city_ids = dict(self.pack_city_ids)
+
+    def reload(self):
+        """Drop the memory copy and load the committed state again"""
+        if self.writer is None:
+            logger.error("Game state without writer can't be reloaded")
+            return
+        self.writer.flush()
+        with DatabaseSqlite3(self.writer.url, pool=self.writer.pool) as db:
+            self.load(db)
+
+    ### UNIT OF WORK ###
+
+    @contextlib.contextmanager
+    def unit(self):
+        """
+        Group the mutations of one game action. They are queued as one unit at the end,
+        callbacks registered with after_unit run afterwards, outside the lock of the state.
+        When an exception is raised the queued writes are dropped and the state is reloaded
+        from the database.
+        """
+        with self.lock:
+            if getattr(self.local, "depth", 0) > 0:
+                self.local.depth += 1
+                try:
+                    yield self
+                finally:
+                    self.local.depth -= 1
+                return
+
+            self.local.depth = 1
+            self.local.writes = []
+            self.local.callbacks = []
+            self.local.last_callbacks = []
+            try:
+                yield self
+            except BaseException:
+                self.local.depth = 0
+                logger.warning("Game action failed, " + str(len(self.local.writes)) + " writes dropped")
+                self.local.writes = []
+                self.local.callbacks = []
+                self.local.last_callbacks = []
+                self.reload()
+                raise
+            self.local.depth = 0
+            writes = self.local.writes
+            callbacks = self.local.callbacks + self.local.last_callbacks
+            self.local.writes = []
+            self.local.callbacks = []
+            self.local.last_callbacks = []
+            if self.writer is not None:
+                self.writer.put(writes)
+
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception as e:
+                logger.error("Game state callback failed")
+                logger.error(e)
+
+    def after_unit(self, callback, last=False):
+        """
+        Run callback after the current unit, or right away outside a unit. last callbacks
+        run after the others. The unit is queued on the writer by then, not committed yet.
+        """
+        if getattr(self.local, "depth", 0) > 0:
+            if last:
+                self.local.last_callbacks.append(callback)
+            else:
+                self.local.callbacks.append(callback)
+        else:
+            callback()
+
+    def write(self, query, params):
+        """Queue a statement in the current unit or as a unit on its own"""
+        if getattr(self.local, "depth", 0) > 0:
+            self.local.writes.append((query, params))
+        elif self.writer is not None:
+            self.writer.put([(query, params)])
+
+    def write_many(self, query, rows):
+        """Queue one statement that is executed for every parameter tuple of rows"""
+        self.write(query, list(rows))
+
+    ### PLAYERS ###
+
+    def player(self, chat_id):
+        """Get the player dict of a chat_id or None"""
+        return self.players.get(chat_id)
+
+    def active_players(self):
+        """Players that have chosen a color"""
+        return [p for p in self.players.values() if p["color"] is not None]
+
+    def add_player(self, chat_id, name):
+        """Add a spectator"""
+        player = {"chat_id": chat_id, "name": name, "trains": 0, "stations": 0, "points": 0, "color": None}
+        self.players[chat_id] = player
+        self.write(build_insert("Player", ("chat_id", "name", "trains", "stations", "points", "color")), (chat_id, name, 0, 0, 0, None))
+        return player
+
+    def update_player(self, chat_id, data):
+        """Update columns of a player"""
+        self.players[chat_id].update(data)
+        self.write(build_update("Player", tuple(data.keys()), "chat_id = ?"), tuple(data.values()) + (chat_id,))
+
+    ### CARDS ###
+
+    def pile(self, owner):
+        """Card ids of an owner in order: OWNER_DECK, OWNER_MARKET, OWNER_DISCARD or a chat_id. Don't modify it"""
+        return self.piles.get(owner, ())
+
+    def pile_colors(self, owner):
+        """Card colors of an owner"""
+        return [self.cards[card_id]["color"] for card_id in self.pile(owner)]
+
+    def count_hands(self):
+        """Count the cards of every owner per color, after the cards are loaded"""
+        for card in self.cards.values():
+            if card["color"] not in self.color_index:
+                self.color_index[card["color"]] = len(self.colors)
+                self.colors.append(card["color"])
+        self.hands = {}
+        for owner, card_ids in self.piles.items():
+            hand = self.hands[owner] = [0] * len(self.colors)
+            for card_id in card_ids:
+                hand[self.color_index[self.cards[card_id]["color"]]] += 1
+
+    def hand(self, owner):
+        """Amount of cards of an owner per color, indexed like colors. Don't modify it"""
+        hand = self.hands.get(owner)
+        if hand is None:
+            return [0] * len(self.colors)
+        return hand
+
+    def count(self, owner, color):
+        """Amount of cards of a color of an owner"""
+        index = self.color_index.get(color)
+        hand = self.hands.get(owner)
+        if index is None or hand is None:
+            return 0
+        return hand[index]
+
+    def hand_colors(self, owner):
+        """Colors an owner has cards of as dict color: amount, in the order of colors"""
+        hand = self.hand(owner)
+        return {color: hand[index] for index, color in enumerate(self.colors) if hand[index] > 0}
+
+    def move_card(self, card_id, owner):
+        """Give a card to a new owner, it goes to the bottom of its pile"""
+        card = self.cards[card_id]
+        take(self.piles[card["owner"]], card_id)
+        self.piles.setdefault(owner, deque()).append(card_id)
+        index = self.color_index[card["color"]]
+        self.hands[card["owner"]][index] -= 1
+        if owner not in self.hands:
+            self.hands[owner] = [0] * len(self.colors)
+        self.hands[owner][index] += 1
+        card["owner"] = owner
+        card["position"] = self.bottoms.get(owner, 0)
+        self.bottoms[owner] = card["position"] + 1
+        self.write(build_update("Card", ("owner", "position"), "id = ?"), (owner, card["position"], card_id))
+
+    def move_pile(self, owner, new_owner, card_ids=None):
+        """
+        Put every card of owner at the bottom of the pile of new_owner, in the order of
+        card_ids, a permutation of the pile, or in pile order. The cards are written with
+        one statement. Returns the amount of cards.
+        """
+        pile = self.piles.get(owner)
+        if not pile:
+            return 0
+        card_ids = list(pile) if card_ids is None else list(card_ids)
+        pile.clear()
+        self.piles.setdefault(new_owner, deque()).extend(card_ids)
+        if new_owner not in self.hands:
+            self.hands[new_owner] = [0] * len(self.colors)
+        self.hands[new_owner] = [a + b for a, b in zip(self.hands[new_owner], self.hands[owner])]
+        self.hands[owner] = [0] * len(self.colors)
+        bottom = self.bottoms.get(new_owner, 0)
+        for position, card_id in enumerate(card_ids, bottom):
+            card = self.cards[card_id]
+            card["owner"] = new_owner
+            card["position"] = position
+        self.bottoms[new_owner] = bottom + len(card_ids)
+        self.write_many(build_update("Card", ("owner", "position"), "id = ?"), ((new_owner, position, card_id) for position, card_id in enumerate(card_ids, bottom)))
+        return len(card_ids)
+
+    def find_card(self, owner, color):
+        """Get the first card of a color of an owner or None"""
+        for card_id in self.pile(owner):
+            if self.cards[card_id]["color"] == color:
+                return card_id
+        return None
+
+    ### TICKETS ###
+
+    def ticket_pile(self, owner):
+        """Ticket ids of an owner in order: None for the stack, 0 for tickets disposed by older versions or a chat_id. Don't modify it"""
+        return self.ticket_piles.get(owner, ())
+
+    def move_ticket(self, ticket_id, owner):
+        """Give a ticket to a new owner, it goes to the bottom of its pile"""
+        ticket = self.tickets[ticket_id]
+        take(self.ticket_piles[ticket["owner"]], ticket_id)
+        self.ticket_piles.setdefault(owner, deque()).append(ticket_id)
+        ticket["owner"] = owner
+        ticket["position"] = self.ticket_bottoms.get(owner, 0)
+        self.ticket_bottoms[owner] = ticket["position"] + 1
+        self.write(build_update("Ticket", ("owner", "position"), "id = ?"), (owner, ticket["position"], ticket_id))
+
+    ### CITIES ###
+
+    def city_name(self, city_id):
+        """Name of a city id"""
+        return self.city_names[city_id]
+
+    def city_id(self, name):
+        """Id of a city name, case insensitive, or None"""
+        return self.city_ids.get(name.lower())
+
+    ### ROUTES AND STATIONS ###
+
+    def index_routes(self):
+        """
+        Route ids per city, all of them and the ones without owner, and per route the
+        other routes between the same cities, after the routes are loaded.
+        """
+        self.city_routes = {}
+        self.open_city_routes = {}
+        self.siblings = {}
+        if self.adjacency is not None and sum(len(links) for links in self.adjacency) != 2 * len(self.routes):
+            logger.error("Routes of the map pack don't match the routes of the game, they are indexed again")
+            self.adjacency = None
+        if self.adjacency is not None:
+            for city_id, links in enumerate(self.adjacency):
+                if not links:
+                    continue
+                self.city_routes[city_id] = [route_id for route_id, other in links]
+                self.open_city_routes[city_id] = [route_id for route_id, other in links if not self.routes[route_id]["owner"]]
+                for route_id, other in links:
+                    self.siblings[route_id] = [sibling for sibling, city in links if city == other and sibling != route_id]
+            return
+        pairs = {}
+        for route_id, route in self.routes.items():
+            for city_id in (route["city1"], route["city2"]):
+                self.city_routes.setdefault(city_id, []).append(route_id)
+                if not route["owner"]:
+                    self.open_city_routes.setdefault(city_id, []).append(route_id)
+            pairs.setdefault(frozenset((route["city1"], route["city2"])), []).append(route_id)
+        for route_ids in pairs.values():
+            for route_id in route_ids:
+                self.siblings[route_id] = [sibling for sibling in route_ids if sibling != route_id]
+
+    def routes_of_city(self, city_id):
+        """Route ids that start or end in a city"""
+        return self.city_routes.get(city_id, [])
+
+    def open_routes_of_city(self, city_id):
+        """Route ids without owner that start or end in a city"""
+        return self.open_city_routes.get(city_id, [])
+
+    def set_route_owner(self, route_id, owner):
+        """Claim a route"""
+        route = self.routes[route_id]
+        for city_id in (route["city1"], route["city2"]):
+            open_routes = self.open_city_routes.setdefault(city_id, [])
+            if owner and route_id in open_routes:
+                open_routes.remove(route_id)
+            elif not owner and route_id not in open_routes:
+                open_routes.append(route_id)
+        route["owner"] = owner
+        self.board_version += 1
+        self.write(build_update("Route", ("owner",), "id = ?"), (owner, route_id))
+
+    def build_station(self, city_id, owner):
+        """Build a station in a city"""
+        self.stations[city_id] = owner
+        self.board_version += 1
+        self.write(build_update("City", ("station",), "id = ?"), (owner, city_id))
+
+    def stations_of(self, owner):
+        """City ids where a player has a station"""
+        return [city_id for city_id, station in self.stations.items() if station == owner]
+
+    ### TURNS ###
+
+    def add_turn(self, chat_id, playing, sequence, turns=None):
+        """Add a player to the turn order"""
+        self.turns[chat_id] = {"chat_id": chat_id, "playing": playing, "sequence": sequence, "turns": turns}
+        if playing:
+            self.playing = chat_id
+        self.write(build_insert("Turn", ("chat_id", "playing", "sequence", "turns")), (chat_id, playing, sequence, turns))
+
+    def update_turn(self, chat_id, data):
+        """Update columns of a turn row"""
+        self.turns[chat_id].update(data)
+        if data.get("playing") == 1:
+            self.playing = chat_id
+        elif data.get("playing") == 0 and self.playing == chat_id:
+            self.playing = None
+        self.write(build_update("Turn", tuple(data.keys()), "chat_id = ?"), tuple(data.values()) + (chat_id,))
+
+    def turn_by_sequence(self, sequence):
+        """Get the turn row with a sequence number or None"""
+        for turn in self.turns.values():
+            if turn["sequence"] == sequence:
+                return turn
+        return None
@@ -1,11 +1,12 @@
 import logging
 import os
-import json
-import requests
 
 from telegram import (ReplyKeyboardMarkup, ReplyKeyboardRemove)
 from telegram.ext import (Updater, CommandHandler, MessageHandler, Filters, ConversationHandler)
 
+from broadcaster import Broadcaster
+from eventlog import DocumentLog
+
 # Enable logging
 logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
 
@@ -14,6 +15,11 @@ logger = logging.getLogger(__name__)
 class VTR():
     def __init__(self):
         keepGoing = True
+        bot_token = ''
+        self.broadcaster = Broadcaster(bot_token)
+        # data.json is kept in an event log, a save appends what changed instead of writing the whole file
+        path = os.path.dirname(os.path.abspath(__file__))
+        self.documents = DocumentLog(os.path.join(path, 'data.eventlog'), os.path.join(path, 'data.json'))
         self.json_load()
         if len(self.data["turn"]) < 1:
             self.broadcast("Welcome to the game, we're starting now!\n\nCHEW CHEW")
@@ -56,34 +62,19 @@ class VTR():
 
     def broadcast(self, message):
         """Send a message to all players and spectators"""
-        bot_token = ''
-        for spectator in self.data["spectators"]:
-            try:
-                send_text = 'https://api.telegram.org/bot' + bot_token + '/sendMessage?chat_id=' + str(spectator) + '&parse_mode=Markdown&text=' + message
-                response = requests.get(send_text)
-            except Exception as e:
-                logger.error(e)
-
-        for player in self.data["players"]:
-            try:
-                send_text = 'https://api.telegram.org/bot' + bot_token + '/sendMessage?chat_id=' + str(player["chat_id"]) + '&parse_mode=Markdown&text=' + message
-                response = requests.get(send_text)
-            except Exception as e:
-                logger.error(e)
+        chat_ids = list(self.data["spectators"])
+        chat_ids += [player["chat_id"] for player in self.data["players"]]
+        self.broadcaster.broadcast(chat_ids, message)
 
     def json_load(self):
         try:
-            path = os.path.join(os.path.dirname(os.path.abspath(__file__)),'data.json')
-            with open(path, 'r') as f:
-                self.data = json.load(f)
+            self.data = self.documents.load()
         except Exception as e:
             logger.error(e)
     
     def json_save(self):
         try:
-            path = os.path.join(os.path.dirname(os.path.abspath(__file__)),'data.json')
-            with open(path, 'w') as json_file:
-                json_file.write(json.dumps(self.data, ensure_ascii=False))
+            self.documents.save(self.data)
         except Exception as e:
             logger.error(e)
 
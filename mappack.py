@@ -0,0 +1,242 @@
+"""
+Map pack: the maps, train_cards, ticket_cards, game and pieces config files of
+one map compiled into a single validated artifact. The pack is pickled in the
+mappacks directory and only compiled again when the content of the config files
+changes, so loading a game is one read of one file.
+
+usage: python mappack.py [map_name]
+"""
+import os
+import sys
+import json
+import pickle
+import hashlib
+import logging
+
+from engine import route_scores
+from distances import all_pairs
+
+logger = logging.getLogger(__name__)
+
+PACK_VERSION = 6
+PACK_DIRECTORY = "mappacks"
+CONFIG_DIRECTORIES = ["maps", "train_cards", "ticket_cards", "game", "pieces"]
+
+# Packs loaded by this process, per map name
+packs = {}
+
+def config_files(path, map_name):
+    """
+    Path of the config file of map_name in every config directory, in the order of
+    CONFIG_DIRECTORIES. The first name in sorted order is used when several match.
+    None when one is missing.
+    """
+    files = []
+    for directory in CONFIG_DIRECTORIES:
+        names = sorted(file_name for file_name in os.listdir(os.path.join(path, directory)) if map_name in file_name)
+        if not names:
+            logger.critical("No " + directory + " config file found for map " + map_name)
+            return None
+        files.append(os.path.join(path, directory, names[0]))
+    return files
+
+def load_config(path, map_name, files=None):
+    """
+    Load the config files of a map_name from the maps, train_cards, ticket_cards,
+    game and pieces directories, or the files of config_files. A dict with the
+    directory names as keys is returned, None when a file is missing or broken.
+    """
+    files = files or config_files(path, map_name)
+    if files is None:
+        return None
+    config = {}
+    for directory, file_name in zip(CONFIG_DIRECTORIES, files):
+        try:
+            with open(file_name) as f:
+                config[directory] = json.load(f)
+        except Exception as e:
+            logger.error("Unable to load " + file_name)
+            logger.error(e)
+            return None
+    return config
+
+def content_hash(files):
+    digest = hashlib.sha256()
+    for file_name in files:
+        with open(file_name, "rb") as f:
+            digest.update(os.path.basename(file_name).encode())
+            digest.update(f.read())
+    return digest.hexdigest()
+
+def seed_hash(pack):
+    """
+    Hash of what is seeded in the game tables: cities, routes, tickets and the card
+    colors and counts. Changes of the game rules, pieces or board leave it alone.
+    """
+    data = [pack["cities"], pack["routes"], pack["tickets"], [[card["color"], card["cards"]] for card in pack["train_cards"]]]
+    return hashlib.sha256(json.dumps(data).encode()).hexdigest()
+
+def file_stats(files):
+    """Modification time and size per file, to see cheaply if the files changed"""
+    stats = {}
+    for file_name in files:
+        stat = os.stat(file_name)
+        stats[file_name] = (stat.st_mtime_ns, stat.st_size)
+    return stats
+
+def unchanged(stats):
+    try:
+        return all(file_stats([file_name])[file_name] == stat for file_name, stat in stats.items())
+    except OSError:
+        return False
+
+def validate(config):
+    """Log what is wrong with a config, returns True when it can be played"""
+    cities = config["maps"]["cities"]
+    valid = True
+    if len(set(city.lower() for city in cities)) != len(cities):
+        logger.critical("Cities of the map are not unique")
+        valid = False
+    known = set(cities)
+    connected = set()
+    for route in config["maps"]["connections"]:
+        connected.add(route["city1"])
+        connected.add(route["city2"])
+    if connected != known:
+        logger.critical("Cities and cities in routes don't match: " + ", ".join(sorted(connected ^ known)))
+        valid = False
+    for kind in ["normal", "special"]:
+        for ticket in config["ticket_cards"][kind]:
+            for city in (ticket["city1"], ticket["city2"]):
+                if city not in known:
+                    logger.critical("Unknown city in " + kind + " ticket: " + city)
+                    valid = False
+    if not config["pieces"]:
+        logger.critical("No pieces in the config")
+        valid = False
+    return valid
+
+def board_geometry(maps, cities):
+    """
+    Board image and position of every city on it, indexed by city id, from the board
+    section of the map. None when the map has no board or a city has no position.
+    """
+    board = maps.get("board")
+    if board is None:
+        return None
+    missing = [city for city in cities if city not in board["cities"]]
+    if missing:
+        logger.error("Cities without position on the board, it is not rendered: " + ", ".join(missing))
+        return None
+    return {"image": board["image"], "cities": [None] + [tuple(board["cities"][city]) for city in cities]}
+
+def build(path, map_name, files=None, digest=None):
+    """Compile the config files of map_name, returns the pack or None when they are invalid"""
+    files = files or config_files(path, map_name)
+    if files is None:
+        return None
+    config = load_config(path, map_name, files)
+    if config is None or not validate(config):
+        return None
+
+    cities = config["maps"]["cities"]
+    city_ids = {name.lower(): city_id for city_id, name in enumerate(cities, 1)}
+    routes = []
+    # Per city id the (route id, other city id) of its routes, route ids are the ids the tables are seeded with
+    adjacency = [[] for i in range(len(cities) + 1)]
+    for route_id, route in enumerate(config["maps"]["connections"], 1):
+        city1 = city_ids[route["city1"].lower()]
+        city2 = city_ids[route["city2"].lower()]
+        routes.append((city1, city2, route["color"], route["distance"], route["locomotives"], int(route["tunnel"])))
+        adjacency[city1].append((route_id, city2))
+        adjacency[city2].append((route_id, city1))
+    tickets = {}
+    for kind in ["normal", "special"]:
+        tickets[kind] = [(city_ids[ticket["city1"].lower()], city_ids[ticket["city2"].lower()], ticket["value"]) for ticket in config["ticket_cards"][kind]]
+
+    board = board_geometry(config["maps"], cities)
+
+    # The compiled maps and ticket_cards replace the parsed files
+    pack = {"train_cards": config["train_cards"], "game": config["game"], "pieces": config["pieces"]}
+    pack.update({
+        "version": PACK_VERSION,
+        "map_name": map_name,
+        "hash": digest or content_hash(files),
+        "sources": file_stats(files),
+        "cities": cities,
+        "city_ids": city_ids,
+        "routes": routes,
+        "adjacency": adjacency,
+        "tickets": tickets,
+        "cards": sum(card["cards"] for card in config["train_cards"]),
+        "route_scores": route_scores(config["game"]["scores"]),
+        "distances": all_pairs(len(cities), [(route[0], route[1], route[3]) for route in routes]),
+        "board": board,
+    })
+    pack["seed_hash"] = seed_hash(pack)
+    return pack
+
+def pack_file(path, map_name):
+    return os.path.join(path, PACK_DIRECTORY, map_name + ".pack")
+
+def read(file_name):
+    try:
+        with open(file_name, "rb") as f:
+            pack = pickle.load(f)
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        logger.error("Unable to read map pack " + file_name)
+        logger.error(e)
+        return None
+    if not isinstance(pack, dict) or pack.get("version") != PACK_VERSION:
+        return None
+    return pack
+
+def write(file_name, pack):
+    """Write the pack next to its final name first, so a reader never sees half a pack"""
+    try:
+        os.makedirs(os.path.dirname(file_name), exist_ok=True)
+        with open(file_name + ".tmp", "wb") as f:
+            pickle.dump(pack, f, pickle.HIGHEST_PROTOCOL)
+        os.replace(file_name + ".tmp", file_name)
+    except Exception as e:
+        logger.error("Unable to write map pack " + file_name)
+        logger.error(e)
+
+def load(path, map_name):
+    """
+    The pack of map_name, compiled again only when the content of its config files
+    changed. Returns None when the config files are missing or invalid.
+    """
+    pack = packs.get(map_name)
+    if pack is not None and unchanged(pack["sources"]):
+        return pack
+    file_name = pack_file(path, map_name)
+    pack = read(file_name)
+    if pack is None or not unchanged(pack["sources"]):
+        files = config_files(path, map_name)
+        if files is None:
+            return None
+        digest = content_hash(files)
+        if pack is not None and pack["hash"] == digest and set(pack["sources"]) == set(files):
+            # Only touched, the compiled data is still valid
+            pack["sources"] = file_stats(files)
+        else:
+            pack = build(path, map_name, files, digest)
+            if pack is None:
+                return None
+            logger.info("Map pack " + map_name + " compiled")
+        write(file_name, pack)
+    packs[map_name] = pack
+    return pack
+
+if __name__ == "__main__":
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
+    map_name = sys.argv[1] if len(sys.argv) > 1 else "europe"
+    path = os.path.dirname(os.path.realpath(__file__))
+    pack = build(path, map_name)
+    if pack is None:
+        sys.exit(1)
+    write(pack_file(path, map_name), pack)
+    logger.info("Map pack " + map_name + ": " + str(len(pack["cities"])) + " cities, " + str(len(pack["routes"])) + " routes, " + str(len(pack["tickets"]["normal"]) + len(pack["tickets"]["special"])) + " tickets")
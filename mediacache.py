@@ -0,0 +1,128 @@
+"""
+File ids of the photos the bot sent. Telegram keeps every photo that was uploaded,
+sending its file_id again costs no upload. Photos are keyed by the hash of their
+content, a board that didn't change is uploaded once however many players look at
+it. The file ids are rows of a sqlite table, the least recently used are evicted.
+Looking up a file id doesn't write, when it was used is written with the next new
+file id or when the cache is flushed.
+"""
+import os
+import time
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+
+from telegram.error import BadRequest
+
+from DatabaseSqlite3 import DatabaseSqlite3
+
+logger = logging.getLogger(__name__)
+
+# File ids kept
+CAPACITY = 500
+
+MEDIA_COLUMNS = [["key", "file_id", "used"], ["TEXT", "TEXT", "REAL"], ["PRIMARY KEY NOT NULL", "NOT NULL", "NOT NULL"]]
+
+def content_key(data):
+    """Key of a photo: the hash of its bytes"""
+    return hashlib.sha256(data).hexdigest()
+
+class MediaCache():
+    """
+    File ids per photo key in the Media table of a sqlite database, loaded once.
+    At most capacity file ids are kept, the least recently sent ones are dropped.
+    The use times of the hits are kept in memory until put or flush writes them.
+    """
+    def __init__(self, url, pool=None, capacity=CAPACITY):
+        self.url = url
+        self.pool = pool
+        self.capacity = capacity
+        self.lock = threading.Lock()
+        self.file_ids = OrderedDict()
+        # Use time per key of the hits that are not written yet
+        self.used = {}
+        # Keys of the files on disk per (file name, modification time)
+        self.file_keys = {}
+        with DatabaseSqlite3(self.url, pool=self.pool) as db:
+            db.create_table("Media", MEDIA_COLUMNS)
+            for key, file_id in db.select("Media", ["key", "file_id"], order_by="used"):
+                self.file_ids[key] = file_id
+        logger.info("Media cache loaded: " + str(len(self.file_ids)) + " file ids")
+
+    def get(self, key):
+        """File id of a photo or None when it wasn't sent yet"""
+        with self.lock:
+            file_id = self.file_ids.get(key)
+            if file_id is None:
+                return None
+            self.file_ids.move_to_end(key)
+            self.used[key] = time.time()
+        return file_id
+
+    def put(self, key, file_id):
+        """Remember the file id of a photo, evicts the least recently used beyond capacity"""
+        with self.lock:
+            self.file_ids[key] = file_id
+            self.file_ids.move_to_end(key)
+            self.used.pop(key, None)
+            evicted = []
+            while len(self.file_ids) > self.capacity:
+                evicted.append(self.file_ids.popitem(last=False)[0])
+        self.write([("INSERT OR REPLACE INTO Media (key, file_id, used) VALUES (?, ?, ?)", (key, file_id, time.time()))]
+            + [("DELETE FROM Media WHERE key = ?", (evicted_key,)) for evicted_key in evicted])
+
+    def forget(self, key):
+        with self.lock:
+            self.file_ids.pop(key, None)
+        self.write([("DELETE FROM Media WHERE key = ?", (key,))])
+
+    def flush(self):
+        """Write the use times of the hits"""
+        self.write([])
+
+    def write(self, statements):
+        """Run statements in one transaction together with the use times of the hits since the last write"""
+        with self.lock:
+            used = [(used, key) for key, used in self.used.items() if key in self.file_ids]
+            self.used = {}
+        if not statements and not used:
+            return
+        try:
+            with DatabaseSqlite3(self.url, pool=self.pool) as db:
+                with db.transaction():
+                    if used:
+                        db.cursor.executemany("UPDATE Media SET used = ? WHERE key = ?", used)
+                    for query, params in statements:
+                        db.cursor.execute(query, params)
+        except Exception as e:
+            logger.error("Unable to write the media cache")
+            logger.error(e)
+
+    def file_key(self, file_name):
+        """Key of a photo file, hashed again when the file changed"""
+        stamp = (file_name, os.path.getmtime(file_name))
+        key = self.file_keys.get(stamp)
+        if key is None:
+            with open(file_name, "rb") as f:
+                key = content_key(f.read())
+            self.file_keys[stamp] = key
+        return key
+
+    def reply_photo(self, message, key, photo, **kwargs):
+        """
+        Reply with a photo, by file id when it was sent before. photo is called to get
+        the bytes or file to upload otherwise, the file id Telegram gives is kept.
+        """
+        file_id = self.get(key)
+        if file_id is not None:
+            try:
+                return message.reply_photo(file_id, **kwargs)
+            except BadRequest as e:
+                logger.error("Unable to send photo " + key + " by file id, it is uploaded again")
+                logger.error(e)
+                self.forget(key)
+        sent = message.reply_photo(photo(), **kwargs)
+        if sent is not None and sent.photo:
+            self.put(key, sent.photo[-1].file_id)
+        return sent
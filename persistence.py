@@ -0,0 +1,173 @@
+"""
+Persistence of the Telegram bots in a sqlite database. Every conversation state,
+user_data, chat_data and the bot_data is a row of its own, only the rows that
+changed are written, together every flush interval. What a transition costs
+depends on what changed, not on how many chats the store holds.
+"""
+import os
+import json
+import atexit
+import pickle
+import logging
+import threading
+from collections import defaultdict
+
+from telegram.ext import BasePersistence
+
+from DatabaseSqlite3 import DatabaseSqlite3
+
+logger = logging.getLogger(__name__)
+
+# Seconds between two writes of the changed rows
+FLUSH_INTERVAL = 5.0
+
+PERSISTENCE_COLUMNS = [["key", "value"], ["TEXT", "BLOB"], ["PRIMARY KEY NOT NULL", ""]]
+
+def conversation_key(name, key):
+    return "conversation:" + name + ":" + json.dumps(list(key))
+
+class SqlitePersistence(BasePersistence):
+    """
+    BasePersistence on keyed rows of the Persistence table of a sqlite database.
+    The data is loaded once, updates that change nothing are ignored and the others
+    mark their key dirty. Dirty keys are written every interval seconds by a background
+    thread, right away with interval 0, and by flush when the bot stops.
+    migrate is the file of a PicklePersistence, its data is taken over into an empty store.
+    """
+    def __init__(self, url, pool=None, interval=FLUSH_INTERVAL, migrate=None, store_user_data=True, store_chat_data=True, store_bot_data=True):
+        super().__init__(store_user_data=store_user_data, store_chat_data=store_chat_data, store_bot_data=store_bot_data)
+        self.url = url
+        self.pool = pool
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.dirty = {}
+        self.blobs = {}
+        self.load()
+        if not self.blobs and migrate is not None and os.path.exists(migrate):
+            self.migrate(migrate)
+        self.running = True
+        self.wake = threading.Event()
+        self.thread = None
+        if interval > 0:
+            self.thread = threading.Thread(target=self.run, name="persistence", daemon=True)
+            self.thread.start()
+        atexit.register(self.close)
+
+    def load(self):
+        """Read every row, the values are unpickled when the dispatcher asks for them"""
+        with DatabaseSqlite3(self.url, pool=self.pool) as db:
+            db.create_table("Persistence", PERSISTENCE_COLUMNS)
+            for key, value in db.select("Persistence", ["key", "value"]):
+                self.blobs[key] = value
+        logger.info("Persistence loaded: " + str(len(self.blobs)) + " rows")
+
+    def migrate(self, file_name):
+        try:
+            with open(file_name, "rb") as f:
+                data = pickle.load(f)
+        except Exception as e:
+            logger.error("Unable to migrate persistence file " + file_name)
+            logger.error(e)
+            return
+        for name, conversations in data.get("conversations", {}).items():
+            for key, state in conversations.items():
+                self.update_conversation(name, key, state)
+        for user_id, user_data in data.get("user_data", {}).items():
+            self.update_user_data(user_id, user_data)
+        for chat_id, chat_data in data.get("chat_data", {}).items():
+            self.update_chat_data(chat_id, chat_data)
+        if data.get("bot_data"):
+            self.update_bot_data(data["bot_data"])
+        logger.info("Persistence migrated from " + file_name + ": " + str(len(self.dirty)) + " rows")
+        self.flush()
+
+    def values(self, prefix):
+        """Unpickled values of the rows with a key prefix, per the rest of the key"""
+        values = {}
+        for key, blob in self.blobs.items():
+            if key.startswith(prefix):
+                try:
+                    values[key[len(prefix):]] = pickle.loads(blob)
+                except Exception as e:
+                    logger.error("Unable to read persisted " + key)
+                    logger.error(e)
+        return values
+
+    def mark(self, key, value):
+        """Mark key dirty when value differs from what is stored, None deletes the row"""
+        blob = None if value is None else pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        with self.lock:
+            if self.blobs.get(key) == blob:
+                return
+            if blob is None:
+                del self.blobs[key]
+            else:
+                self.blobs[key] = blob
+            self.dirty[key] = blob
+        if self.interval <= 0:
+            self.flush()
+
+    ### BASEPERSISTENCE ###
+
+    def get_conversations(self, name):
+        prefix = "conversation:" + name + ":"
+        return {tuple(json.loads(key)): state for key, state in self.values(prefix).items()}
+
+    def update_conversation(self, name, key, new_state):
+        self.mark(conversation_key(name, key), new_state)
+
+    def get_user_data(self):
+        return defaultdict(dict, {int(user_id): data for user_id, data in self.values("user_data:").items()})
+
+    def update_user_data(self, user_id, data):
+        self.mark("user_data:" + str(user_id), data)
+
+    def get_chat_data(self):
+        return defaultdict(dict, {int(chat_id): data for chat_id, data in self.values("chat_data:").items()})
+
+    def update_chat_data(self, chat_id, data):
+        self.mark("chat_data:" + str(chat_id), data)
+
+    def get_bot_data(self):
+        return self.values("bot_data:").get("", {})
+
+    def update_bot_data(self, data):
+        self.mark("bot_data:", data)
+
+    def flush(self):
+        """Write the dirty rows in one transaction"""
+        with self.lock:
+            dirty = self.dirty
+            self.dirty = {}
+        if not dirty:
+            return
+        try:
+            with DatabaseSqlite3(self.url, pool=self.pool) as db:
+                with db.transaction():
+                    for key, blob in dirty.items():
+                        if blob is None:
+                            db.cursor.execute("DELETE FROM Persistence WHERE key = ?", (key,))
+                        else:
+                            db.cursor.execute("INSERT OR REPLACE INTO Persistence (key, value) VALUES (?, ?)", (key, blob))
+        except Exception as e:
+            logger.error("Unable to write " + str(len(dirty)) + " persistence rows")
+            logger.error(e)
+            # Written with the next flush, unless they changed again meanwhile
+            with self.lock:
+                for key, blob in dirty.items():
+                    self.dirty.setdefault(key, blob)
+
+    def run(self):
+        while self.running:
+            self.wake.wait(self.interval)
+            self.flush()
+
+    def close(self):
+        """Stop the background thread and write what is left"""
+        if not self.running:
+            return
+        self.running = False
+        self.wake.set()
+        if self.thread is not None:
+            self.thread.join()
+        self.flush()
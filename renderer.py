@@ -0,0 +1,167 @@
+"""
+Board of a game as a picture: the claimed routes in the colors of their owners and
+the stations drawn over the board image. The board image is the base layer, shared
+by the games of a map. Routes and stations of a game are drawn on a layer of their
+own, after a claim only the segment of that route is drawn and composed again.
+The picture is encoded as JPEG, Telegram recompresses photos to JPEG anyway and
+encoding the whole board as PNG took far longer than drawing a claim. The JPEG
+and its hash are kept until the board version of the game state changes.
+"""
+import io
+import os
+import math
+import hashlib
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+# RGB of the player colors of the pieces
+PLAYER_COLORS = {
+    "blue": (30, 110, 220),
+    "red": (215, 35, 35),
+    "green": (40, 160, 60),
+    "yellow": (240, 200, 20),
+    "black": (30, 30, 30),
+}
+UNKNOWN_COLOR = (128, 128, 128)
+OUTLINE = (0, 0, 0, 220)
+
+ROUTE_WIDTH = 5
+# Distance between the routes of a double route and the part of a route hidden under its cities
+ROUTE_SPACING = 7
+CITY_RADIUS = 8
+STATION_RADIUS = 7
+# Quality of the JPEG of the board, the lines and city names stay sharp
+JPEG_QUALITY = 90
+
+# Base layers per board image file
+bases = {}
+
+def pil():
+    """
+    The Image and ImageDraw modules of Pillow, imported on first use. Only the board
+    needs them, without Pillow the plain board image is sent. None when not installed.
+    """
+    try:
+        from PIL import Image, ImageDraw
+    except ImportError as e:
+        logger.error("Drawing the board needs Pillow, it is not installed")
+        logger.error(e)
+        return None
+    return Image, ImageDraw
+
+def base_layer(file_name):
+    base = bases.get(file_name)
+    if base is None:
+        Image, ImageDraw = pil()
+        with Image.open(file_name) as image:
+            base = image.convert("RGBA")
+        bases[file_name] = base
+    return base
+
+class BoardRenderer():
+    """
+    Draws the board of a game state. board is the board of the map pack, the city
+    positions indexed by city id, and directory the directory of its image.
+    """
+    def __init__(self, state, board, directory):
+        self.state = state
+        self.cities = board["cities"]
+        self.file_name = os.path.join(directory, board["image"])
+        self.lock = threading.RLock()
+        self.layer = None
+        self.composed = None
+        self.routes = {}
+        self.stations = {}
+        self.version = None
+        self.photo = None
+        self.digest = None
+
+    def segment(self, route):
+        """End points of the line of a route, the routes of a double route lie next to each other"""
+        x1, y1 = self.cities[route["city1"]]
+        x2, y2 = self.cities[route["city2"]]
+        length = math.hypot(x2 - x1, y2 - y1) or 1
+        dx, dy = (x2 - x1) / length, (y2 - y1) / length
+        parallel = sorted([route["id"]] + self.state.siblings.get(route["id"], []))
+        offset = (parallel.index(route["id"]) - (len(parallel) - 1) / 2) * ROUTE_SPACING
+        # Perpendicular to the route, the same side for both routes whatever their city order
+        if (x1, y1) > (x2, y2):
+            offset = -offset
+        ox, oy = -dy * offset, dx * offset
+        return (x1 + dx * CITY_RADIUS + ox, y1 + dy * CITY_RADIUS + oy), (x2 - dx * CITY_RADIUS + ox, y2 - dy * CITY_RADIUS + oy)
+
+    def color(self, colors, owner):
+        return PLAYER_COLORS.get(colors.get(owner), UNKNOWN_COLOR)
+
+    def draw_route(self, draw, route, owner, colors):
+        """Draw a route on the layer, returns the box it covers"""
+        start, end = self.segment(route)
+        draw.line([start, end], fill=OUTLINE, width=ROUTE_WIDTH + 2)
+        draw.line([start, end], fill=self.color(colors, owner) + (255,), width=ROUTE_WIDTH)
+        margin = ROUTE_WIDTH + 2
+        return (int(min(start[0], end[0]) - margin), int(min(start[1], end[1]) - margin), int(max(start[0], end[0]) + margin) + 1, int(max(start[1], end[1]) + margin) + 1)
+
+    def draw_station(self, draw, city_id, owner, colors):
+        """Draw a station on the layer, returns the box it covers"""
+        x, y = self.cities[city_id]
+        box = (x - STATION_RADIUS, y - STATION_RADIUS, x + STATION_RADIUS, y + STATION_RADIUS)
+        draw.ellipse(box, fill=self.color(colors, owner) + (255,), outline=OUTLINE, width=2)
+        return (box[0] - 1, box[1] - 1, box[2] + 2, box[3] + 2)
+
+    def render(self):
+        """JPEG of the board as bytes, None without Pillow"""
+        with self.lock:
+            if self.version == self.state.board_version:
+                return self.photo
+            if pil() is None:
+                return None
+            Image, ImageDraw = pil()
+            with self.state.lock:
+                version = self.state.board_version
+                routes = {route_id: route["owner"] for route_id, route in self.state.routes.items() if route["owner"]}
+                stations = dict(self.state.stations)
+                colors = {chat_id: player["color"] for chat_id, player in self.state.players.items()}
+
+            base = base_layer(self.file_name)
+            # Something was taken back, only a reload does that: everything is drawn again
+            if self.layer is None or any(routes.get(route_id) != owner for route_id, owner in self.routes.items()) \
+                    or any(stations.get(city_id) != owner for city_id, owner in self.stations.items()):
+                self.layer = Image.new("RGBA", base.size, (0, 0, 0, 0))
+                self.composed = base.convert("RGB")
+                self.routes = {}
+                self.stations = {}
+
+            draw = ImageDraw.Draw(self.layer)
+            boxes = []
+            for route_id, owner in routes.items():
+                if self.routes.get(route_id) != owner:
+                    boxes.append(self.draw_route(draw, self.state.routes[route_id], owner, colors))
+                    self.routes[route_id] = owner
+            # Stations lie on top, the ones under a new route are drawn again
+            for city_id, owner in stations.items():
+                x, y = self.cities[city_id]
+                if self.stations.get(city_id) != owner or any(box[0] <= x + STATION_RADIUS and x - STATION_RADIUS <= box[2] and box[1] <= y + STATION_RADIUS and y - STATION_RADIUS <= box[3] for box in boxes):
+                    boxes.append(self.draw_station(draw, city_id, owner, colors))
+                    self.stations[city_id] = owner
+
+            for box in boxes:
+                box = (max(box[0], 0), max(box[1], 0), min(box[2], base.size[0]), min(box[3], base.size[1]))
+                if box[0] < box[2] and box[1] < box[3]:
+                    self.composed.paste(Image.alpha_composite(base.crop(box), self.layer.crop(box)).convert("RGB"), box[:2])
+
+            output = io.BytesIO()
+            self.composed.save(output, "JPEG", quality=JPEG_QUALITY)
+            self.photo = output.getvalue()
+            self.digest = hashlib.sha256(self.photo).hexdigest()
+            self.version = version
+            logger.debug("Board drawn, " + str(len(boxes)) + " parts changed")
+            return self.photo
+
+    def picture(self):
+        """(hash, JPEG) of the board, None without Pillow"""
+        with self.lock:
+            if self.render() is None:
+                return None
+            return self.digest, self.photo
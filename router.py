@@ -0,0 +1,57 @@
+"""
+Menu router for the conversation states of the bots. The button texts, their
+aliases and slash commands of a state are keys of one dict, a message is routed
+with one lookup however many actions the menu has.
+"""
+import logging
+
+from telegram.ext import MessageHandler, MessageFilter
+
+logger = logging.getLogger(__name__)
+
+def normalize(text):
+    """Key of a message text: lower case, /command@botname and its arguments reduced to /command"""
+    text = " ".join(text.split()).lower()
+    if text.startswith("/"):
+        text = text.split(" ", 1)[0].split("@", 1)[0]
+    return text
+
+class Router():
+    """
+    Maps button texts, aliases and slash commands to handlers, keys are matched
+    without case and extra spaces. handler() gives the MessageHandler for a
+    conversation state, messages that are no key are left to the other handlers.
+    """
+    def __init__(self):
+        self.routes = {}
+
+    def add(self, text, handler, aliases=(), command=None):
+        """Route a button text, its aliases and /command to handler"""
+        for key in [text] + list(aliases) + (["/" + command] if command else []):
+            key = normalize(key)
+            if key in self.routes and self.routes[key] is not handler:
+                logger.warning("Menu key " + key + " is routed twice, the last handler is used")
+            self.routes[key] = handler
+
+    def route(self, text):
+        """Handler of a message text or None"""
+        if text is None:
+            return None
+        return self.routes.get(normalize(text))
+
+    def dispatch(self, update, context):
+        handler = self.route(update.message.text)
+        if handler is None:
+            return None
+        return handler(update, context)
+
+    def handler(self):
+        return MessageHandler(RouterFilter(self), self.dispatch)
+
+class RouterFilter(MessageFilter):
+    """Lets the messages through that the router has a handler for"""
+    def __init__(self, router):
+        self.router = router
+
+    def filter(self, message):
+        return self.router.route(message.text) is not None
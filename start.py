@@ -2,6 +2,8 @@ import os
 import json
 import random
 
+from eventlog import DocumentLog
+
 def main(numplay, game):
     data = {}
 
@@ -107,6 +109,10 @@ def json_save(data):
         path = os.path.join(os.path.dirname(os.path.abspath(__file__)),'data.json')
         with open(path, 'w') as json_file:
             json_file.write(json.dumps(data, ensure_ascii=False))
+        # The bots keep data.json in an event log, a new game starts a new log
+        documents = DocumentLog(os.path.join(os.path.dirname(path), 'data.eventlog'))
+        documents.reset(data)
+        documents.close()
     except Exception as e:
         print(e)
 
@@ -0,0 +1,123 @@
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, PATH)
+
+from engine import Engine, tunnel_extra_options
+from eventlog import EventLog, DocumentLog
+from mappack import load_config
+
+COLORS = ("red", "blue", "locomotive")
+
+class TunnelExtraOptionsTest(unittest.TestCase):
+    def test_color_locomotives_or_both(self):
+        options = tunnel_extra_options((3, 1, 2), COLORS, "red", 2)
+        self.assertEqual(options, ((("red", 2),), (("red", 1), ("locomotive", 1)), (("locomotive", 2),)))
+
+    def test_locomotives_make_up_for_missing_colors(self):
+        options = tunnel_extra_options((1, 4, 2), COLORS, "red", 3)
+        self.assertEqual(options, ((("red", 1), ("locomotive", 2)),))
+
+    def test_other_colors_dont_pay(self):
+        self.assertEqual(tunnel_extra_options((0, 4, 1), COLORS, "red", 2), ())
+
+    def test_paid_with_locomotives(self):
+        options = tunnel_extra_options((3, 0, 2), COLORS, "locomotive", 1)
+        self.assertEqual(options, ((("locomotive", 1),),))
+
+    def test_no_extra_cards(self):
+        self.assertEqual(tunnel_extra_options((0, 0, 0), COLORS, "red", 0), ((),))
+
+class MoveLogTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.log = EventLog(self.directory, sync=False)
+        self.engine = Engine.simulation(load_config(PATH, "europe"), 1)
+        for chat_id, color in [(1, "blue"), (2, "red")]:
+            self.engine.join(chat_id, str(chat_id), color)
+            self.engine.keep_tickets(self.engine.pending[chat_id][0], chat_id)
+        self.engine.attach(self.log)
+
+    def tearDown(self):
+        self.log.close()
+        shutil.rmtree(self.directory)
+
+    def test_failed_draw_appends_nothing(self):
+        # Not started yet, nobody may draw
+        self.assertIsNone(self.engine.draw_tickets())
+        self.assertEqual(self.log.seq, 0)
+
+    def test_draw_from_empty_stack_appends_nothing(self):
+        self.engine.start()
+        state = self.engine.state
+        with state.unit():
+            for ticket_id in list(state.ticket_pile(None)):
+                state.move_ticket(ticket_id, 0)
+        seq = self.log.seq
+        self.assertIsNone(self.engine.draw_tickets())
+        self.assertEqual(self.log.seq, seq)
+
+    def test_no_op_moves_append_nothing(self):
+        self.engine.reshuffle()
+        seq = self.log.seq
+        # Full market and empty discard pile
+        self.assertIsNone(self.engine.deal_market())
+        self.assertIsNone(self.engine.reshuffle())
+        self.assertEqual(self.log.seq, seq)
+
+    def test_draw_is_logged(self):
+        self.engine.start()
+        seq = self.log.seq
+        self.assertTrue(self.engine.draw_tickets())
+        self.assertEqual(self.log.seq, seq + 1)
+        self.assertEqual(list(self.log.events(seq))[0]["move"], "draw_tickets")
+
+class DocumentLogTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.file_name = os.path.join(self.directory, "data.json")
+        with open(self.file_name, "w") as f:
+            f.write('{"turn": "red", "deck": [1, 2, 3]}')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def open(self, snapshot_every=50):
+        return DocumentLog(os.path.join(self.directory, "data.eventlog"), self.file_name, snapshot_every, sync=False)
+
+    def test_starts_from_the_file(self):
+        documents = self.open()
+        self.assertEqual(documents.load(), {"turn": "red", "deck": [1, 2, 3]})
+        documents.close()
+
+    def test_saves_only_what_changed(self):
+        documents = self.open()
+        data = documents.load()
+        data["turn"] = "blue"
+        del data["deck"]
+        seq = documents.save(data)
+        self.assertEqual(list(documents.log.events())[0]["args"], [{"turn": "blue"}, ["deck"]])
+        self.assertIsNone(documents.save(data))
+        self.assertEqual(documents.log.seq, seq)
+        documents.close()
+
+    def test_reopened_from_snapshot_and_saves(self):
+        documents = self.open(snapshot_every=2)
+        for turn in ["blue", "green", "yellow"]:
+            data = documents.load()
+            data["turn"] = turn
+            documents.save(data)
+        documents.close()
+        # The file is only read by an empty log
+        with open(self.file_name, "w") as f:
+            f.write("{}")
+        documents = self.open(snapshot_every=2)
+        self.assertEqual(documents.load(), {"turn": "yellow", "deck": [1, 2, 3]})
+        documents.close()
+
+if __name__ == "__main__":
+    unittest.main()
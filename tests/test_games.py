@@ -0,0 +1,64 @@
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, PATH)
+
+import mappack
+from games import Games
+
+class LeaseTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.pack = mappack.load(PATH, "europe")
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.games = Games(self.directory, self.pack, capacity=1)
+
+    def tearDown(self):
+        self.games.close()
+        shutil.rmtree(self.directory)
+
+    def test_leased_game_stays_open(self):
+        with self.games.lease("a") as game:
+            self.games.get("b")
+            self.assertIn("a", self.games.open_games)
+        # Closed at the end of the lease, beyond capacity
+        self.assertEqual(list(self.games.open_games), ["a"])
+
+    def test_game_closed_when_released(self):
+        with self.games.lease("a"):
+            with self.games.lease("b"):
+                self.assertEqual(len(self.games.open_games), 2)
+            self.assertEqual(list(self.games.open_games), ["a"])
+        self.assertEqual(self.games.open_games["a"].users, 0)
+
+class EnterTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.games = Games(self.directory, None)
+
+    def tearDown(self):
+        self.games.close()
+        shutil.rmtree(self.directory)
+
+    def test_membership_is_stored(self):
+        self.assertTrue(self.games.enter(1, "a"))
+        self.assertTrue(self.games.enter(1, "b"))
+        self.games.close()
+        self.games = Games(self.directory, None)
+        self.assertEqual(self.games.game_of(1), "b")
+
+    def test_failed_write_keeps_the_route(self):
+        self.assertTrue(self.games.enter(1, "a"))
+        with self.games.lobby() as db:
+            db.delete_table("Membership")
+        self.assertFalse(self.games.enter(1, "b"))
+        self.assertEqual(self.games.game_of(1), "a")
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,269 @@
+import logging
+
+logger = logging.getLogger(__name__)
+
+def longest_trail(edges):
+    """
+    Longest trail, a path that uses every edge at most once, in a connected graph.
+    edges is a dict edge_id: (node1, node2, length).
+    Returns (length, edge ids in the order of the trail).
+
+    A trail that can't be extended ends in a node of odd degree unless it is closed,
+    and a closed one covers the whole component. So with at most two odd nodes the
+    trail is an Euler path over all edges and otherwise it starts in an odd node.
+    A trail never ends halfway a chain of nodes with degree 2, so chains are searched
+    as one edge. The search is a DFS over edges that skips (node, used edges) states
+    it has seen and prunes a branch when all edges it can still reach would not
+    make it longer than the best trail so far.
+    """
+    if not edges:
+        return 0, []
+    chains = contract(edges)
+    lengths = [chain[2] for chain in chains]
+    total = sum(lengths)
+    adjacency = {}
+    for index, (node1, node2, length, path) in enumerate(chains):
+        adjacency.setdefault(node1, []).append((index, node2, length))
+        adjacency.setdefault(node2, []).append((index, node1, length))
+    odd = [node for node, incident in adjacency.items() if len(incident) % 2 == 1]
+
+    if len(odd) <= 2:
+        start = odd[0] if odd else chains[0][0]
+        return total, expand(chains, start, euler_trail(adjacency, start, len(chains)))
+
+    # Longest edges first, so a long trail is found early and prunes the rest
+    for incident in adjacency.values():
+        incident.sort(key=lambda item: item[2], reverse=True)
+
+    def bound(node, used):
+        """
+        Upper bound of a trail from node over the unused edges: the edges it can reach,
+        minus the shortest edges it has to leave out because of their odd nodes.
+        """
+        seen = {node}
+        stack = [node]
+        lengths = []
+        cheapest = []
+        start_cheapest = 0
+        start_odd = 0
+        while stack:
+            current = stack.pop()
+            degree = 0
+            shortest = None
+            for index, other, edge_length in adjacency[current]:
+                bit = 1 << index
+                if used & bit:
+                    continue
+                degree += 1
+                if other not in seen:
+                    seen.add(other)
+                    stack.append(other)
+                lengths.append(edge_length)
+                if shortest is None or edge_length < shortest:
+                    shortest = edge_length
+            if current == node:
+                start_odd = degree % 2
+                start_cheapest = shortest or 0
+            elif degree % 2:
+                cheapest.append(shortest)
+        # Every edge was counted from both of its nodes
+        total = sum(lengths) // 2
+        # Every odd node that is not an end of the trail keeps an edge out of it, an
+        # edge that is left out serves two nodes at most. The start node is only an
+        # end that stays odd when it is odd already, the other end can be any node.
+        cheapest.sort()
+        if cheapest:
+            end = cheapest.pop()
+            if not start_odd:
+                cheapest.append(min(end, start_cheapest))
+        return total - (sum(cheapest) + 1) // 2
+
+    best = [0, None, []]
+    visited = set()
+    path = []
+
+    def search(node, used, length):
+        # The used edges fix the length, so a (node, used) state is only worth one visit
+        if (node, used) in visited:
+            return
+        visited.add((node, used))
+        if length > best[0]:
+            best[0], best[1], best[2] = length, start, list(path)
+        if best[0] == total or length + bound(node, used) <= best[0]:
+            return
+        for index, other, edge_length in adjacency[node]:
+            bit = 1 << index
+            if used & bit:
+                continue
+            path.append(index)
+            search(other, used | bit, length + edge_length)
+            path.pop()
+
+    for start in odd:
+        search(start, 0, 0)
+        if best[0] == total:
+            break
+    return best[0], expand(chains, best[1], best[2])
+
+def contract(edges):
+    """
+    Replace every chain through nodes of degree 2 by one edge.
+    Returns a list of (node1, node2, length, edge ids from node1 to node2).
+    """
+    incident = {}
+    for edge_id, (node1, node2, length) in edges.items():
+        incident.setdefault(node1, []).append(edge_id)
+        incident.setdefault(node2, []).append(edge_id)
+    chains = []
+    done = set()
+
+    def walk(node, edge_id):
+        """Follow a chain from node over edge_id up to a node with another degree"""
+        path = []
+        length = 0
+        while True:
+            done.add(edge_id)
+            path.append(edge_id)
+            node1, node2, edge_length = edges[edge_id]
+            length += edge_length
+            node = node2 if node == node1 else node1
+            if len(incident[node]) != 2:
+                return node, length, path
+            next_edge = incident[node][0] if incident[node][1] == edge_id else incident[node][1]
+            if next_edge in done:
+                return node, length, path
+            edge_id = next_edge
+
+    for node, edge_ids in incident.items():
+        if len(edge_ids) == 2:
+            continue
+        for edge_id in edge_ids:
+            if edge_id not in done:
+                end, length, path = walk(node, edge_id)
+                chains.append((node, end, length, path))
+    # What is left are cycles of nodes with degree 2
+    for edge_id in edges:
+        if edge_id not in done:
+            node = edges[edge_id][0]
+            end, length, path = walk(node, edge_id)
+            chains.append((node, end, length, path))
+    return chains
+
+def expand(chains, start, trail):
+    """Edge ids of a trail over chains that starts in start"""
+    edge_ids = []
+    node = start
+    for index in trail:
+        node1, node2, length, path = chains[index]
+        if node == node1:
+            edge_ids += path
+            node = node2
+        else:
+            edge_ids += reversed(path)
+            node = node1
+    return edge_ids
+
+def euler_trail(adjacency, start, amount):
+    """Edge indexes of an Euler trail from start with Hierholzer's algorithm"""
+    used = [False] * amount
+    position = {node: 0 for node in adjacency}
+    stack = [(start, None)]
+    trail = []
+    while stack:
+        node, edge = stack[-1]
+        incident = adjacency[node]
+        while position[node] < len(incident) and used[incident[position[node]][0]]:
+            position[node] += 1
+        if position[node] == len(incident):
+            stack.pop()
+            if edge is not None:
+                trail.append(edge)
+        else:
+            index, other, length = incident[position[node]]
+            used[index] = True
+            stack.append((other, index))
+    trail.reverse()
+    return trail
+
+class LongestRoutes():
+    """
+    Longest continuous route of every player, kept up to date per claimed route.
+    Every player has the connected components of its routes, a claim only merges
+    the components of the two cities of the route and searches that component again.
+    """
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        self.components = {}
+        self.best = {}
+
+    def rebuild(self, routes):
+        """Compute everything from scratch, routes are the route dicts of the game state"""
+        self.clear()
+        for route in routes.values():
+            if route["owner"]:
+                self.claim(route)
+
+    def claim(self, route):
+        """Add a claimed route to its owner, returns the new longest route length of the owner"""
+        owner = route["owner"]
+        components = self.components.setdefault(owner, {})
+        first = components.get(route["city1"])
+        second = components.get(route["city2"])
+        if first is None and second is None:
+            component = {"nodes": set(), "edges": {}, "length": 0, "trail": []}
+        elif first is None or second is None or first is second:
+            component = first if second is None else second
+        else:
+            # Merge the smaller component into the bigger one
+            component, other = (first, second) if len(first["edges"]) >= len(second["edges"]) else (second, first)
+            component["nodes"] |= other["nodes"]
+            component["edges"].update(other["edges"])
+            for node in other["nodes"]:
+                components[node] = component
+        component["edges"][route["id"]] = (route["city1"], route["city2"], route["distance"])
+        for node in (route["city1"], route["city2"]):
+            component["nodes"].add(node)
+            components[node] = component
+        component["length"], component["trail"] = longest_trail(component["edges"])
+
+        best = self.best.get(owner)
+        if best is None or component["length"] > best["length"]:
+            self.best[owner] = component
+        elif best is not component and best["nodes"] & component["nodes"]:
+            # The best component got merged into this one
+            self.best[owner] = component
+        return self.best[owner]["length"]
+
+    def length(self, owner):
+        """Longest route length of a player"""
+        best = self.best.get(owner)
+        return best["length"] if best is not None else 0
+
+    def trail(self, owner):
+        """Route ids of the longest route of a player, in order"""
+        best = self.best.get(owner)
+        return list(best["trail"]) if best is not None else []
+
+    def cities(self, owner):
+        """Nodes along the longest route of a player"""
+        best = self.best.get(owner)
+        if best is None or not best["trail"]:
+            return []
+        edges = best["edges"]
+        node1, node2, length = edges[best["trail"][0]]
+        if len(best["trail"]) > 1 and node1 in edges[best["trail"][1]][:2] and node2 not in edges[best["trail"][1]][:2]:
+            node1, node2 = node2, node1
+        nodes = [node1]
+        for edge_id in best["trail"]:
+            node1, node2, length = edges[edge_id]
+            nodes.append(node2 if nodes[-1] == node1 else node1)
+        return nodes
+
+    def leaders(self):
+        """Players with the longest route, an empty list when nobody has a route"""
+        longest = max([best["length"] for best in self.best.values()], default=0)
+        if longest < 1:
+            return []
+        return [owner for owner, best in self.best.items() if best["length"] == longest]
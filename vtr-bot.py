@@ -1,12 +1,18 @@
+import io
 import os
 import json
-import random
 import logging
-import requests
+import threading
 from telegram import (ReplyKeyboardMarkup, ReplyKeyboardRemove)
-from telegram.ext import (Updater, CommandHandler, MessageHandler, Filters, ConversationHandler, PicklePersistence)
+from telegram.ext import (Updater, CommandHandler, MessageHandler, Filters, ConversationHandler)
 
-from DatabaseSqlite3 import DatabaseSqlite3
+from broadcaster import Broadcaster
+from router import Router
+from games import Games, valid_game_id, DEFAULT_GAME, CAPACITY, IDLE_SECONDS
+from persistence import SqlitePersistence, FLUSH_INTERVAL
+from mediacache import MediaCache, CAPACITY as MEDIA_CAPACITY
+from gamestate import OWNER_MARKET
+import mappack
 
 # Enable logging
 logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
@@ -31,194 +37,16 @@ class VTR_BOT():
             logger.critical("File Not found: config.json")
             exit()
 
-        ### Initialize database
-        self.url = config["database"]["url"]
-        self.db = DatabaseSqlite3(self.url, True)
         self.map_name = map_name
 
         ### Initialize Game configuration
-        # Check if all cards are present:
-        cards = self.db.get_data_table("Card", self.db.card_columns, "id > 0")
-
-        present = False
-        train_cards = {}
-        for train_card_config in os.listdir(os.path.join(self.path, "train_cards")):
-            if map_name in train_card_config:
-                try:
-                    train_cards = json.load(open(os.path.join(self.path, "train_cards", train_card_config)))
-                    present = True
-                except Exception as e:
-                    logger.error(e)
-
-        if not present:
-            logger.critical("No train_cards config file found for this map_name")
+        pack = mappack.load(self.path, map_name)
+        if pack is None:
+            logger.critical("No valid config files found for this map_name")
             exit()
-        
-        amount_cards = 0
-        for color in train_cards:
-            amount_cards += color["cards"]
-
-        if len(cards) is not amount_cards:
-            self.db.delete_table("Card")
-            self.db.create_table("Card", self.db.card_columns)
-            deck =  []
-            for card in train_cards:
-                for i in range(0,card["cards"]):
-                    deck.append(card["color"])
-            random.shuffle(deck)
-            insert_data = []
-            for card in deck:
-                new_tuple = (card, 0)
-                insert_data.append(new_tuple)
-
-            self.db.insert_data_table("Card", [["color", "owner"]], insert_data)
-
-        logger.info("Card Table OK")
-
-        # Check if market cards are set
-        market = self.db.get_data_table("Card", self.db.card_columns, "owner = 1")
-        if len(market) is not 5:
-            self.db.update_data_table("Card", {"owner":0}, "owner = 1")
-            available_cards = self.db.get_data_table("Card", self.db.card_columns, "owner = 0")
-            i = 0
-            while i < 5:
-                self.db.update_data_table("Card", {"owner":1}, "id = " + str(available_cards[i][0]))
-                i += 1
-
-        logger.info("Market OK")
-
-        # Check if cities and routes are present:
-        cities = self.db.get_data_table("City", self.db.city_columns, "id > 0")
-
-        present = False
-        map_data = {}
-        for map_config in os.listdir(os.path.join(self.path, "maps")):
-            if map_name in map_config:
-                try:
-                    map_data = json.load(open(os.path.join(self.path, "maps", map_config)))
-                    present = True
-                except Exception as e:
-                    logger.error(e)
-
-        if not present:
-            logger.critical("No maps config file found for this map_name")
-            exit()
-
-        # Check if cities and connections cities are the same. 
-        cities_check = map_data["cities"]
-        check = []
-        for route in map_data["connections"]:
-            check.append(route["city1"])
-            check.append(route["city2"])
-
-        check = set(check)
-        check = list(check)
-
-        cities_check.sort()
-        check.sort()
-        if set(cities_check) == set(check):
-            logger.info("Cities and cities in routes match")
-        else:
-            logger.critical("Cities and cities in routes don't match")
-            exit()
-
-        if len(cities) is not len(map_data["cities"]):
-            self.db.delete_table("City")
-            self.db.create_table("City", self.db.city_columns)
-            insert_data = []
-            for city in map_data["cities"]:
-                insert_data.append((city, None))
-            self.db.insert_data_table("City", [["name","station"]], insert_data)
-
-        logger.info("City table OK")
-
-        routes = self.db.get_data_table("Route", self.db.route_columns, "id > 0")
-        if len(routes) is not len(map_data["connections"]):
-            self.db.delete_table("Route")
-            self.db.create_table("Route", self.db.route_columns)
-            insert_data = []
-            for route in map_data["connections"]:
-                city1 = self.db.get_data_table("City", [["id"]], "name LIKE '" + str(route["city1"]) + "'")
-                city2 = self.db.get_data_table("City", [["id"]], "name LIKE '" + str(route["city2"]) + "'")
-                tunnel = 0
-                if route["tunnel"]:
-                    tunnel = 1
-                insert_data.append((city1[0][0], city2[0][0], route["color"], route["distance"], route["locomotives"], tunnel, 0))
-            self.db.insert_data_table("Route", [["city1","city2","color","distance","locomotives","tunnel","owner"]], insert_data)
-
-        logger.info("Route table OK")
-
-        # check if tickets are present
-
-        tickets = self.db.get_data_table("Ticket", self.db.ticket_columns, "id > 0")
-
-        present = False
-        ticket_data = {}
-        for ticket_config in os.listdir(os.path.join(self.path, "ticket_cards")):
-            if map_name in ticket_config:
-                try:
-                    ticket_data = json.load(open(os.path.join(self.path, "ticket_cards", ticket_config)))
-                    present = True
-                except Exception as e:
-                    logger.error(e)
-
-        if not present:
-            logger.critical("No tickets config file found for this map_name")
-            exit()
-
-        # check if ticket cities correspond to cities
-        # check = []
-        # for ticket in ticket_data["normal"]:
-        #     check.append(ticket["city1"])
-        #     check.append(ticket["city2"])
-
-        # check = set(check)
-        # check = list(check)
-
-        # check.sort()
-        # if set(cities_check) == set(check):
-        #     logger.info("Cities and cities in tickets match")
-        # else:
-        #     logger.critical("Cities and cities in tickets don't match")
-        #     exit()
-
-        tickets = self.db.get_data_table("Ticket", self.db.ticket_columns, "id > 0")
-        if len(tickets) is not (len(ticket_data["normal"]) + len(ticket_data["special"])):
-            self.db.delete_table("Ticket")
-            self.db.create_table("Ticket", self.db.ticket_columns)
-            insert_data = []
-            random.shuffle(ticket_data["normal"])
-            for ticket in ticket_data["normal"]:
-                city1 = self.db.get_data_table("City", [["id"]], "name LIKE '" + str(ticket["city1"]) + "'")
-                city2 = self.db.get_data_table("City", [["id"]], "name LIKE '" + str(ticket["city2"]) + "'")
-                insert_data.append((city1[0][0], city2[0][0], ticket["value"], 0, None))
-            random.shuffle(ticket_data["special"])
-            for ticket in ticket_data["special"]:
-                city1 = self.db.get_data_table("City", [["id"]], "name LIKE '" + str(ticket["city1"]) + "'")
-                city2 = self.db.get_data_table("City", [["id"]], "name LIKE '" + str(ticket["city2"]) + "'")
-                insert_data.append((city1[0][0], city2[0][0], ticket["value"], 1, None))
-            self.db.insert_data_table("Ticket", [["city1","city2","value","special","owner"]], insert_data)
-        
-        logger.info("Ticket table OK")
-
-        # check turn table for all players
-        ### TO DO
 
         # Get game parameters
-        present = False
-        game = {}
-        for game_config in os.listdir(os.path.join(self.path, "game")):
-            if map_name in game_config:
-                try:
-                    game = json.load(open(os.path.join(self.path, "game", game_config)))
-                    present = True
-                except Exception as e:
-                    logger.error(e)
-
-        if not present:
-            logger.critical("No game config file found for this map_name")
-            exit()
-
+        game = pack["game"]
         self.nbr_players_for_single_route = game["single_where_double"]
         self.longest_route_active = game["longest_route"]
         self.schips_active = game["schips"]
@@ -228,19 +56,7 @@ class VTR_BOT():
         self.turns_left = game["turns_left"]
 
         # Set game pieces
-        present = False
-        pieces = {}
-        for pieces_config in os.listdir(os.path.join(self.path, "pieces")):
-            if map_name in pieces_config:
-                try:
-                    pieces = json.load(open(os.path.join(self.path, "pieces", pieces_config)))
-                    present = True
-                except Exception as e:
-                    logger.error(e)
-
-        if not present:
-            logger.critical("No pieces config file found for this map_name")
-            exit()
+        pieces = pack["pieces"]
         self.colors_players = []
         self.amount_trains = pieces[0]["trains"]
 
@@ -249,37 +65,65 @@ class VTR_BOT():
         if self.stations_active:
             self.amount_stations = game["stations"]["amount"]
 
+        ### Games are opened on first use, every chat plays in the game it joined
+        database = config["database"]
+        self.local = threading.local()
+        self.games = Games(database.get("games", os.path.join(self.path, "games")), pack, database["url"], os.path.join(self.path, "eventlog"),
+            database.get("capacity", CAPACITY), database.get("idle_seconds", IDLE_SECONDS), self.opened, os.path.join(self.path, "board"))
+
+        # File ids of the board photos that were sent, a board is uploaded once
+        self.media = MediaCache(self.games.lobby_url, self.games.lobby_pool, config.get("media", {}).get("capacity", MEDIA_CAPACITY))
+
         self.token = config["telegram"]["token"]
+        self.broadcaster = Broadcaster(self.token)
         
         # Initialize Telegram bot
-        pp = PicklePersistence(filename="bobbieventianbot")
+        # Conversations and user_data are rows of the lobby database, the old pickle file is taken over once
+        pp = SqlitePersistence(self.games.lobby_url, self.games.lobby_pool, config.get("persistence", {}).get("interval", FLUSH_INTERVAL), migrate="bobbieventianbot")
         updater = Updater(self.token, persistence= pp, use_context=True)
         dp = updater.dispatcher
 
+        # Menus are routed with one lookup, the colors are the ones of the pieces
+        self.colors_router = Router()
+        for color in self.colors_players:
+            self.colors_router.add(color, self.routed(self.add))
+        self.options_router = Router()
+        for text, handler, aliases, command in [
+            ("Get Market Card", self.choose_market, ["Market Card", "Draw"], "draw"),
+            ("Build Route", self.build_route, ["Route"], "route"),
+            ("Build Station", self.build_station, ["Station"], "station"),
+            ("Get New Tickets", self.choose_tickets, ["Tickets"], "tickets"),
+            ("Deck", self.deck, ["Cards", "Hand"], "deck"),
+            ("Market", self.market, [], "market"),
+            ("Overview", self.overview, [], "overview"),
+            ("Map", self.map, ["Board"], "map"),
+            ("Routes", self.all_routes, ["All Routes"], "routes"),
+            ("City", self.city_information, ["Cities"], "city"),
+            ("Your Routes", self.your_routes, ["My Routes"], "myroutes"),
+            ("Longest Route", self.longest_route, ["Longest"], "longest"),
+            ("Points", self.points, ["Score", "Scores"], "points"),
+            ("Help", self.help, [], "help"),
+            ("Next Turn", self.next_turn_hehe, ["End Turn"], "next")]:
+            self.options_router.add(text, self.routed(handler), aliases, command)
+
         option_handler = ConversationHandler(
-            entry_points=[CommandHandler("start", self.start)],
+            entry_points=[CommandHandler("start", self.routed(self.start))],
             states = {
-                SELECTION: [MessageHandler(Filters.regex("^(yellow|black|red|green|blue)$"), self.add),],
-                OPTIONS: [MessageHandler(Filters.regex("^(Get Market Card)$"), self.choose_market), MessageHandler(Filters.regex("^(Build Route)$"), self.build_route),
-                MessageHandler(Filters.regex("^(Build Station)$"), self.build_station), MessageHandler(Filters.regex("^(Get New Tickets)$"), self.choose_tickets),
-                MessageHandler(Filters.regex("^(Deck)$"), self.deck), MessageHandler(Filters.regex("^(Market)$"), self.market),
-                MessageHandler(Filters.regex("^(Overview)$"), self.overview), MessageHandler(Filters.regex("^(Map)$"), self.map),
-                MessageHandler(Filters.regex("^(Routes)$"), self.all_routes), MessageHandler(Filters.regex("^(City)$"), self.city_information),
-                MessageHandler(Filters.regex("^(Your Routes)$"), self.your_routes), MessageHandler(Filters.regex("^(Longest Route)$"), self.longest_route),
-                MessageHandler(Filters.regex("^(Points)$"), self.points), MessageHandler(Filters.regex("^(Help)$"), help), MessageHandler(Filters.regex("^(Next Turn)$"), self.next_turn_hehe)],
-                CITY: [MessageHandler(Filters.text, self.pick_city),],
-                MARKET: [MessageHandler(Filters.text, self.pick_market),],
-                TICKET : [MessageHandler(Filters.text, self.pick_ticket),],
-                ROUTE : [MessageHandler(Filters.text, self.pick_route),],
-                CARDS : [MessageHandler(Filters.text, self.pick_cards),],
+                SELECTION: [self.colors_router.handler(),],
+                OPTIONS: [self.options_router.handler(),],
+                CITY: [MessageHandler(Filters.text, self.routed(self.pick_city)),],
+                MARKET: [MessageHandler(Filters.text, self.routed(self.pick_market)),],
+                TICKET : [MessageHandler(Filters.text, self.routed(self.pick_ticket)),],
+                ROUTE : [MessageHandler(Filters.text, self.routed(self.pick_route)),],
+                CARDS : [MessageHandler(Filters.text, self.routed(self.pick_cards)),],
             },
-            fallbacks = [MessageHandler(Filters.regex("^Done$"), self.start)],
+            fallbacks = [MessageHandler(Filters.regex("^Done$"), self.routed(self.start))],
             name = "ticket_to_ride",
             persistent= True
         )
 
         dp.add_handler(option_handler)
-        dp.add_handler(CommandHandler('gogogo', self.start_game))
+        dp.add_handler(CommandHandler('gogogo', self.routed(self.start_game)))
 
         # log all errors
         dp.add_error_handler(self.error)
@@ -289,87 +133,82 @@ class VTR_BOT():
 
         updater.idle()
 
-
-    def available_colors(self, db):
+        self.broadcaster.close()
+        self.media.flush()
+        self.games.close()
+
+    @property
+    def state(self):
+        """GameState of the game of the chat that is handled"""
+        return self.local.game.state
+
+    @property
+    def engine(self):
+        """Engine of the game of the chat that is handled"""
+        return self.local.game.engine
+
+    def opened(self, game):
+        game.engine.on_turn = self.announce_turn
+        game.engine.on_reshuffle = self.announce_reshuffle
+
+    def routed(self, handler):
+        """Handler that runs on the game of the chat of the update"""
+        def route(update, context):
+            with self.games.for_chat(update.message.chat_id) as game:
+                self.local.game = game
+                return handler(update, context)
+        return route
+
+    def available_colors(self):
         """Check which colors are still available"""
         available_colors = []
-        p_colors = self.colors_players
-        players = db.get_data_table("Player", [["chat_id", "color"]], "color IS NOT NULL")
-        for player in players:
-            p_colors.remove(player[1])
+        p_colors = list(self.colors_players)
+        for player in self.state.active_players():
+            p_colors.remove(player["color"])
         for c in p_colors:
             available_colors.append([c])
         #available_colors.append(["spectator"])
         return available_colors
 
-    def assign_cards(self, db, id, color=None, amount=1):
-        """assigns an amount of cards to a player or market"""
-        assigned_cards = []
-        if color is None:
-            available_cards = db.get_data_table("Card", [["id"]], "owner = 0")
-            if len(available_cards) < amount:
-                db.update_data_table("Card", {"owner": 0}, "id = 2")
-                logger.info("Card deck gets reshuffled!")
-                # Broadcast
-                available_cards = db.get_data_table("Card", [["id"]], "owner = 0")
-            i = 0
-            while i < amount:
-                assigned_cards.append(available_cards[i][0])
-                i += 1
-            for a_card in assigned_cards:
-                db.update_data_table("Card", {"owner": id}, "id = " + str(a_card))
-                logger.debug("Card " + str(a_card) + " assigned to " + str(id))
-        else:
-            market_cards = db.get_data_table("Card", [["id","color"]], "owner = 1")
-            present = False
-            for market_card in market_cards:
-                if color in market_card[1]:
-                    present = True
-                    card_id = market_card[0]
-            if not present:
-                return False
-            db.update_data_table("Card", {"owner": id}, "id = " + str(card_id))
-            logger.debug("Card " + str(color) + " assigned to " + str(id))
-
-        return True
-
-    def dispose_card(self, db, card_id):
-        """Dispose a card"""
-        db.update_data_table("Card", {"owner": 2}, "id = " + str(card_id))
-        logger.debug("Card " + str(card_id) + " disposed!")
-
-    def assign_tickets(self, db, id, amount = 1):
-        """assigns an amount of tickets to a player chat_id"""
-        assigned_tickets = []
-        show_routes = []
-        available_tickets = db.get_data_table("Ticket", [["id","city1","city2","value"]], "owner IS NULL")
-        i = 0
-        while i < amount:
-            assigned_tickets.append(available_tickets[i][0])
-            city1 = db.get_data_table("City", [["name"]], "id = " + str(available_tickets[i][1]))
-            city2 = db.get_data_table("City", [["name"]], "id = " + str(available_tickets[i][2]))
-            show_routes.append([str(available_tickets[i][0]) + ": " + str(city1[0][0]) + " - " + str(city2[0][0]) + " value: " + str(available_tickets[i][3])])
-            i += 1
-        for a_ticket in assigned_tickets:
-            db.update_data_table("Ticket", {"owner": id}, "id = " + str(a_ticket))
-            logger.debug("Ticket " + str(a_ticket) + " assigned to " + str(id))
-        return show_routes, assigned_tickets
-    
-    def dispose_ticket(self, db, ticket_id):
-        """Dispose a ticket"""
-        db.update_data_table("Ticket", {"owner": 0}, "id = " + str(ticket_id))
-        logger.debug("Ticket " + str(ticket_id) + " disposed!")
+    def city_names(self, free = False):
+        """Names of all cities, only the ones without station if free is True"""
+        return [name for city_id, name in self.state.city_names.items() if not free or city_id not in self.state.stations]
 
-    def show_route(self, db, routes, array = False):
+    def cities_keyboard(self, free = False):
+        """Keyboard with the cities and a Back button"""
+        cities_keyboard = self.make_nested_lists(self.city_names(free), 4)
+        cities_keyboard.append(["Back"])
+        return cities_keyboard
+
+    def show_ticket(self, ticket_id):
+        """Ticket as text"""
+        ticket = self.state.tickets[ticket_id]
+        return str(ticket_id) + ": " + self.state.city_name(ticket["city1"]) + " - " + self.state.city_name(ticket["city2"]) + " value: " + str(ticket["value"])
+
+    def show_progress(self, ticket_id, chat_id = None):
+        """How far a ticket of a player is from completion"""
+        if chat_id is None and self.engine.completed(ticket_id):
+            return "completed"
+        distance = self.engine.ticket_distance(ticket_id, chat_id)
+        if distance is None:
+            return "can't be completed anymore"
+        ticket = self.state.tickets[ticket_id]
+        return str(distance) + " of " + str(self.engine.distances.shortest(ticket["city1"], ticket["city2"])) + " trains to go"
+
+    def tickets_keyboard(self, ticket_ids, chat_id):
+        """Keyboard with tickets and their progress for chat_id and a Hold all button"""
+        tickets_keyboard = [[self.show_ticket(ticket_id) + ", " + self.show_progress(ticket_id, chat_id)] for ticket_id in ticket_ids]
+        tickets_keyboard.append(["Hold all"])
+        return tickets_keyboard
+
+    def show_route(self, routes, array = False):
         """See which routes are possible with the cards given.
         If one route given also return card combinations to build the route
-        Both routes and cards are tuples containing all database columns"""
+        Routes are route dicts of the game state"""
         return_routes = []
         for route in routes:
-            city1 = db.get_data_table("City", [["name"]], "id = " + str(route[1]))
-            city2 = db.get_data_table("City", [["name"]], "id = " + str(route[2]))
-            route_text = str(route[0]) + ": " + str(city1[0][0]) + " - " + str(city2[0][0]) + " " + str(route[3]) + " dist: " + str(route[4]) + " loc: " + str(route[5])
-            if route[6] > 0:
+            route_text = str(route["id"]) + ": " + self.state.city_name(route["city1"]) + " - " + self.state.city_name(route["city2"]) + " " + str(route["color"]) + " dist: " + str(route["distance"]) + " loc: " + str(route["locomotives"])
+            if route["tunnel"] > 0:
                 route_text += " tunnel"
             if array:
                 return_routes.append([route_text])
@@ -378,136 +217,90 @@ class VTR_BOT():
 
         return return_routes
 
-    def possible_card_combination(self, db, id, distance, color, locomotives = 0):
-        """Check what card combinations are possible for a route"""
-        possible = True
-        deck_cards = db.get_data_table("Ticket", [["color"]], "owner = " + str(id))
-        deck = {}
-        possible_combinations = []
-        rest_distance = distance
+    def open_routes(self, city_name, chat_id = None):
+        """Routes that start or end in a city and can still be claimed, by chat_id when given"""
+        city_id = self.state.city_id(city_name)
+        if city_id is None:
+            return []
+        return self.engine.open_routes(city_id, chat_id)
 
-        for card in deck_cards:
-            if card[0] in deck:
-                deck[card[0]] += 1
-            else:
-                deck[card[0]] = 1
+    def payable(self, id, route):
+        """Check if a player has the cards for a route"""
+        return self.engine.payment(id, route["distance"], route["color"], route["locomotives"]) is not None
 
-        if locomotives > 0:
-            if "locomotive" in deck:
-                if deck["locomotive"] >= locomotives:
-                    deck["locomotive"] -= locomotives
-                    rest_distance -= locomotives
-                else:
-                    possible = False
-            else:
-                possible = False
-        
-        colors = []
-        if color in "blank":
-            for c in deck:
-                colors.append[c]
-        else:
-            colors.append[color]
-
-        combination_found = False
-        for c in colors:
-            if c in deck:
-                # All color cards
-                if rest_distance >= deck[c]:
-                    combination_found = True
-                    locos = deck["locomotive"]
-                    if locos > 0:
-                        if locomotives > 0:
-                            for l in range(0,locos+1):
-                                possible_combinations.append([str(locomotives + l) + " x locomotives + " +  str(deck[c] - l) + " x " + c])
-                        else:
-                            possible_combinations.append [str(deck[c]) + " x " + c]
-                            for l in range(1,locos+1):
-                                possible_combinations.append([str(l) + " x locomotives + " +  str(deck[c] - l) + " x " + c])
-                    else:
-                        if locomotives > 0:
-                            possible_combinations.append([str(locomotives) + " x locomotives + " +  str(deck[c]) + " x " + c])
-                        else:
-                            possible_combinations.append([str(deck[c]) + " x " + c])
-                # color and locomotives
-                elif rest_distance >= deck[c] + deck["locomotive"]:
-                    combination_found = True
-                    locos_nec = rest_distance - deck[c]
-                    locos = deck["locomotive"] - locos_nec
-                    if locos > 0:
-                        if locomotives > 0:
-                            for l in range(0,locos+1):
-                                possible_combinations.append([str(locomotives + l + locos_nec) + " x locomotives + " +  str(deck[c] - l) + " x " + c])
-                        else:
-                            possible_combinations.append([str(locos_nec) + " x locomotives + " +  str(deck[c]) + " x " + c])
-                            for l in range(1,locos+1):
-                                possible_combinations.append([str(l + locos_nec) + " x locomotives + " +  str(deck[c] - l) + " x " + c])
-                    else:
-                        if locomotives > 0:
-                            possible_combinations.append([str(locomotives + locos_nec) + " x locomotives + " +  str(deck[c]) + " x " + c])
-                        else:
-                            possible_combinations.append([str(locos_nec) + " x locomotives + " +  str(deck[c]) + " x " + c])
-            else:
-                possible = False
-
-        if not combination_found:
-            possible = False
-        
-        return possible, possible_combinations
-
-    def build_route_with_cards(self, db, chat_id, selection):
-        """Assign cards to graveyard"""
-        ok = True
-        splitted = selection.split(" + ")
-        for split in splitted:
-            pieces = split.split(" ")
-            db.update_data_table("Card", {"owner": 2}, "id = " + str(chat_id) + " AND color LIKE '" + str(pieces[1]) + "'")
-        return ok
-
-    def show_deck(self, db, id, anonimity = False):
+    def possible_card_combination(self, id, distance, color, locomotives = 0):
+        """Check what card combinations are possible for a route, as keyboard rows"""
+        possible_combinations = []
+        for cards in self.engine.payment_options(id, distance, color, locomotives):
+            possible_combinations.append([self.show_cards(cards)])
+        return len(possible_combinations) > 0, possible_combinations
+
+    def show_cards(self, cards):
+        """Cards as dict color: amount like 2 x locomotives + 3 x red, the opposite of parse_cards"""
+        parts = []
+        if cards.get("locomotive", 0) > 0:
+            parts.append(str(cards["locomotive"]) + " x locomotives")
+        for color, amount in cards.items():
+            if color != "locomotive" and amount > 0:
+                parts.append(str(amount) + " x " + color)
+        return " + ".join(parts)
+
+    def parse_cards(self, selection):
+        """Cards of a combination like 2 x locomotives + 3 x red as dict color: amount"""
+        cards = {}
+        for split in selection.split(" + "):
+            pieces = split.split(" x ")
+            color = pieces[1]
+            if color == "locomotives":
+                color = "locomotive"
+            cards[color] = cards.get(color, 0) + int(pieces[0])
+        return cards
+
+    def show_deck(self, id, anonimity = False):
         """Places the deck inside a return string"""
         response = ""
-        tickets = db.get_data_table("Ticket", [["id","city1","city2","value"]], "owner = " + str(id))
-        response = "Tickets: " + str(len(tickets)) + "\n"
+        tickets = self.state.ticket_pile(id)
+        completed = [ticket for ticket in tickets if self.engine.completed(ticket)]
+        response = "Tickets: " + str(len(tickets)) + " (" + str(len(completed)) + " completed)\n"
         if not anonimity:
             for ticket in tickets:
-                city1 = db.get_data_table("City", [["name"]], "id = " + str(ticket[1]))
-                city2 = db.get_data_table("City", [["name"]], "id = " + str(ticket[2]))
-                response += str(ticket[0]) + ": " + str(city1[0][0]) + " - " + str(city2[0][0]) + " value: " + str(ticket[3]) + "\n"
+                response += self.show_ticket(ticket) + " (" + self.show_progress(ticket) + ")\n"
             response += "\n"
 
-        cards = db.get_data_table("Card", [["color"]], "owner = " + str(id))
-        response += "Cards: " + str(len(cards)) + "\n"
+        response += "Cards: " + str(len(self.state.pile(id))) + "\n"
         if not anonimity:
-            card_dict = {}
-            for card in cards:
-                if card[0] in card_dict:
-                    card_dict[card[0]] += 1
-                else:
-                    card_dict[card[0]] = 1
-            for color, amount in card_dict.items():
+            for color, amount in self.state.hand_colors(id).items():
                 response += str(amount) + " " + str(color) + "\n"
             response += "\n"
 
-        player = db.get_data_table("Player", [["trains","stations"]], "chat_id = " + str(id))
-        response += "Trains: " + str(player[0][0]) + "\n"
-        response += "Stations: " + str(player[0][1]) + "\n"
-        if player[0][1] < self.amount_stations:
-            stations = db.get_data_table("Station", [["name"]], "owner = " + str(id))
+        player = self.state.player(id)
+        response += "Trains: " + str(player["trains"]) + "\n"
+        response += "Stations: " + str(player["stations"]) + "\n"
+        if player["stations"] < self.amount_stations:
             response += "Station(s) built in: "
-            for station in stations:
-                response += str(station[0]) + ", "
+            for station in self.state.stations_of(id):
+                response += self.state.city_name(station) + ", "
             response = response[:-2]
         return response
 
-    def show_market(self, db):
+    def show_market(self):
         """Show the train cards in the market"""
         response = "Market:\n"
-        market = db.get_data_table("Card", [["color"]], "owner = 1")
-        for i,card in enumerate(market):
-            response += str(i+1) + " " + str(card[0]) + "\n"
+        for i,card in enumerate(self.state.pile_colors(OWNER_MARKET)):
+            response += str(i+1) + " " + str(card) + "\n"
 
         return response
+
+    def market_keyboard(self, locomotives = True):
+        """Keyboard with the market cards, a random card and a Back button"""
+        market_list = []
+        for card in self.state.pile_colors(OWNER_MARKET):
+            if locomotives or card != "locomotive":
+                market_list.append(card)
+        market_list.append("random")
+        market_keyboard = self.make_nested_lists(market_list, 2)
+        market_keyboard.append(["Back"])
+        return market_keyboard
     
     def make_nested_lists(self, data_list, items_each_line = 3):
         """Makes nested lists with a shape to use as keyboard in markup"""
@@ -533,52 +326,56 @@ class VTR_BOT():
 
         return outer_list
 
-    def next_turn(self, db):
-        """Sets the next turn"""
-        player = db.get_data_table("Turn", [["sequence, turns"]], "playing = 1")
-        if len(player) < 1:
+    def show_score(self, chat_id, score, tickets = False):
+        """Score of a player as text, with the completed and open tickets if tickets is True"""
+        player = self.state.player(chat_id)
+        response = str(player["color"]) + " (" + str(player["name"]) + "): " + str(score["total"]) + " points\n"
+        response += "Routes: " + str(score["routes"]) + ", tickets: " + str(score["tickets"]) + ", stations: " + str(score["stations"])
+        if score["longest"] > 0:
+            response += ", longest route: " + str(score["longest"])
+        response += "\n"
+        if tickets:
+            for ticket in score["completed"]:
+                response += "+ " + self.show_ticket(ticket) + "\n"
+            for ticket in score["open"]:
+                response += "- " + self.show_ticket(ticket) + "\n"
+            if score["borrowed"]:
+                response += "Stations use: " + ", ".join(self.show_route([self.state.routes[route_id] for route_id in score["borrowed"]])) + "\n"
+        return response
+
+    def announce_turn(self, chat_id):
+        """Broadcast who's turn it is, called by the engine after every turn"""
+        if self.engine.finished:
+            # end the game
+            response = "GAME HAS ENDED\n\nRESULTS:\n"
+            for place, (player_id, score) in enumerate(self.engine.results(), 1):
+                response += "\n" + str(place) + ". " + self.show_score(player_id, score, True)
+            self.broadcast(response)
             return
-        db.update_data_table("Turn", {"playing": 0}, "playing = 1")
-        players = db.get_data_table("Player", [["trains"]], "color IS NOT NULL")
-        if player[0][1] is None:
-            for p in players:
-                if p[0] <= self.trains_last_turns:
-                    db.update_data_table("Turn", {"turns": self.turns_left}, "chat_id > 0")
-        else:
-            db.update_data_table("Turn", {"turns": player[0][1] - 1}, "sequence = " +  str(player[0][0]))
+        info = self.state.player(chat_id)
+        response = "Turn for player " + info["color"] + " -> " + info["name"]
+        self.broadcast(response)
 
-        if player[0][0] >= len(players):
-            db.update_data_table("Turn", {"playing": 1}, "sequence = 1")
-        else:
-            db.update_data_table("Turn", {"playing": 1}, "sequence = " + str(player[0][0] + 1))
-
-        player = db.get_data_table("Turn", [["chat_id, sequence, turns"]], "playing = 1")
-        if player[0][2] is not None:
-            if player[0][2] <= 0:
-                # end the game
-                response = "GAME HAS ENDED\n\nRESULTS:"
-                pass
-        info = db.get_data_table("Player", db.player_columns, "chat_id = " + str(player[0][0]))
-        response = "Turn for player " + info[0][5] + " -> " + info[0][1]
-        self.broadcast(db, response)
-
-    def your_turn(self, db, id):
+    def announce_reshuffle(self, cards):
+        """Broadcast that the discard pile went back into the deck, called by the engine"""
+        self.broadcast("The deck ran out, the " + str(cards) + " discarded cards are shuffled into it.")
+
+    def your_turn(self, id):
         """Check if it is your turn"""
-        player = db.get_data_table("Turn", [["chat_id"]], "playing = 1")
-        if player[0][0] == id:
-            return True
-        else:
-            return False
+        return self.state.playing == id
 
-    def broadcast(self, db, message):
-        """broadcast a message to all the players"""
-        players = db.get_data_table("Player", db.player_columns, "chat_id > 0")
-        
-        for player in players:
-            send_text = 'https://api.telegram.org/bot' + self.token + '/sendMessage?chat_id=' + str(player[0]) + '&parse_mode=Markdown&text=' + message
+    def broadcast(self, message):
+        """broadcast a message to all the players, inside a game action it is sent once the action is done"""
+        players = [chat_id for chat_id in self.state.players if chat_id > 0]
+        self.state.after_unit(lambda: self.send_broadcast(players, message))
 
-            response = requests.get(send_text)
-        
+    def reply(self, update, text, markup=None):
+        """Reply to the chat of an update, inside a game action it is sent once the action is done"""
+        self.state.after_unit(lambda: update.message.reply_text(text, reply_markup=markup))
+
+    def send_broadcast(self, players, message):
+        """Queue a message for the given chat_ids, the broadcaster delivers it in the background"""
+        self.broadcaster.broadcast(players, message)
 
     ###########################################################################################################################################
 
@@ -587,241 +384,186 @@ class VTR_BOT():
     ############################################################################################################################################
 
     def start(self, update, context):
-        """Start: add the chat_id to the player table"""
+        """Start: add the chat_id to the player table, /start name moves the chat to the game with that name"""
+        if context.args:
+            game_id = context.args[0]
+            if not valid_game_id(game_id):
+                update.message.reply_text("A game name has at most 32 letters, digits, - or _")
+                return ConversationHandler.END
+            if not self.games.enter(update.message.chat_id, game_id):
+                update.message.reply_text("Unable to move you to game " + game_id + ", please try again")
+                return ConversationHandler.END
+            with self.games.lease(game_id) as game:
+                self.local.game = game
+                return self.welcome(update, context)
+        return self.welcome(update, context)
+
+    def welcome(self, update, context):
+        """Welcome the chat in its game as a player or a spectator"""
         response = ""
-        db = DatabaseSqlite3(self.url)
-        self.broadcast(db, update.message.from_user.first_name + " has joined!")
-        players = db.get_data_table("Player", [["chat_id", "color"]], "color IS NOT NULL")
-        for player in players:
-            if update.message.chat_id == player[0]:
+        if self.local.game.game_id != DEFAULT_GAME:
+            response += "Game: " + self.local.game.game_id + "\n\n"
+        with self.state.unit():
+            self.broadcast(update.message.from_user.first_name + " has joined!")
+            player = self.state.player(update.message.chat_id)
+            if player is not None and player["color"] is not None:
                 response += "Welcome back to Bobbie's Venetian Hotel & Casino! \n\n We are still playing ticket to ride!!!\n\n"
-                response += "Your color is: " + str(player[1][0])
+                response += "Your color is: " + str(player["color"])
                 markup = ReplyKeyboardMarkup(option_keyboard, one_time_keyboard=True)
-                update.message.reply_text(response, reply_markup=markup)
+                self.reply(update, response, markup)
                 logger.info("user: " + str(update.message.chat_id) + " reconnected!")
-                self.broadcast(db, update.message.from_user.first_name + " has joined again!")
+                self.broadcast(update.message.from_user.first_name + " has joined again!")
                 return OPTIONS
 
-        spectators = db.get_data_table("Player", [["chat_id", "color"]], "color IS NULL")
-        present = False
-        for spectator in spectators:
-            if update.message.chat_id == spectator[0]:
+            if player is not None:
                 response += "Welcome back to Bobbie's Venetian Hotel & Casino! \n\n We are still playing ticket to ride!!!\n\nPlease choose a color you want to play"     
-                present = True
                 logger.info("user: " + str(update.message.chat_id) + " reconnected!")
-
-        if not present:
-            db.insert_data_table("Player", db.player_columns, [(update.message.chat_id, update.message.from_user.first_name, 0, 0, 0, None)])
-            response += "Hello, \n\nWelcome to Bobbie\'s Venitian Hotel & Casino\nCome and play with us!\n\nWe are playing Ticket To Ride tonight...\nChoose an available color to add yourself to the game!\n\nYou are now a spectator!"
-            logger.info("user: " + str(update.message.chat_id) + " added to player database!")
-        available_colors = self.available_colors(db)
-        markup = ReplyKeyboardMarkup(available_colors, one_time_keyboard=True)
-        update.message.reply_text(response, reply_markup=markup)
-        db.close()
-        return SELECTION
+            else:
+                self.engine.watch(update.message.chat_id, update.message.from_user.first_name)
+                response += "Hello, \n\nWelcome to Bobbie\'s Venitian Hotel & Casino\nCome and play with us!\n\nWe are playing Ticket To Ride tonight...\nChoose an available color to add yourself to the game!\n\nYou are now a spectator!"
+                logger.info("user: " + str(update.message.chat_id) + " added to player database!")
+            available_colors = self.available_colors()
+            markup = ReplyKeyboardMarkup(available_colors, one_time_keyboard=True)
+            self.reply(update, response, markup)
+            return SELECTION
 
     def add(self, update, context):
         """Add a player to the game"""
         choice = update.message.text.lower()
-        db = DatabaseSqlite3(self.url)
-        result = db.get_data_table("Player", [["name","color"]], "color LIKE '" + choice + "'")
-        if len(result) > 0:
-            response = "Somebody else is already assigned to this color, please choose another one!"
-            available_colors = self.available_colors(db)
-            markup = ReplyKeyboardMarkup(available_colors, one_time_keyboard=True)
-            update.message.reply_text(response, reply_markup=markup)
-        else:
-            response = "You are assigned to player color: " + choice
-            logger.info("user: " + str(update.message.chat_id) + " choose color: " + str(choice))
-            # Assign cards
-            self.assign_cards(db, update.message.chat_id, None, 4)
-            # Assign special_tickets
-            special_tickets = db.get_data_table("Ticket", [["id"]], "special = 1 AND owner IS NULL")
-            db.update_data_table("Ticket", {"owner": update.message.chat_id}, "id = " + str(special_tickets[0][0]))
-            # Assign trains and stations
-            db.update_data_table("Player", {"trains": self.amount_trains, "stations": self.amount_stations, "color": choice}, "chat_id = " + str(update.message.chat_id), True)
-            context.user_data['initialized'] = False
-            context.user_data['dispose_second_ticket'] = False
-            # Show the map
-            present = False
-            for board in os.listdir(os.path.join(self.path, "board")):
-                if self.map_name in board:
-                    try:
-                        picture = os.path.join(self.path, "board", board)
-                        present = True
-                    except Exception as e:
-                        logger.error(e)
-            if not present:
-                update.message.reply_text("Unable to find map picture!")
+        with self.state.unit():
+            # Assign cards, special ticket, trains and stations and deal 3 normal tickets
+            ticket_ids = self.engine.join(update.message.chat_id, update.message.from_user.first_name, choice)
+            if ticket_ids is None:
+                response = "Somebody else is already assigned to this color, please choose another one!"
+                available_colors = self.available_colors()
+                markup = ReplyKeyboardMarkup(available_colors, one_time_keyboard=True)
+                self.reply(update, response, markup)
             else:
-                update.message.reply_photo(open(picture, 'rb'))
-            # Show the deck
-            deck = "Deck:\n"
-            deck += self.show_deck(db, update.message.chat_id)
-            update.message.reply_text(deck)
-            # Assing 3 normal tickets
-            tickets, ticket_ids = self.assign_tickets(db, update.message.chat_id, 3)
-            tickets.append(["Hold all"])
-            context.user_data['tickets_selection'] = ticket_ids
-            response += "\nChoose if you want to delete one of the below route's:"
-            markup = ReplyKeyboardMarkup(tickets, one_time_keyboard=True)
-            update.message.reply_text(response, reply_markup=markup)
-            self.broadcast(db, update.message.from_user.first_name + " choose color " + choice + " and was added to the game's players.")
-            logger.info("Player " + str(update.message.chat_id) + " choose color " + choice)
-            db.close()
-            return TICKET
+                response = "You are assigned to player color: " + choice
+                logger.info("user: " + str(update.message.chat_id) + " choose color: " + str(choice))
+                context.user_data['initialized'] = False
+                context.user_data['dispose_second_ticket'] = False
+                # Show the map
+                self.state.after_unit(lambda: self.send_board(update))
+                # Show the deck
+                deck = "Deck:\n"
+                deck += self.show_deck(update.message.chat_id)
+                self.reply(update, deck)
+                context.user_data['tickets_selection'] = ticket_ids
+                response += "\nChoose if you want to delete one of the below route's:"
+                markup = ReplyKeyboardMarkup(self.tickets_keyboard(ticket_ids, update.message.chat_id), one_time_keyboard=True)
+                self.reply(update, response, markup)
+                self.broadcast(update.message.from_user.first_name + " choose color " + choice + " and was added to the game's players.")
+                logger.info("Player " + str(update.message.chat_id) + " choose color " + choice)
+                return TICKET
 
     def start_game(self, update, context):
         """Start the game"""
-        db = DatabaseSqlite3(self.url)
-        players = db.get_data_table("Player", [["chat_id","name","color"]], "color IS NOT NULL")
-        seq = 1
-        message = "THE GAME STARTS\n\nCHEW CHEW\n\nGOOD LUCK AND HAVE FUN!\n\n"
-        for player in players:
-            if seq is 1:
-                db.insert_data_table("Turn", db.turn_columns, [(player[0], 1, seq, None)])
-                message += str(player[2]) + "(" + str(player[1]) + ") goes first"
-            else:
-                db.insert_data_table("Turn", db.turn_columns, [(player[0], 0, seq, None)])
-            seq += 1
-        self.broadcast(db, message)
-        db.close()
+        with self.state.unit():
+            message = "THE GAME STARTS\n\nCHEW CHEW\n\nGOOD LUCK AND HAVE FUN!\n\n"
+            first = self.engine.start()
+            if first is not None:
+                player = self.state.player(first)
+                message += str(player["color"]) + "(" + str(player["name"]) + ") goes first"
+            self.broadcast(message)
 
     def choose_tickets(self, update, context):
         """Assign three tickets and let them choose which on they want to hold"""
-        db = DatabaseSqlite3(self.url)
-        if not self.your_turn(db, update.message.chat_id):
-            markup = ReplyKeyboardMarkup(option_keyboard, one_time_keyboard=True)
-            update.message.reply_text("It's not your turn yet! Going back...", reply_markup=markup)
-            db.close()
-            return OPTIONS
-        tickets, ticket_ids = self.assign_tickets(db, update.message.chat_id, 3)
-        tickets.append(["Hold all"])
-        context.user_data['tickets_selection'] = ticket_ids
-        context.user_data['dispose_second_ticket'] = False
-        markup = ReplyKeyboardMarkup(tickets, one_time_keyboard=True)
-        player = db.get_data_table("Player", [["name", "color"]], "chat_id = " + str(update.message.chat_id))
-        self.broadcast(db, player[0][1] + " (" + player[0][0] + ") " + " took 3 new tickets")
-        deck = self.show_deck(db, update.message.chat_id)
-        update.message.reply_text(deck)
-        update.message.reply_text("Choose the ticket(s) you want to delete:", reply_markup=markup)
-        db.close()
-        logger.debug("Player " + str(update.message.chat_id) + " has had three new tickets")
-        return TICKET
+        with self.state.unit():
+            if not self.your_turn(update.message.chat_id):
+                markup = ReplyKeyboardMarkup(option_keyboard, one_time_keyboard=True)
+                self.reply(update, "It's not your turn yet! Going back...", markup)
+                return OPTIONS
+            ticket_ids = self.engine.draw_tickets()
+            if not ticket_ids:
+                markup = ReplyKeyboardMarkup(option_keyboard, one_time_keyboard=True)
+                self.reply(update, "No tickets left to take! Going back...", markup)
+                return OPTIONS
+            context.user_data['tickets_selection'] = ticket_ids
+            context.user_data['dispose_second_ticket'] = False
+            markup = ReplyKeyboardMarkup(self.tickets_keyboard(ticket_ids, update.message.chat_id), one_time_keyboard=True)
+            player = self.state.player(update.message.chat_id)
+            self.broadcast(player["color"] + " (" + player["name"] + ") " + " took 3 new tickets")
+            deck = self.show_deck(update.message.chat_id)
+            self.reply(update, deck)
+            self.reply(update, "Choose the ticket(s) you want to delete:", markup)
+            logger.debug("Player " + str(update.message.chat_id) + " has had three new tickets")
+            return TICKET
 
     def pick_ticket(self, update, context):
         """Drop a tickets and let them choose which one they want to hold"""
         choice = update.message.text
-        db = DatabaseSqlite3(self.url)
-        if choice in "Hold all":
-            del context.user_data['tickets_selection']
-            markup = ReplyKeyboardMarkup(option_keyboard, one_time_keyboard=True)
-            update.message.reply_text("You hold all the rest of the new tickets!", reply_markup=markup)
-            player = db.get_data_table("Player", [["name", "color"]], "chat_id = " + str(update.message.chat_id))
-            self.broadcast(db, str(player[0][0]) + " (" + str(player[0][1]) + ") " + " holds the rest of the new tickets")
-            self.next_turn(db)
-            context.user_data['initialized'] = True
-            deck = self.show_deck(db, update.message.chat_id)
-            update.message.reply_text(deck)
-            db.close()
-            return OPTIONS
+        with self.state.unit():
+            player = self.state.player(update.message.chat_id)
+            if choice in "Hold all":
+                self.engine.keep_tickets(context.user_data['tickets_selection'], update.message.chat_id)
+                del context.user_data['tickets_selection']
+                markup = ReplyKeyboardMarkup(option_keyboard, one_time_keyboard=True)
+                self.reply(update, "You hold all the rest of the new tickets!", markup)
+                self.broadcast(str(player["name"]) + " (" + str(player["color"]) + ") " + " holds the rest of the new tickets")
+                context.user_data['initialized'] = True
+                deck = self.show_deck(update.message.chat_id)
+                self.reply(update, deck)
+                return OPTIONS
         
-        db = DatabaseSqlite3(self.url)
-        ticket_list = choice.split(":")
-        result = db.get_data_table("Ticket", db.ticket_columns, "id = " + ticket_list[0])
-        if len(result) < 1:
-            update.message.reply_text("Input was not correct, choose if you want to delete on of following routes:")
-            return TICKET
-
-        self.dispose_ticket(db, result[0][0])
-        if context.user_data['dispose_second_ticket'] or not context.user_data['initialized']:
-            context.user_data['initialized'] = True
-            del context.user_data['tickets_selection']
-            del context.user_data['dispose_second_ticket']
-            markup = ReplyKeyboardMarkup(option_keyboard, one_time_keyboard=True)
-            update.message.reply_text("Ticket was deleted!", reply_markup=markup)
-            player = db.get_data_table("Player", [["name", "color"]], "chat_id = " + str(update.message.chat_id))
-            deck = self.show_deck(db, update.message.chat_id)
-            update.message.reply_text(deck)
-            self.broadcast(db, player[0][1] + " (" + player[0][0] + ") " + " deleted one of the new tickets.")
-            self.next_turn(db)
-            db.close()
-            return OPTIONS
+            ticket_list = choice.split(":")
+            ticket_ids = context.user_data['tickets_selection']
+            if not ticket_list[0].isdigit() or int(ticket_list[0]) not in ticket_ids:
+                self.reply(update, "Input was not correct, choose if you want to delete on of following routes:")
+                return TICKET
+
+            ticket_ids.remove(int(ticket_list[0]))
+            if context.user_data['dispose_second_ticket'] or not context.user_data['initialized']:
+                self.engine.keep_tickets(ticket_ids, update.message.chat_id)
+                context.user_data['initialized'] = True
+                del context.user_data['tickets_selection']
+                del context.user_data['dispose_second_ticket']
+                markup = ReplyKeyboardMarkup(option_keyboard, one_time_keyboard=True)
+                self.reply(update, "Ticket was deleted!", markup)
+                deck = self.show_deck(update.message.chat_id)
+                self.reply(update, deck)
+                self.broadcast(player["color"] + " (" + player["name"] + ") " + " deleted one of the new tickets.")
+                return OPTIONS
 
-        context.user_data['dispose_second_ticket'] = True
-        ticket_ids = context.user_data['tickets_selection']
-        ticket_ids.remove(int(ticket_list[0]))
-        tickets_show = []
-        for id in ticket_ids:
-            result = db.get_data_table("Ticket", db.ticket_columns, "id = " + str(id))
-            tickets_show.append([str(result[0][0]) + ": " + str(result[0][1]) + " - " + str(result[0][2]) + " value: " + str(result[0][3])])
-        markup = ReplyKeyboardMarkup(tickets_show, one_time_keyboard=True)
-        player = db.get_data_table("Player", [["name", "color"]], "id = " + str(update.message.chat_id))
-        self.broadcast(db, player[0][1] + " (" + player[0][0] + ") " + " deletes one of the new tickets")
-        deck = self.show_deck(db, update.message.chat_id)
-        update.message.reply_text(deck)
-        update.message.reply_text("Ticket was deleted, want to delete another route?", reply_markup=markup)
-        db.close()
-        return TICKET
+            # The ticket is disposed together with the second choice
+            context.user_data['dispose_second_ticket'] = True
+            markup = ReplyKeyboardMarkup(self.tickets_keyboard(ticket_ids, update.message.chat_id), one_time_keyboard=True)
+            self.broadcast(player["color"] + " (" + player["name"] + ") " + " deletes one of the new tickets")
+            self.reply(update, "Ticket was deleted, want to delete another route?", markup)
+            return TICKET
 
     def build_station(self, update, context):
         """Build a station"""
-        db = DatabaseSqlite3(self.url)
-        station = db.get_data_table("City", [["id"]], "station = " + str(update.message.chat_id))
-        possible, combination = self.possible_card_combination(db, update.message.chat_id, len(station)+1, "blank")
-        if not self.your_turn(db, update.message.chat_id) or not possible:
+        station = self.state.stations_of(update.message.chat_id)
+        possible, combination = self.possible_card_combination(update.message.chat_id, len(station)+1, "blank")
+        if not self.your_turn(update.message.chat_id) or not possible:
             markup = ReplyKeyboardMarkup(option_keyboard, one_time_keyboard=True)
             update.message.reply_text("You don't have the cards to build a new station or it's just not your turn yet! Going back...", reply_markup=markup)
-            db.close()
             logger.debug("Player " + str(update.message.chat_id) + " tried to build a station, but was denied!")
             return OPTIONS
 
         context.user_data['station'] = True
-        cities = db.get_data_table("City", db.city_columns, "station IS NULL")
-        cities_list = []
-        for city in cities:
-            cities_list.append(city[1])
-        cities_keyboard = self.make_nested_lists(cities_list, 4)
-        cities_keyboard.append(["Back"])
-        markup = ReplyKeyboardMarkup(cities_keyboard, one_time_keyboard=True)
+        markup = ReplyKeyboardMarkup(self.cities_keyboard(True), one_time_keyboard=True)
         update.message.reply_text("Select the city where to build the station:", reply_markup=markup)
-        db.close()
         logger.debug("Player " + str(update.message.chat_id) + " tries to build a station in CITY state")
         return CITY
 
     def build_route(self, update, context):
         """Build a route"""
-        db = DatabaseSqlite3(self.url)
-        if not self.your_turn(db, update.message.chat_id):
+        if not self.your_turn(update.message.chat_id):
             markup = ReplyKeyboardMarkup(option_keyboard, one_time_keyboard=True)
             update.message.reply_text("It's not your turn yet! Going back...", reply_markup=markup)
-            db.close()
             return OPTIONS
         context.user_data['route'] = True
-        cities = db.get_data_table("City", db.city_columns, "id > 0")
-        cities_list = []
-        for city in cities:
-            cities_list.append(city[1])
-        cities_keyboard = self.make_nested_lists(cities_list, 4)
-        cities_keyboard.append(["Back"])
-        markup = ReplyKeyboardMarkup(cities_keyboard, one_time_keyboard=True)
+        markup = ReplyKeyboardMarkup(self.cities_keyboard(), one_time_keyboard=True)
         update.message.reply_text("Select the city where the route starts:", reply_markup=markup)
-        db.close()
         logger.debug("Player " + str(update.message.chat_id) + " wants to build route goto CITY state")
         return CITY
 
     def city_information(self, update, context):
         """Show information about a city"""
-        db = DatabaseSqlite3(self.url)
-        cities = db.get_data_table("City", db.city_columns, "id > 0")
-        cities_list = []
-        for city in cities:
-            cities_list.append(city[1])
-        cities_keyboard = self.make_nested_lists(cities_list, 4)
-        cities_keyboard.append(["Back"])
-        markup = ReplyKeyboardMarkup(cities_keyboard, one_time_keyboard=True)
+        markup = ReplyKeyboardMarkup(self.cities_keyboard(), one_time_keyboard=True)
         update.message.reply_text("Select the city for which you want information:", reply_markup=markup)
-        db.close()
         logger.debug("Player " + str(update.message.chat_id) + " wants city information goto CITY state")
         return CITY
 
@@ -835,63 +577,34 @@ class VTR_BOT():
             markup = ReplyKeyboardMarkup(option_keyboard, one_time_keyboard=True)
             update.message.reply_text("Going back...", reply_markup=markup)
             return OPTIONS
-        db = DatabaseSqlite3(self.url)
         # build station
         if "station" in context.user_data:
             if context.user_data['station']:
-                cities = db.get_data_table("City", db.city_columns, "station IS NULL")
-                for city in cities:
-                    found = False
-                    if city[1] in choice:
-                        found = True
-                    
-                if not found:
-                    cities_list = []
-                    for city in cities:
-                        cities_list.append(city[1])
-                    cities_keyboard = self.make_nested_lists(cities_list, 4)
-                    cities_keyboard.append(["Back"])
-                    markup = ReplyKeyboardMarkup(cities_keyboard, one_time_keyboard=True)
+                if choice not in self.city_names(True):
+                    markup = ReplyKeyboardMarkup(self.cities_keyboard(True), one_time_keyboard=True)
                     update.message.reply_text("The input was not valid, choose a station from the list below:", reply_markup=markup)
-                    db.close()
                     logger.debug("Player " + str(update.message.chat_id) + " gave invalid input in build station")
                     return CITY
 
-                db.update_data_table("City", {{"owner":update.message.chat_id}}, "name LIKE " + str(choice), True)
-                logger.info("Station was built in" + str(choice) + "by player: " + str(update.message.chat_id))
-                player = db.get_data_table("Player", [["name", "color"]], "chat_id = " + str(update.message.chat_id))
-                self.broadcast(db, player[0][0] + " (" + player[0][0] + ") " + " build a station in " + choice)
-                station = db.get_data_table("City", [["id"]], "station = " + str(update.message.chat_id))
-                possible, combination = self.possible_card_combination(db, update.message.chat_id, len(station)+1, "blank")
-                context.user_data['station'] = False
+                context.user_data['station_city'] = choice
+                station = self.state.stations_of(update.message.chat_id)
+                possible, combination = self.possible_card_combination(update.message.chat_id, len(station)+1, "blank")
+                combination.append(["Back"])
                 markup = ReplyKeyboardMarkup(combination, one_time_keyboard=True)
                 update.message.reply_text("Select the cards you want to use to build this station:", reply_markup=markup)
-                db.close()
                 logger.info("Player " + str(update.message.chat_id) + " wants to build a station in " + choice + " going to state CARDS")
                 return CARDS
 
         # build route
         if "route" in context.user_data:
             if context.user_data['route']:
-                city = db.get_data_table("City", [["id"]], "name LIKE '" + choice + "'")
-                routes = db.get_data_table("Route", db.route_columns, "city1 = " + str(city[0][0]) + " OR city2 = " + str(city[0][0]) + " AND owner = 0")
+                routes = self.open_routes(choice, update.message.chat_id)
                 if len(routes) < 1:
-                    cities = db.get_data_table("City", db.city_columns, "id > 0")
-                    cities_list = []
-                    for city in cities:
-                        cities_list.append(city[1])
-                    cities_keyboard = self.make_nested_lists(cities_list, 4)
-                    cities_keyboard.append(["Back"])
-                    markup = ReplyKeyboardMarkup(cities_keyboard, one_time_keyboard=True)
+                    markup = ReplyKeyboardMarkup(self.cities_keyboard(), one_time_keyboard=True)
                     update.message.reply_text("The input was not valid, choose a city from the list below:", reply_markup=markup)
                     return CITY
-                 
-                possible_routes = []
-                for route in routes:
-                    possible, combination = self.possible_card_combination(db, update.message.chat_id, route[4], route[3],route[5])
-                    if possible:
-                        possible_routes.append(route)
-                
+             
+                possible_routes = [route for route in routes if self.payable(update.message.chat_id, route)]
                 routes_keyboard = self.show_route(possible_routes, True)
                 routes_keyboard.append(["Back"])
 
@@ -902,31 +615,19 @@ class VTR_BOT():
                 return ROUTE
 
         # city information
-        cities = db.get_data_table("City", db.city_columns, "id > 0")
-        found = False
-        for city in cities:
-            if choice in city[1]:
-                found = True
-
-        if not found:
-            cities_list = []
-            for city in cities:
-                cities_list.append(city[1])
-            cities_keyboard = self.make_nested_lists(cities_list, 4)
-            cities_keyboard.append(["Back"])
-            markup = ReplyKeyboardMarkup(cities_keyboard, one_time_keyboard=True)
+        city_id = self.state.city_id(choice)
+        if city_id is None:
+            markup = ReplyKeyboardMarkup(self.cities_keyboard(), one_time_keyboard=True)
             update.message.reply_text("The input was not valid, choose a city from the list below:", reply_markup=markup)
+            return CITY
 
         response = choice + "\nroutes:\n"
-        city = db.get_data_table("City", [["id"]], "name LIKE '" + choice + "'")
-        routes = db.get_data_table("Route", db.route_columns, "city1 = " + str(city[0][0]) + " OR city2 = " + str(city[0][0]) + " AND owner = 0")
-        routes_info = self.show_route(db, routes, False)
+        routes_info = self.show_route(self.open_routes(choice), False)
         for r in routes_info:
             response += r + "\n"
-        city = db.get_data_table("City", [["station"]], "name like '" + choice + "'")
-        if city[0][0] is not None:
-            player = db.get_data_table("Player", [["name"]], "chat_id = " + str(city))
-            response += "Station built by " + str(player[0][0])
+        if city_id in self.state.stations:
+            player = self.state.player(self.state.stations[city_id])
+            response += "Station built by " + str(player["name"])
         else:
             response += "No station built yet in this city"
         markup = ReplyKeyboardMarkup(option_keyboard, one_time_keyboard=True)
@@ -937,7 +638,6 @@ class VTR_BOT():
     def pick_route(self, update, context):
         """Choose a route to build and get cards selection"""
         choice = update.message.text
-        db = DatabaseSqlite3(self.url)
         if choice in "Back" or not context.user_data['route']:
             context.user_data['route'] = False
             markup = ReplyKeyboardMarkup(option_keyboard, one_time_keyboard=True)
@@ -945,149 +645,119 @@ class VTR_BOT():
             logger.debug("Player " + str(update.message.chat_id) + " goes back to OPTIONS")
             return OPTIONS
 
-        city = db.get_data_table("City", [["id"]], "name LIKE '" + context.user_data['route_city'] + "'")
-        routes = db.get_data_table("Route", db.route_columns, "city1 = " + str(city[0][0]) + " OR city2 = " + str(city[0][0]) + " AND owner = 0")
-        del context.user_data['route_city']
-        possible_routes = []
-        for route in routes:
-            possible, combination = self.possible_card_combination(db, update.message.chat_id, route[4], route[3],route[5])
-            if possible:
-                possible_routes.append(route)
-        
-        routes_keyboard = self.show_route(possible_routes, True)
-        
-        if choice not in possible_routes:
+        # Only the chosen route is checked, the list is made again when the input is not valid
+        city_id = self.state.city_id(context.user_data['route_city'])
+        choice_sections = choice.split(":")
+        route = None
+        if choice_sections[0].isdigit() and int(choice_sections[0]) in self.state.open_routes_of_city(city_id):
+            route = self.state.routes[int(choice_sections[0])]
+        if route is None or not self.engine.claimable(route["id"], update.message.chat_id) or not self.payable(update.message.chat_id, route):
+            possible_routes = [route for route in self.open_routes(context.user_data['route_city'], update.message.chat_id) if self.payable(update.message.chat_id, route)]
+            routes_keyboard = self.show_route(possible_routes, True)
             routes_keyboard.append(["Back"])
             markup = ReplyKeyboardMarkup(routes_keyboard, one_time_keyboard=True)
             update.message.reply_text("Input not valid, select one of following route's to build:", reply_markup=markup)
             logger.info("Player " + str(update.message.chat_id) + " invalid input in ROUTE => wants to build a route from " + choice + " going to state ROUTE")
             return ROUTE
         
-        choice_sections = choice.split(":")
-        route = db.get_data_table("Route", [["color","distance","locomotives"]], "id = " + choice_sections[0])
-        possible, combination = self.possible_card_combination(db, update.message.chat_id, route[0][1], route[0][0], route[0][2])
+        del context.user_data['route_city']
+        possible, combination = self.possible_card_combination(update.message.chat_id, route["distance"], route["color"], route["locomotives"])
+        combination.append(["Back"])
         markup = ReplyKeyboardMarkup(combination, one_time_keyboard=True)
         update.message.reply_text("Select the cards you want to use to build this route:", reply_markup=markup)
-        context.user_data['route_id'] = choice_sections[0]
+        context.user_data['route_id'] = route["id"]
         logger.info("Player " + str(update.message.chat_id) + " wants to build a route " + choice + " going to state CARDS")
         return CARDS
 
 
     def pick_cards(self, update, context):
         """Get the cards selection to build a route or station"""
-        db = DatabaseSqlite3(self.url)
-        choice = update.message.text
-        if choice in "Back":
-            context.user_data['route'] = False
-            markup = ReplyKeyboardMarkup(option_keyboard, one_time_keyboard=True)
-            update.message.reply_text("Going back...", reply_markup=markup)
-            self.next_turn(db)
-            db.close()
-            return OPTIONS
+        with self.state.unit():
+            choice = update.message.text
+            if choice in "Back":
+                context.user_data['route'] = False
+                context.user_data['station'] = False
+                markup = ReplyKeyboardMarkup(option_keyboard, one_time_keyboard=True)
+                self.reply(update, "Going back...", markup)
+                # A keyboard of an earlier turn doesn't end the turn of somebody else
+                if self.your_turn(update.message.chat_id):
+                    self.engine.end_turn()
+                return OPTIONS
 
-        if context.user_data['station']:
-            stations = db.get_data_table("Route", db.route_columns, "owner = " + str(update.message.chat_id))
-            possible, combination = self.possible_card_combination(db, update.message.chat_id, len(stations) + 1, "blank")
-            input_correct = False
-            for combo in combination:
-                if choice in combo:
-                    input_correct = True
-            
-            if not input_correct:
-                combination.append(["Back"])
-                markup = ReplyKeyboardMarkup(combination, one_time_keyboard=True)
-                update.message.reply_text("Input was not valid, select the cards you want to use to build this station:", reply_markup=markup)
-                return CARDS
+            if not self.your_turn(update.message.chat_id):
+                markup = ReplyKeyboardMarkup(option_keyboard, one_time_keyboard=True)
+                self.reply(update, "It's not your turn anymore! Going back...", markup)
+                return OPTIONS
 
-            context.user_data['station'] = False
-            choice_split = choice.split(" + ")
-            if len(choice_split) < 2:
-                card_split = choice_split[0].split(" x ")
-                used_cards = int(card_split[0]) * [card_split[1]]
-            else:
-                card_split = choice_split[0].split(" x ")
-                used_cards = int(card_split[0]) * [card_split[1]]
-                card_split = choice_split[1].split(" x ")
-                used_cards += int(card_split[0]) * [card_split[1]]
-            for card in used_cards:
-                db.update_data_table("Card", {{"id":2}}, "color LIKE '" + card + "' AND owner = " + str(update.message.chat_id))
-
-            db.update_data_table("City", {{"station":update.message.chat_id}}, "name LIKE '" + context.user_data['station_city'] + "'")
-            logger.info("Player " + str(update.message.chat_id) + " has build a station in " + context.user_data['station_city'] + " with cards " + choice + " back to state OPTIONS")
-            player = db.get_data_table("Player", [["name", "color"]], "chat_id = " + str(update.message.chat_id))
-            self.broadcast(db, str(player[0][0]) + " (" + str(player[0][1]) + ") has build a station in city: " + context.user_data['station_city'] + " with cards " + choice)
-            self.next_turn(db)
-            deck = self.show_deck(db, update.message.chat_id)
-            markup = ReplyKeyboardMarkup(option_keyboard, one_time_keyboard=True)
-            update.message.reply_text(deck, reply_markup=markup)
-            db.close()
-            return OPTIONS
+            player = self.state.player(update.message.chat_id)
+            if context.user_data.get('station'):
+                stations = self.state.stations_of(update.message.chat_id)
+                possible, combination = self.possible_card_combination(update.message.chat_id, len(stations) + 1, "blank")
+                input_correct = False
+                for combo in combination:
+                    if choice in combo:
+                        input_correct = True
+            
+                if not input_correct:
+                    combination.append(["Back"])
+                    markup = ReplyKeyboardMarkup(combination, one_time_keyboard=True)
+                    self.reply(update, "Input was not valid, select the cards you want to use to build this station:", markup)
+                    return CARDS
 
-        if context.user_data['route']:
-            route = db.get_data_table("Route", db.route_columns, "id = " + context.user_data['route_id'])
-            possible, combination = self.possible_card_combination(db, update.message.chat_id, route[0][4], route[0][3], route[0][5])
-            input_correct = False
-            for combo in combination:
-                if choice in combo:
-                    input_correct = True
+                context.user_data['station'] = False
+                if not self.engine.build_station(self.state.city_id(context.user_data['station_city']), self.parse_cards(choice)):
+                    markup = ReplyKeyboardMarkup(option_keyboard, one_time_keyboard=True)
+                    self.reply(update, "Unable to build a station in " + context.user_data['station_city'] + ", going back", markup)
+                    return OPTIONS
+                logger.info("Player " + str(update.message.chat_id) + " has build a station in " + context.user_data['station_city'] + " with cards " + choice + " back to state OPTIONS")
+                self.broadcast(str(player["name"]) + " (" + str(player["color"]) + ") has build a station in city: " + context.user_data['station_city'] + " with cards " + choice)
+                del context.user_data['station_city']
+                deck = self.show_deck(update.message.chat_id)
+                markup = ReplyKeyboardMarkup(option_keyboard, one_time_keyboard=True)
+                self.reply(update, deck, markup)
+                return OPTIONS
 
-            if not input_correct:
-                combination.append(["Back"])
-                markup = ReplyKeyboardMarkup(combination, one_time_keyboard=True)
-                update.message.reply_text("Input was not valid, select the cards you want to use to build this route:", reply_markup=markup)
-                return CARDS
+            if context.user_data.get('route'):
+                route = self.state.routes[context.user_data['route_id']]
+                possible, combination = self.possible_card_combination(update.message.chat_id, route["distance"], route["color"], route["locomotives"])
+                input_correct = False
+                for combo in combination:
+                    if choice in combo:
+                        input_correct = True
+
+                if not input_correct:
+                    combination.append(["Back"])
+                    markup = ReplyKeyboardMarkup(combination, one_time_keyboard=True)
+                    self.reply(update, "Input was not valid, select the cards you want to use to build this route:", markup)
+                    return CARDS
+
+                del context.user_data['route_id']
+                context.user_data['route'] = False
+                if not self.engine.claim_route(route["id"], self.parse_cards(choice)):
+                    markup = ReplyKeyboardMarkup(option_keyboard, one_time_keyboard=True)
+                    self.reply(update, "Unable to build this route, going back", markup)
+                    return OPTIONS
+                route_info = self.show_route([route], False)[0]
+                logger.info("Player " + str(update.message.chat_id) + " has build route " + route_info + " with cards " + choice + " back to state OPTIONS")
+                self.broadcast(str(player["name"]) + " (" + str(player["color"]) + ") has build following route: " + route_info + " with the cards " + choice)
+                deck = self.show_deck(update.message.chat_id)
+                markup = ReplyKeyboardMarkup(option_keyboard, one_time_keyboard=True)
+                self.reply(update, deck, markup)
+                return OPTIONS
 
-            choice_split = choice.split(" + ")
-            if len(choice_split) < 2:
-                card_split = choice_split[0].split(" x ")
-                used_cards = int(card_split[0]) * [card_split[1]]
-            else:
-                card_split = choice_split[0].split(" x ")
-                used_cards = int(card_split[0]) * [card_split[1]]
-                card_split = choice_split[1].split(" x ")
-                used_cards += int(card_split[0]) * [card_split[1]]
-            for card in used_cards:
-                db.update_data_table("Card", {{"id":2}}, "color LIKE '" + card + "' AND owner = " + str(update.message.chat_id))
-
-            db.update_data_table("Route", {{"owner":update.message.chat_id}}, "id = " + str(context.user_data['route_id']) )
-            del context.user_data['route_id']
-            context.user_data['route'] = False
-            route_info = self.show_route(db, route, False)
-            logger.info("Player " + str(update.message.chat_id) + " has build route " + route_info + " with cards " + choice + " back to state OPTIONS")
-            player = db.get_data_table("Player", [["name", "color"]], "chat_id = " + str(update.message.chat_id))
-            self.broadcast(db, str(player[0][0]) + " (" + str(player[0][1]) + ") has build following route: " + route_info + " with the cards " + choice)
-            self.next_turn(db)
-            deck = self.show_deck(db, update.message.chat_id)
             markup = ReplyKeyboardMarkup(option_keyboard, one_time_keyboard=True)
-            update.message.reply_text(deck, reply_markup=markup)
-            db.close()
+            self.reply(update, "Something went wrong, going back", markup)
             return OPTIONS
 
-        markup = ReplyKeyboardMarkup(option_keyboard, one_time_keyboard=True)
-        update.message.reply_text("Something went wrong, going back", reply_markup=markup)
-        db.close()
-        return OPTIONS
-
 
     def choose_market(self, update, context):
         """Choose a card from the market place"""
-        db = DatabaseSqlite3(self.url)
-        if not self.your_turn(db, update.message.chat_id):
+        if not self.your_turn(update.message.chat_id):
             markup = ReplyKeyboardMarkup(option_keyboard, one_time_keyboard=True)
             update.message.reply_text("It's not your turn yet! Going back...", reply_markup=markup)
-            db.close()
             return OPTIONS
-        context.user_data['second_pick'] = False
-        market_cards = db.get_data_table("Card", db.card_columns, "owner = 1")
-        market_list = []
-        for card in market_cards:
-            market_list.append(card[1])
-        market_list.append("random")
-        market_keyboard = self.make_nested_lists(market_list, 2)
-        market_keyboard.append(["Back"])
-        markup = ReplyKeyboardMarkup(market_keyboard, one_time_keyboard=True)
+        markup = ReplyKeyboardMarkup(self.market_keyboard(self.engine.drawn == 0), one_time_keyboard=True)
         update.message.reply_text("Select a card from the market:", reply_markup=markup)
-        db.close()
         return MARKET
 
     def pick_market(self, update, context):
@@ -1097,146 +767,109 @@ class VTR_BOT():
             markup = ReplyKeyboardMarkup(option_keyboard, one_time_keyboard=True)
             update.message.reply_text("Going back...", reply_markup=markup)
             return OPTIONS
-        db = DatabaseSqlite3(self.url)
-        if choice in "random":
-            self.assign_cards(db, update.message.chat_id)
-            if context.user_data['second_pick']:
-                markup = ReplyKeyboardMarkup(option_keyboard, one_time_keyboard=True)
-                update.message.reply_text("Selected a random card.", reply_markup=markup)
-                self.next_turn(db)
-                deck = self.show_deck(db, update.message.chat_id)
-                update.message.reply_text(deck)
-                player = db.get_data_table("Player", [["name", "color"]], "chat_id = " + str(update.message.chat_id))
-                self.broadcast(db, player[0][1] + " (" + player[0][0] + ") " + " choose a random card!")
-                db.close()
-                return OPTIONS
-            else:
-                market_cards = db.get_data_table("Card", db.card_columns, "owner = 1 AND color NOT LIKE 'locomotive'")
-                market_list = []
-                for card in market_cards:
-                    market_list.append(card[1])
-                market_list.append("random")
-                market_keyboard = self.make_nested_lists(market_list, 2)
-                market_keyboard.append(["Back"])
-                markup = ReplyKeyboardMarkup(market_keyboard, one_time_keyboard=True)
-                deck = self.show_deck(db, update.message.chat_id)
-                update.message.reply_text(deck)
-                update.message.reply_text("Select a card from the market:", reply_markup=markup)
-                player = db.get_data_table("Player", [["name", "color"]], "chat_id = " + str(update.message.chat_id))
-                self.broadcast(db, player[0][1] + " (" + player[0][0] + ") " + " choose a random card!")
-                db.close()
-                return MARKET
-            
-        market_colors = db.get_data_table("Card", [["color"]], "owner = 1")
-        found = False
-        for color in market_colors:
-            if choice in color:
-                if context.user_data['second_pick'] and color not in "locomotive":
-                    found = True
-                else:
-                    found = True
-
-        if not found:
-            market_list = []
-            for card in market_cards:
-                market_list.append(card[1])
-            market_list.append("random")
-            market_keyboard = self.make_nested_lists(market_list, 2)
-            market_keyboard.append(["Back"])
+        if not self.your_turn(update.message.chat_id):
             markup = ReplyKeyboardMarkup(option_keyboard, one_time_keyboard=True)
-            update.message.reply_text("Input was not valid, try picking a card again:", reply_markup=markup)
-            player = db.get_data_table("Player", [["name", "color"]], "id = " + str(update.message.chat_id))
-            self.broadcast(db, player[0][1] + " (" + player[0][0] + ") " + " choose a random card!")
-            return MARKET
-
-        self.assign_cards(db, update.message.chat_id, choice)
-        self.assign_cards(db, 1)
-        deck = self.show_deck(db, update.message.chat_id)
-        update.message.reply_text(deck)
-        player = db.get_data_table("Player", [["name", "color"]], "chat_id = " + str(update.message.chat_id))
-        self.broadcast(db, player[0][1] + " (" + player[0][0] + ") " + " choose " + choice + " from the market.")
-        market_info = "New Market: \n"
-        market_info += self.show_market(db)
-        self.broadcast(db, market_info)
-        if context.user_data['second_pick']:
-            context.user_data['second_pick'] = False
-            markup = ReplyKeyboardMarkup(option_keyboard, one_time_keyboard=True)
-            update.message.reply_text("You choose a card!", reply_markup=markup)
-            deck = self.show_deck(db, update.message.chat_id)
-            update.message.reply_text(deck)
-            self.next_turn(db)
-            db.close()
+            update.message.reply_text("It's not your turn anymore! Going back...", reply_markup=markup)
             return OPTIONS
+        with self.state.unit():
+            player = self.state.player(update.message.chat_id)
+            if choice in "random":
+                if self.engine.draw_blind() is None:
+                    markup = ReplyKeyboardMarkup(option_keyboard, one_time_keyboard=True)
+                    self.reply(update, "No cards left to take! Going back...", markup)
+                    return OPTIONS
+                if self.engine.drawn == 0:
+                    markup = ReplyKeyboardMarkup(option_keyboard, one_time_keyboard=True)
+                    self.reply(update, "Selected a random card.", markup)
+                    deck = self.show_deck(update.message.chat_id)
+                    self.reply(update, deck)
+                    self.broadcast(player["color"] + " (" + player["name"] + ") " + " choose a random card!")
+                    return OPTIONS
+                else:
+                    markup = ReplyKeyboardMarkup(self.market_keyboard(False), one_time_keyboard=True)
+                    deck = self.show_deck(update.message.chat_id)
+                    self.reply(update, deck)
+                    self.reply(update, "Select a card from the market:", markup)
+                    self.broadcast(player["color"] + " (" + player["name"] + ") " + " choose a random card!")
+                    return MARKET
+            
+            if self.engine.draw_market(choice) is None:
+                markup = ReplyKeyboardMarkup(self.market_keyboard(self.engine.drawn == 0), one_time_keyboard=True)
+                self.reply(update, "Input was not valid, try picking a card again:", markup)
+                return MARKET
+
+            self.broadcast(player["color"] + " (" + player["name"] + ") " + " choose " + choice + " from the market.")
+            market_info = "New Market: \n"
+            market_info += self.show_market()
+            self.broadcast(market_info)
+            if self.engine.drawn == 0:
+                markup = ReplyKeyboardMarkup(option_keyboard, one_time_keyboard=True)
+                self.reply(update, "You choose a card!", markup)
+                deck = self.show_deck(update.message.chat_id)
+                self.reply(update, deck)
+                return OPTIONS
         
-        context.user_data['second_pick'] = True
-        deck = self.show_deck(db, update.message.chat_id)
-        update.message.reply_text(deck)
-        market_cards = db.get_data_table("Card", db.card_columns, "id = 1 AND color NOT LIKE 'locomotive'")
-        market_list = []
-        for card in market_cards:
-            market_list.append(card[1])
-        market_list.append("random")
-        market_keyboard = self.make_nested_lists(market_list, 2)
-        market_keyboard.append(["Back"])
-        markup = ReplyKeyboardMarkup(market_keyboard, one_time_keyboard=True)
-        update.message.reply_text("You choose a card, choose another one:", reply_markup=markup)
-        return MARKET
+            deck = self.show_deck(update.message.chat_id)
+            self.reply(update, deck)
+            markup = ReplyKeyboardMarkup(self.market_keyboard(False), one_time_keyboard=True)
+            self.reply(update, "You choose a card, choose another one:", markup)
+            return MARKET
 
     def deck(self, update, context):
         """Show your current deck"""
-        db = DatabaseSqlite3(self.url)
-        deck = self.show_deck(db, update.message.chat_id)
+        deck = self.show_deck(update.message.chat_id)
         markup = ReplyKeyboardMarkup(option_keyboard, one_time_keyboard=True)
         update.message.reply_text(deck, reply_markup=markup)
-        db.close()
         return OPTIONS
 
     def market(self, update, context):
         """Show the market"""
-        db = DatabaseSqlite3(self.url)
-        response = self.show_market(db)
+        response = self.show_market()
         markup = ReplyKeyboardMarkup(option_keyboard, one_time_keyboard=True)
         update.message.reply_text(response, reply_markup=markup)
-        db.close()
         return OPTIONS
     
     def overview(self, update, context):
         """Shows the overview of the game"""
-        db = DatabaseSqlite3(self.url)
-        players = db.get_data_table("Player", [["id","name","color"]], "color IS NOT NULL")
-        for player in players:
-            deck = str(player[2]) + " (" + str(player[1]) + ")\n"
-            deck += self.show_deck(db, update.message.chat_id, True)
+        for player in self.state.active_players():
+            deck = str(player["color"]) + " (" + str(player["name"]) + ")\n"
+            deck += self.show_deck(player["chat_id"], True)
             update.message.reply_text(deck)
-        turn = db.get_data_table("Turn", [["chat_id"]], "playing = 1")
-        if len(turn) > 0:
-            player = db.get_data_table("Player", [["name","color"]], "chat_id = " + str(turn[0][0]))
-            response = "Turn for " + str(player[0][1]) + " (" + str(player[0][0]) + ")"
+        if self.state.playing is not None:
+            player = self.state.player(self.state.playing)
+            response = "Turn for " + str(player["color"]) + " (" + str(player["name"]) + ")"
         else:
             response = "Game hasn't started yet!"
         markup = ReplyKeyboardMarkup(option_keyboard, one_time_keyboard=True)
         update.message.reply_text(response, reply_markup=markup)
-        db.close()
         return OPTIONS
 
     def map(self, update, context):
-        """send the map as a png"""
+        """send the map as a photo"""
         #https://github.com/python-telegram-bot/python-telegram-bot/wiki/Code-snippets#post-an-image-file-from-disk
-        response = "Not implemented yet"
         markup = ReplyKeyboardMarkup(option_keyboard, one_time_keyboard=True)
-        present = False
+        self.send_board(update, markup)
+        return OPTIONS
+
+    def send_board(self, update, markup=None):
+        """Send the board with the claimed routes and stations, the plain board picture when it can't be drawn"""
+        board = self.local.game.board
+        drawn = board.picture() if board is not None else None
+        if drawn is not None:
+            digest, photo = drawn
+            self.media.reply_photo(update.message, digest, lambda: io.BytesIO(photo), reply_markup=markup)
+            return
+        picture = None
         for board in os.listdir(os.path.join(self.path, "board")):
             if self.map_name in board:
-                try:
-                    picture = os.path.join(self.path, "board", board)
-                    present = True
-                except Exception as e:
-                    logger.error(e)
-        if not present:
+                picture = os.path.join(self.path, "board", board)
+        if picture is None:
             update.message.reply_text("Unable to find map picture!", reply_markup=markup)
-        else:
-            update.message.reply_photo(open(picture, 'rb'), reply_markup=markup)
-        return OPTIONS
+            return
+        def upload():
+            with open(picture, 'rb') as photo:
+                return io.BytesIO(photo.read())
+        self.media.reply_photo(update.message, self.media.file_key(picture), upload, reply_markup=markup)
 
     def all_routes(self, update, context):
         """Show all routes in the game"""
@@ -1254,14 +887,32 @@ class VTR_BOT():
 
     def longest_route(self, update, context):
         """Show who has the longest continous route"""
-        response = "Not implemented yet"
+        longest = self.engine.longest
+        response = "Longest routes:\n"
+        for player in self.state.active_players():
+            response += str(player["color"]) + " (" + str(player["name"]) + "): " + str(longest.length(player["chat_id"]))
+            cities = [self.state.city_name(city_id) for city_id in longest.cities(player["chat_id"])]
+            if cities:
+                response += " trains, " + " - ".join(cities)
+            response += "\n"
+        leaders = longest.leaders()
+        if leaders:
+            names = [str(self.state.player(chat_id)["name"]) for chat_id in leaders]
+            response += "\nLongest route: " + ", ".join(names)
+            if self.longest_route_active:
+                response += " (+" + str(self.scores["longest_route"]) + " points at the end)"
         markup = ReplyKeyboardMarkup(option_keyboard, one_time_keyboard=True)
         update.message.reply_text(response, reply_markup=markup)
         return OPTIONS
 
     def points(self, update, context):
         """Show all the players points"""
-        response = "Not implemented yet"
+        if self.engine.finished:
+            response = "Final scores:\n"
+        else:
+            response = "Scores so far, open tickets are not counted yet:\n"
+        for chat_id, score in self.engine.results():
+            response += "\n" + self.show_score(chat_id, score, self.engine.finished or chat_id == update.message.chat_id)
         markup = ReplyKeyboardMarkup(option_keyboard, one_time_keyboard=True)
         update.message.reply_text(response, reply_markup=markup)
         return OPTIONS
@@ -1275,12 +926,14 @@ class VTR_BOT():
 
     def next_turn_hehe(self, update, context):
         """help section"""
-        db = DatabaseSqlite3(self.url)
-        markup = ReplyKeyboardMarkup(option_keyboard, one_time_keyboard=True)
-        update.message.reply_text("Turn done...", reply_markup=markup)
-        self.next_turn(db)
-        db.close()
-        return OPTIONS
+        with self.state.unit():
+            markup = ReplyKeyboardMarkup(option_keyboard, one_time_keyboard=True)
+            if not self.your_turn(update.message.chat_id):
+                self.reply(update, "It's not your turn yet! Going back...", markup)
+                return OPTIONS
+            self.reply(update, "Turn done...", markup)
+            self.engine.end_turn()
+            return OPTIONS
 
 
     def error(self, update, context):